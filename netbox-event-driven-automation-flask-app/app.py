@@ -1,15 +1,35 @@
 import os
-import logging
 import json
 import yaml
+import logging
 
 from datetime import datetime
 
 # adapted from: https://majornetwork.net/2019/10/webhook-listener-for-netbox/
 
+from helpers.bulk_migration import BulkMigration, BulkMigrations, plan_bulk_migration, DEFAULT_MAX_EVENT_STREAMS, DEFAULT_MAX_PER_SOURCE, DEFAULT_MAX_PER_TARGET, DEFAULT_MIGRATION_TIMEOUT
+from helpers.client_registry import client_registry
+from helpers.cluster_inventory import cluster_inventory
+from helpers.clone_strategy import clone_strategy
+from helpers.dedupe_store import WebhookDedupeStore, DEDUPE_STATE_DONE, IN_PROGRESS_RETRY_AFTER
+from helpers.disk_batch import is_batchable_disk_webhook, merge_disk_webhooks
+from helpers.job_queue import WebhookJobQueue
+from helpers.keyed_executor import KeyedExecutor
+from helpers.netbox_cache import netbox_vm_cache
+from helpers.node_routing import node_routes
+from helpers.metrics import METRICS_CONTENT_TYPE, metrics_output, webhooks_in_flight
+from helpers.status_store import SharedStatusStore
+from helpers.task_watcher import task_watchers
+from helpers.transport import transport
+from helpers.vmid_allocator import vmid_allocator
+from helpers.warm_pool import warm_pool
+from helpers.webhook_event import WebhookEvent
+from helpers.webhook_router import WebhookRouter
+from helpers.webhook_logging import webhook_logger, log_webhook, webhook_capture_logger, capture_webhook, WebhookPayload, DEFAULT_PAYLOAD_MAX_BYTES, DEFAULT_PAYLOAD_SAMPLE_RATE
 from helpers.netbox_proxmox import NetBoxProxmoxHelper, NetBoxProxmoxHelperVM, NetBoxProxmoxHelperLXC, NetBoxProxmoxHelperMigrate
 
-from flask import Flask, Response, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
+from proxmoxer import ResourceException
 from flask_restx import Api, Resource, fields
 
 VERSION = '2025.11.01'
@@ -25,6 +45,89 @@ with open(app_config_file) as yaml_cfg:
 if not 'netbox_webhook_name' in app_config:
     raise ValueError(f"'netbox_webhook_name' missing in {app_config_file}")
 
+if 'client_pool' in app_config and app_config['client_pool']:
+    client_registry.configure(
+        pool_connections=app_config['client_pool'].get('pool_connections'),
+        pool_maxsize=app_config['client_pool'].get('pool_maxsize')
+    )
+
+if 'transport' in app_config and app_config['transport']:
+    transport.configure(
+        connect_timeout=app_config['transport'].get('connect_timeout'),
+        read_timeout=app_config['transport'].get('read_timeout'),
+        retries=app_config['transport'].get('retries'),
+        backoff=app_config['transport'].get('backoff'),
+        max_backoff=app_config['transport'].get('max_backoff'),
+        retry_budget=app_config['transport'].get('retry_budget'),
+        failure_threshold=app_config['transport'].get('failure_threshold'),
+        reset_timeout=app_config['transport'].get('reset_timeout')
+    )
+
+if 'node_routing' in app_config and app_config['node_routing']:
+    node_routes.configure(
+        enabled=app_config['node_routing'].get('enabled'),
+        refresh_interval=app_config['node_routing'].get('refresh_interval'),
+        retry_after=app_config['node_routing'].get('retry_after'),
+        addresses=app_config['node_routing'].get('addresses')
+    )
+
+if 'task_watcher' in app_config and app_config['task_watcher']:
+    task_watchers.configure(
+        min_interval=app_config['task_watcher'].get('min_interval'),
+        max_interval=app_config['task_watcher'].get('max_interval'),
+        backoff=app_config['task_watcher'].get('backoff'),
+        max_errors=app_config['task_watcher'].get('max_errors'),
+        timeout=app_config['task_watcher'].get('timeout')
+    )
+
+if 'cluster_inventory' in app_config and app_config['cluster_inventory']:
+    cluster_inventory.configure(
+        enabled=app_config['cluster_inventory'].get('enabled'),
+        refresh_interval=app_config['cluster_inventory'].get('refresh_interval'),
+        max_age=app_config['cluster_inventory'].get('max_age')
+    )
+
+if 'vmid_allocator' in app_config and app_config['vmid_allocator']:
+    vmid_allocator.configure(
+        enabled=app_config['vmid_allocator'].get('enabled'),
+        vmid_min=app_config['vmid_allocator'].get('vmid_min'),
+        vmid_max=app_config['vmid_allocator'].get('vmid_max'),
+        lease_ttl=app_config['vmid_allocator'].get('lease_ttl'),
+        sqlite_path=app_config['vmid_allocator'].get('sqlite_path')
+    )
+
+if 'clone_strategy' in app_config and app_config['clone_strategy']:
+    clone_strategy.configure(
+        default=app_config['clone_strategy'].get('default'),
+        templates=app_config['clone_strategy'].get('templates'),
+        tags=app_config['clone_strategy'].get('tags'),
+        local_storage=app_config['clone_strategy'].get('local_storage'),
+        linked_storage_types=app_config['clone_strategy'].get('linked_storage_types'),
+        cache_ttl=app_config['clone_strategy'].get('cache_ttl')
+    )
+
+if 'warm_pool' in app_config and app_config['warm_pool']:
+    warm_pool.configure(
+        enabled=app_config['warm_pool'].get('enabled'),
+        pools=app_config['warm_pool'].get('pools'),
+        name_prefix=app_config['warm_pool'].get('name_prefix'),
+        refill_interval=app_config['warm_pool'].get('refill_interval'),
+        clone_timeout=app_config['warm_pool'].get('clone_timeout'),
+        lock_file=app_config['warm_pool'].get('lock_file')
+    )
+
+if 'netbox_cache' in app_config and app_config['netbox_cache']:
+    netbox_vm_cache.configure(
+        ttl=app_config['netbox_cache'].get('ttl'),
+        max_entries=app_config['netbox_cache'].get('max_entries')
+    )
+
+# a webhook only drops cached records in the gunicorn worker that receives it: with more
+# than one worker, only share lookups within a webhook
+if int((app_config.get('server') or {}).get('workers', 1)) > 1 and netbox_vm_cache.ttl:
+    logging.warning(f"netbox_cache: ttl {netbox_vm_cache.ttl:g} ignored with more than one gunicorn worker")
+    netbox_vm_cache.configure(ttl=0)
+
 app = Flask(__name__)
 api = Api(app, version=VERSION, title="NetBox-Proxmox Webhook Listener",
         description="NetBox-Proxmox Webhook Listener")
@@ -39,12 +142,16 @@ if app.debug:
 
 APP_NAME = "netbox-proxmox-webhook-listener"
 
-logger = logging.getLogger(APP_NAME)
-logger.setLevel(logging.INFO)
-formatter = logging.Formatter("%(asctime)s %(name)s %(levelname)s: %(message)s")
-file_logging = logging.FileHandler("{}.log".format(APP_NAME))
-file_logging.setFormatter(formatter)
-logger.addHandler(file_logging)
+# JSON lines, written by a background thread and rotated by size
+logger = webhook_logger(APP_NAME, app_config.get('logging'))
+payload_sample_rate = float((app_config.get('logging') or {}).get('payload_sample_rate', DEFAULT_PAYLOAD_SAMPLE_RATE))
+payload_max_bytes = int((app_config.get('logging') or {}).get('payload_max_bytes', DEFAULT_PAYLOAD_MAX_BYTES))
+
+# optionally record every incoming webhook for replay_webhooks.py
+webhook_capture = None
+
+if (app_config.get('webhook_capture') or {}).get('file'):
+    webhook_capture = webhook_capture_logger(app_config['webhook_capture']['file'])
 
 webhook_request = api.model("Webhook request from NetBox", {
     'username': fields.String,
@@ -67,170 +174,438 @@ session = {
   },
 }
 
+# request counters shared by all worker processes (see gunicorn.conf.py)
+status_store = SharedStatusStore()
+
+# Optionally hold 'updated' webhooks for a VM for `window` seconds and fold bursts together,
+# and collect disk webhooks for a VM for `disk_window` seconds and apply them together
+webhook_coalesce = {
+    'window': float((app_config.get('webhook_coalesce') or {}).get('window', 0)),
+    'disk_window': float((app_config.get('webhook_coalesce') or {}).get('disk_window', 0)),
+    'max_delay': float((app_config.get('webhook_coalesce') or {}).get('max_delay', 10))
+}
+
+# NetBox retries deliveries on timeout; duplicates get the cached or in-progress result
+webhook_dedupe = None
+
+if (app_config.get('webhook_dedupe') or {}).get('enabled', True):
+    webhook_dedupe = WebhookDedupeStore(
+        max_entries=(app_config.get('webhook_dedupe') or {}).get('max_entries', 10000),
+        ttl=(app_config.get('webhook_dedupe') or {}).get('ttl', 3600),
+        sqlite_path=(app_config.get('webhook_dedupe') or {}).get('sqlite_path'),
+        in_progress_ttl=(app_config.get('webhook_dedupe') or {}).get('in_progress_ttl', 900)
+    )
+
+# Webhooks for the same VM run in order, webhooks for different VMs run in parallel
+webhook_lanes = None
+webhook_jobs = None
+
+# with webhook_jobs.async, webhooks are accepted right away (202 + /jobs/<job_id>/)
+if 'webhook_jobs' in app_config and app_config['webhook_jobs'] and app_config['webhook_jobs'].get('async', False):
+    webhook_jobs = WebhookJobQueue(
+        workers=app_config['webhook_jobs'].get('workers', 4),
+        max_finished_jobs=app_config['webhook_jobs'].get('max_finished_jobs', 1000),
+        debug=DEBUG
+    )
+    webhook_jobs.start()
+else:
+    webhook_lanes = KeyedExecutor(
+        workers=(app_config.get('webhook_lanes') or {}).get('workers', 8),
+        name='webhook-lane-worker'
+    )
+    webhook_lanes.start()
+
+
+# optional: drain nodes / migrate many guests at once (POST /<netbox_webhook_name>/migrations/)
+bulk_migration_config = app_config.get('bulk_migration') or {}
+bulk_migrations = BulkMigrations(max_event_streams=bulk_migration_config.get('max_event_streams', DEFAULT_MAX_EVENT_STREAMS))
+
+
+def start_warm_pool():
+    # called in a process that serves webhooks (gunicorn's post_worker_init, or __main__), never
+    # in the gunicorn master: its connections and locks would be inherited by every worker.
+    # Workers take turns refilling through the lock file, and all of them claim from the pool
+    if warm_pool.enabled:
+        warm_pool.start(NetBoxProxmoxHelperVM(app_config, None, DEBUG))
+
 
 @ns.route("/status/", methods=['GET'])
 class WebhookListener(Resource):
     @ns.expect(webhook_request)
 
     def get(self):
-        _session = session.copy()
+        status_store.record('requests')
+        status_stats = status_store.get_stats()
+
+        _session = dict(session)
         _session['version_lastrun'] = VERSION
-        _session['status']['requests'] += 1
-        _session['status']['last_called'] = datetime.now()
-        sanitized_full_path = request.full_path.replace('\r\n', '').replace('\n', '')
-        sanitized_remote_addr = request.remote_addr.replace('\r\n', '').replace('\n', '') if request.remote_addr else 'Unknown'
-        sanitized_data = request.get_data(as_text=True).replace('\r\n', '').replace('\n', '') if request.get_data() else ''
-        logger.info(f"{sanitized_full_path}, {sanitized_remote_addr}, Status request with data {sanitized_data}")
+        _session['server_start'] = datetime.fromtimestamp(status_stats['server_start']).isoformat()
+        _session['status'] = {
+            'requests': status_stats['counters']['requests'],
+            'last_called': datetime.fromtimestamp(status_stats['last_called']['requests']).isoformat(),
+            'webhooks': status_stats['counters']['webhooks'],
+            'webhook_last_called': datetime.fromtimestamp(status_stats['last_called']['webhooks']).isoformat() if status_stats['counters']['webhooks'] else ""
+        }
+        _session['process'] = {'pid': os.getpid()}
+        _session['clients'] = client_registry.get_stats()
+        _session['task_watchers'] = task_watchers.get_stats()
+        _session['netbox_cache'] = netbox_vm_cache.get_stats()
+        _session['inventory'] = cluster_inventory.get_stats()
+        _session['vmids'] = vmid_allocator.get_stats()
+        _session['warm_pool'] = warm_pool.get_stats()
+        _session['clones'] = clone_strategy.get_stats()
+        _session['transport'] = transport.get_stats()
+        _session['node_routing'] = node_routes.get_stats()
+        _session['routes'] = webhook_router.get_stats()
+
+        if webhook_jobs:
+            _session['jobs'] = webhook_jobs.get_stats()
+        else:
+            _session['lanes'] = webhook_lanes.get_stats()
+
+        if webhook_dedupe:
+            _session['dedupe'] = webhook_dedupe.get_stats()
+
+        if bulk_migration_config.get('enabled', False):
+            _session['bulk_migrations'] = bulk_migrations.get_stats()
+
+        request_data = request.get_data(as_text=True)
+        logger.info("Status request", extra={'path': request.full_path, 'remote_addr': request.remote_addr or 'Unknown', 'data': request_data[:1024]})
         return jsonify(_session)
 
 
+@app.route("/metrics")
+def metrics():
+    return Response(metrics_output(), mimetype=METRICS_CONTENT_TYPE)
+
+
+@ns.route("/jobs/<string:job_id>/", methods=['GET'])
+class WebhookJobStatus(Resource):
+    def get(self, job_id):
+        if not webhook_jobs:
+            return {'result': 'Asynchronous webhook jobs are not enabled'}, 404
+
+        job_info = webhook_jobs.get(job_id)
+
+        if not job_info:
+            return {'result': f"Unknown job {job_id}"}, 404
+
+        return job_info, 200
+
+
+@ns.route("/migrations/", methods=['POST'])
+class BulkMigrationStart(Resource):
+    def post(self):
+        if not bulk_migration_config.get('enabled', False):
+            return {'result': 'Bulk migrations are not enabled'}, 404
+
+        migration_request = request.get_json(silent=True) or {}
+
+        try:
+            helper = NetBoxProxmoxHelper(app_config, None, DEBUG)
+            proxmox_api = helper.proxmox_api
+
+            guests, target_nodes = plan_bulk_migration(
+                proxmox_api,
+                source_node=migration_request.get('source_node'),
+                vmids=migration_request.get('vmids'),
+                target_nodes=migration_request.get('target_nodes')
+            )
+
+            bulk_migration = bulk_migrations.start(BulkMigration(
+                proxmox_api,
+                guests,
+                target_nodes,
+                max_per_source=migration_request.get('max_per_source') or bulk_migration_config.get('max_per_source', DEFAULT_MAX_PER_SOURCE),
+                max_per_target=migration_request.get('max_per_target') or bulk_migration_config.get('max_per_target', DEFAULT_MAX_PER_TARGET),
+                bwlimit=migration_request.get('bwlimit') or bulk_migration_config.get('bwlimit'),
+                timeout=bulk_migration_config.get('timeout', DEFAULT_MIGRATION_TIMEOUT),
+                netbox_api=helper.netbox_api
+            ))
+        except (TypeError, ValueError) as e:
+            return {'result': str(e)}, 400
+        except ResourceException as e:
+            return {'result': e.content}, 500
+
+        return bulk_migration.to_dict(), 202
+
+
+@ns.route("/migrations/<string:migration_id>/", methods=['GET', 'DELETE'])
+class BulkMigrationStatus(Resource):
+    def get(self, migration_id):
+        bulk_migration = bulk_migrations.get(migration_id)
+
+        if not bulk_migration:
+            return {'result': f"Unknown migration {migration_id}"}, 404
+
+        return bulk_migration.to_dict(), 200
+
+
+    def delete(self, migration_id):
+        # queued guests are not migrated; running migrations finish
+        bulk_migration = bulk_migrations.get(migration_id)
+
+        if not bulk_migration:
+            return {'result': f"Unknown migration {migration_id}"}, 404
+
+        bulk_migration.cancel()
+
+        return bulk_migration.to_dict(include_guests=False), 202
+
+
+@ns.route("/migrations/<string:migration_id>/events/", methods=['GET'])
+class BulkMigrationEvents(Resource):
+    def get(self, migration_id):
+        # one JSON line per progress event, streamed until the migration has finished
+        bulk_migration = bulk_migrations.get(migration_id)
+
+        if not bulk_migration:
+            return {'result': f"Unknown migration {migration_id}"}, 404
+
+        since = request.args.get('since', 0, type=int)
+
+        # every stream holds a worker thread: leave the rest for webhooks
+        if not bulk_migrations.open_event_stream():
+            return {'result': f"Too many progress streams open (max_event_streams: {bulk_migrations.max_event_streams})"}, 503, {'Retry-After': '30'}
+
+        def stream_events():
+            for event in bulk_migration.iter_events(since):
+                yield json.dumps(event) + "\n" if event else "\n"
+
+            yield json.dumps(bulk_migration.to_dict(include_guests=False)) + "\n"
+
+        response = Response(stream_with_context(stream_events()), mimetype='application/x-ndjson')
+        # also called when the client goes away before the migration has finished
+        response.call_on_close(bulk_migrations.close_event_stream)
+
+        return response
+
+
+def webhook_coalesce_options(webhook_event):
+    # disk webhooks for a VM are applied as one batch
+    if webhook_coalesce['disk_window'] and is_batchable_disk_webhook(webhook_event):
+        return {
+            'merge_key': 'vm-disks',
+            'merge': merge_disk_webhook_args,
+            'delay': webhook_coalesce['disk_window'],
+            'max_delay': webhook_coalesce['max_delay']
+        }
+
+    # bursts of 'updated' webhooks for a staged VM are folded into the latest desired state
+    if not webhook_coalesce['window']:
+        return {}
+
+    if webhook_event.model != 'virtualmachine' or webhook_event.event != 'updated':
+        return {}
+
+    if webhook_event.vm_type != 'vm' or webhook_event.status != 'staged':
+        return {}
+
+    return {
+        'merge_key': 'vm-staged-updated',
+        'merge': merge_webhook_updates,
+        'delay': webhook_coalesce['window'],
+        'max_delay': webhook_coalesce['max_delay']
+    }
+
+
+def merge_webhook_updates(pending_args, incoming_args):
+    # NetBox sends the full object with every webhook, so the newest payload is the desired
+    # state; keep the oldest prechange snapshot so the merged event covers the whole burst
+    pending_json_data = pending_args[0].payload
+    merged_json_data = dict(incoming_args[0].payload)
+
+    if 'snapshots' in pending_json_data and 'snapshots' in merged_json_data:
+        merged_json_data['snapshots'] = dict(merged_json_data['snapshots'])
+        merged_json_data['snapshots']['prechange'] = pending_json_data['snapshots'].get('prechange')
+
+    return (WebhookEvent.from_json(merged_json_data),) + tuple(incoming_args[1:])
+
+
+def merge_disk_webhook_args(pending_args, incoming_args):
+    return (WebhookEvent.from_json(merge_disk_webhooks(pending_args[0].payload, incoming_args[0].payload)),) + tuple(incoming_args[1:])
+
+
+def webhook_response(results):
+    response = Response(
+        json.dumps(results[1]),
+        status = results[0],
+        mimetype = 'application/json'
+    )
+
+    response_body = {'result': response.json['result']}
+
+    # per-field outcome of VM config updates
+    if 'fields' in response.json:
+        response_body['fields'] = response.json['fields']
+
+    # per-disk outcome of disk batches
+    if 'disks' in response.json:
+        response_body['disks'] = response.json['disks']
+
+    return response.status_code, response_body
+
+
+def webhook_vm_helper(webhook_event):
+    return NetBoxProxmoxHelperVM(app_config, webhook_event.node, DEBUG)
+
+
+def webhook_lxc_helper(webhook_event):
+    return NetBoxProxmoxHelperLXC(app_config, webhook_event.node, DEBUG)
+
+
+def webhook_disk_node(webhook_event):
+    # virtual disk webhooks do not carry the Proxmox node, so ask NetBox for it
+    tcall = NetBoxProxmoxHelper(app_config, None, DEBUG)
+    return tcall.netbox_get_proxmox_node_from_vm_id(webhook_event.netbox_vm_id)
+
+
+def migrate_vm(webhook_event):
+    pxmx_migrate = NetBoxProxmoxHelperMigrate(app_config, None, DEBUG)
+
+    return pxmx_migrate.migrate_vm(webhook_event.vmid, webhook_event.prechange_node, webhook_event.node)
+
+
+def update_lxc_config(webhook_event):
+    tc = webhook_lxc_helper(webhook_event)
+
+    if DEBUG:
+        print(f"LXC STAGED INPUT {webhook_event.payload['data']}", webhook_event.event)
+
+    if webhook_event.payload['data']['primary_ip'] and webhook_event.payload['data']['primary_ip']['address']:
+        results = tc.proxmox_lxc_set_net0(webhook_event.payload)
+
+    if webhook_event.changed('vcpus', 'memory'):
+        results = tc.proxmox_update_lxc_vpus_and_memory(webhook_event.payload)
+    else:
+        results = (200, {'result': 'No resources to change'})
+
+    return results
+
+
+# handlers get a WebhookEvent (helpers/webhook_event.py); the helpers take the payload as NetBox sent it
+webhook_handlers = {
+    'missing-proxmox-node': lambda webhook_event: (500, {'result': 'Missing proxmox_node in custom_fields'}),
+    'unknown-status': lambda webhook_event: (500, {'result': f"Unknown value {webhook_event.status}"}),
+    'unknown-event': lambda webhook_event: (500, {'result': f"Unknown event: {webhook_event.event}"}),
+    'vm-clone': lambda webhook_event: webhook_vm_helper(webhook_event).proxmox_clone_vm(webhook_event.payload),
+    'vm-update-config': lambda webhook_event: webhook_vm_helper(webhook_event).proxmox_update_vm_config(webhook_event.payload),
+    'vm-delete': lambda webhook_event: webhook_vm_helper(webhook_event).proxmox_delete_vm(webhook_event.payload),
+    'vm-start': lambda webhook_event: webhook_vm_helper(webhook_event).proxmox_start_vm(webhook_event.payload),
+    'vm-stop': lambda webhook_event: webhook_vm_helper(webhook_event).proxmox_stop_vm(webhook_event.payload),
+    'vm-migrate': migrate_vm,
+    'lxc-create': lambda webhook_event: webhook_lxc_helper(webhook_event).proxmox_create_lxc(webhook_event.payload),
+    'lxc-update-config': update_lxc_config,
+    'lxc-delete': lambda webhook_event: webhook_lxc_helper(webhook_event).proxmox_delete_lxc(webhook_event.payload),
+    'lxc-start': lambda webhook_event: webhook_lxc_helper(webhook_event).proxmox_start_lxc(webhook_event.payload),
+    'lxc-stop': lambda webhook_event: webhook_lxc_helper(webhook_event).proxmox_stop_lxc(webhook_event.payload),
+    'lxc-resize-disk': lambda webhook_event: NetBoxProxmoxHelperLXC(app_config, webhook_disk_node(webhook_event), DEBUG).proxmox_lxc_resize_disk(webhook_event.payload),
+    'lxc-delete-disk': lambda webhook_event: (200, {'result': 'All good'}),
+    'vm-add-disk': lambda webhook_event: NetBoxProxmoxHelperVM(app_config, webhook_disk_node(webhook_event), DEBUG).proxmox_add_disk(webhook_event.payload),
+    'vm-resize-disk': lambda webhook_event: NetBoxProxmoxHelperVM(app_config, webhook_disk_node(webhook_event), DEBUG).proxmox_resize_disk(webhook_event.payload),
+    'vm-delete-disk': lambda webhook_event: NetBoxProxmoxHelperVM(app_config, webhook_disk_node(webhook_event), DEBUG).proxmox_delete_disk(webhook_event.payload),
+    'vm-disk-batch': lambda webhook_event: NetBoxProxmoxHelperVM(app_config, webhook_disk_node(webhook_event), DEBUG).proxmox_apply_disk_batch(webhook_event.payload)
+}
+
+# built once: (model, vm_type, status, event, change) -> handler, with per-route counters
+webhook_router = WebhookRouter(webhook_handlers)
+
+
+def process_webhook(webhook_event):
+    if DEBUG:
+        print(f"INCOMING DATA FOR WEBHOOK {webhook_event.event} --> {webhook_event.model}\n", json.dumps(webhook_event.payload, indent=4))
+
+    # NetBox VM lookups are done at most once per webhook
+    with netbox_vm_cache.request_scope():
+        results = webhook_router.dispatch(webhook_event)
+
+    if DEBUG:
+        print("RAW RESULTS", results)
+
+    return results
+
+
 # For handling event rules
 @ns.route("/")
 class WebhookListener(Resource):
     @ns.expect(webhook_request)
     def post(self):
+        status_store.record('webhooks')
+
         try:
             webhook_json_data = request.json
         except:
             webhook_json_data = {}
 
-        sanitized_data = json.dumps(webhook_json_data).replace('\n', '').replace('\r', '')
-        logger.info("User-provided data: {}".format(sanitized_data))
+        payload = WebhookPayload(webhook_json_data, request.content_length)
+        capture_webhook(webhook_capture, payload)
+        log_webhook(logger, payload, payload_sample_rate, payload_max_bytes, remote_addr=request.remote_addr or 'Unknown')
 
         if not webhook_json_data or "model" not in webhook_json_data or "event" not in webhook_json_data:
             return {"result":"invalid input"}, 400
 
-        results = (500, {'result': 'Default error message (obviously something has gone wrong)'})
-
-        if DEBUG:
-            print(f"INCOMING DATA FOR WEBHOOK {webhook_json_data['event']} --> {webhook_json_data['model']}\n", json.dumps(webhook_json_data, indent=4))
-
-        if webhook_json_data['model'] == 'virtualmachine':
-            if not 'proxmox_node' in webhook_json_data['data']['custom_fields']:
-                results = 500, {'result': 'Missing proxmox_node in custom_fields'}
-            
-            proxmox_node = webhook_json_data['data']['custom_fields']['proxmox_node']
-
-            if webhook_json_data['data']['custom_fields']['proxmox_vm_type'] == 'vm':
-                tc = NetBoxProxmoxHelperVM(app_config, proxmox_node, DEBUG)
-
-                if webhook_json_data['data']['status']['value'] == 'staged':
-                    if webhook_json_data['event'] == 'created':
-                        results = tc.proxmox_clone_vm(webhook_json_data)
-                    elif webhook_json_data['event'] == 'updated':
-                        results = tc.proxmox_update_vm_vcpus_and_memory(webhook_json_data)
-
-                        if webhook_json_data['data']['primary_ip'] and webhook_json_data['data']['primary_ip']['address']:
-                            results = tc.proxmox_set_ipconfig0(webhook_json_data)
-
-                        if 'proxmox_public_ssh_key' in webhook_json_data['data']['custom_fields'] and webhook_json_data['data']['custom_fields']['proxmox_public_ssh_key']:
-                            results = tc.proxmox_set_ssh_public_key(webhook_json_data)
-                    elif webhook_json_data['event'] == 'deleted':
-                        results = tc.proxmox_delete_vm(webhook_json_data)
-                elif webhook_json_data['event'] == 'updated':
-                    if webhook_json_data['data']['status']['value'] == 'offline':
-                        if (webhook_json_data['data']['status']['value'] != webhook_json_data['snapshots']['prechange']['status']) and (webhook_json_data['data']['custom_fields']['proxmox_node'] == webhook_json_data['snapshots']['prechange']['custom_fields']['proxmox_node']):
-                            results = tc.proxmox_stop_vm(webhook_json_data)
-
-                        if webhook_json_data['data']['custom_fields']['proxmox_node'] != webhook_json_data['snapshots']['prechange']['custom_fields']['proxmox_node']:
-                            proxmox_vmid = int(webhook_json_data['data']['custom_fields']['proxmox_vmid'])
-                            source_node = webhook_json_data['snapshots']['prechange']['custom_fields']['proxmox_node']
-                            target_node = webhook_json_data['data']['custom_fields']['proxmox_node']
-
-                            pxmx_migrate = NetBoxProxmoxHelperMigrate(app_config, None, DEBUG)
-
-                            results = pxmx_migrate.migrate_vm(proxmox_vmid, source_node, target_node)                            
-
-                    elif webhook_json_data['data']['status']['value'] == 'active':
-                        if (webhook_json_data['data']['status']['value'] != webhook_json_data['snapshots']['prechange']['status']) and (webhook_json_data['data']['custom_fields']['proxmox_node'] == webhook_json_data['snapshots']['prechange']['custom_fields']['proxmox_node']):
-                            results = tc.proxmox_start_vm(webhook_json_data)
-
-                        if webhook_json_data['data']['custom_fields']['proxmox_node'] != webhook_json_data['snapshots']['prechange']['custom_fields']['proxmox_node']:
-                            proxmox_vmid = int(webhook_json_data['data']['custom_fields']['proxmox_vmid'])
-                            source_node = webhook_json_data['snapshots']['prechange']['custom_fields']['proxmox_node']
-                            target_node = webhook_json_data['data']['custom_fields']['proxmox_node']
-
-                            pxmx_migrate = NetBoxProxmoxHelperMigrate(app_config, None, DEBUG)
-
-                            results = pxmx_migrate.migrate_vm(proxmox_vmid, source_node, target_node)                            
-                    else:
-                        results = (500, {'result': f"Unknown value {webhook_json_data['data']['status']['value']}"})
-                elif webhook_json_data['event'] == 'deleted':
-                    results = tc.proxmox_delete_vm(webhook_json_data)
-            elif webhook_json_data['data']['custom_fields']['proxmox_vm_type'] == 'lxc':
-                tc = NetBoxProxmoxHelperLXC(app_config, proxmox_node, DEBUG)
-
-                if webhook_json_data['data']['status']['value'] == 'staged':
-                    if DEBUG:
-                        print(f"LXC STAGED INPUT {webhook_json_data['data']}", webhook_json_data['event'])
-
-                    if webhook_json_data['event'] == 'created':
-                        results = tc.proxmox_create_lxc(webhook_json_data)
-                    elif webhook_json_data['event'] == 'updated':
-                        if webhook_json_data['data']['primary_ip'] and webhook_json_data['data']['primary_ip']['address']:
-                            results = tc.proxmox_lxc_set_net0(webhook_json_data)
-
-                        if (webhook_json_data['snapshots']['prechange']['vcpus'] != webhook_json_data['snapshots']['postchange']['vcpus']) or (webhook_json_data['snapshots']['prechange']['memory'] != webhook_json_data['snapshots']['postchange']['memory']):
-                            results = tc.proxmox_update_lxc_vpus_and_memory(webhook_json_data)
-                        else:
-                            results = (200, {'result': 'No resources to change'})
-                    elif webhook_json_data['event'] == 'deleted':
-                        results = tc.proxmox_delete_lxc(webhook_json_data)
-                elif webhook_json_data['event'] == 'updated':
-                    if webhook_json_data['data']['status']['value'] == 'offline':
-                        results = tc.proxmox_stop_lxc(webhook_json_data)
-                    elif webhook_json_data['data']['status']['value'] == 'active':
-                        results = tc.proxmox_start_lxc(webhook_json_data)
-                    else:
-                        results = (500, {'result': f"Unknown value {webhook_json_data['data']['status']['value']}"})
-                elif webhook_json_data['event'] == 'deleted':
-                    results = tc.proxmox_delete_lxc(webhook_json_data)
-                else:
-                    results = (500, {'result': f"Unknown event: {webhook_json_data['event']}"})
-        elif webhook_json_data['model'] == 'virtualdisk':
-            results = 500, {'result': 'Something has gone wrong with virtualdisk management'}
-            is_lxc = False
-
-            if webhook_json_data['data']['name'] == 'rootfs':
-                is_lxc = True
-
-            if DEBUG:
-                print("HERE VIRTUALDISK", is_lxc)
-
-            tcall = NetBoxProxmoxHelper(app_config, None, DEBUG)
-            proxmox_node = tcall.netbox_get_proxmox_node_from_vm_id(webhook_json_data['data']['virtual_machine']['id'])
-
-            if is_lxc:
-                if DEBUG:
-                    print("change disk lxc")
-
-                if webhook_json_data['event'] == 'updated':
-                    if webhook_json_data['snapshots']['prechange']['size'] != webhook_json_data['snapshots']['postchange']['size']:
-                        tc = NetBoxProxmoxHelperLXC(app_config, proxmox_node, DEBUG)
-                        results = tc.proxmox_lxc_resize_disk(webhook_json_data)
-                elif webhook_json_data['event'] == 'deleted':
-                    results = 200, {'result': 'All good'}
-            else:
-                tc = NetBoxProxmoxHelperVM(app_config, proxmox_node, DEBUG)
+        if not isinstance(webhook_json_data.get('data'), dict):
+            return {"result":"invalid input"}, 400
+
+        netbox_vm_cache.invalidate_from_webhook(webhook_json_data)
+
+        # parsed once; everything after this works on the event
+        try:
+            webhook_event = WebhookEvent.from_json(webhook_json_data)
+        except (TypeError, ValueError):
+            # e.g. a proxmox_vmid that is not a number
+            return {"result":"invalid input"}, 400
 
-                if webhook_json_data['event'] == 'created':
-                    results = tc.proxmox_add_disk(webhook_json_data)
-                elif webhook_json_data['event'] == 'updated':
-                    results = tc.proxmox_resize_disk(webhook_json_data)
-                elif webhook_json_data['event'] == 'deleted':
-                    results = tc.proxmox_delete_disk(webhook_json_data)
+        dedupe_key = webhook_event.dedupe_key if webhook_dedupe else None
+
+        if dedupe_key:
+            is_new_delivery, dedupe_entry = webhook_dedupe.begin(dedupe_key)
+
+            if not is_new_delivery:
+                if dedupe_entry['state'] == DEDUPE_STATE_DONE:
+                    return webhook_response(dedupe_entry['results'])
+
+                # not a 2xx: NetBox has to keep retrying in case the first delivery fails
+                return {'result': 'in progress', 'request_id': webhook_event.request_id, 'job_id': dedupe_entry['job_id']}, 409, {'Retry-After': str(IN_PROGRESS_RETRY_AFTER)}
+
+        lane_key = webhook_event.lane_key
+        coalesce_options = webhook_coalesce_options(webhook_event) if lane_key else {}
+
+        webhooks_in_flight.inc()
+
+        if webhook_jobs:
+            def on_finished(job):
+                webhooks_in_flight.dec()
+
+                if dedupe_key:
+                    webhook_dedupe.complete(dedupe_key, job.results)
+
+            job = webhook_jobs.submit(process_webhook, webhook_event, model=webhook_event.model, event=webhook_event.event, key=lane_key, on_finished=on_finished, **coalesce_options)
+
+            if dedupe_key:
+                webhook_dedupe.attach_job(dedupe_key, job.id)
+
+            return {'result': 'accepted', 'job_id': job.id}, 202
+
+        try:
+            if lane_key:
+                results = webhook_lanes.submit(lane_key, process_webhook, webhook_event, **coalesce_options).result()
+            else:
+                results = process_webhook(webhook_event)
+        except Exception:
+            if dedupe_key:
+                webhook_dedupe.release(dedupe_key)
 
-        if DEBUG:
-            print("RAW RESULTS", results)
+            raise
+        finally:
+            webhooks_in_flight.dec()
 
-        response = Response(
-            json.dumps(results[1]),
-            status = results[0],
-            mimetype = 'application/json'
-        )
+        if dedupe_key:
+            webhook_dedupe.complete(dedupe_key, results)
 
-        return response.status_code, {'result': response.json['result']}
+        return webhook_response(results)
 
 
 if __name__ == "__main__":
+    start_warm_pool()
     app.run(host="0.0.0.0")
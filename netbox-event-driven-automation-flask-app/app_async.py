@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import aiohttp
+import yaml
+
+from aiohttp import web
+from datetime import datetime
+
+from helpers.metrics import METRICS_CONTENT_TYPE, metrics_output, webhooks_in_flight
+from helpers.cluster_inventory import cluster_inventory
+from helpers.clone_strategy import clone_strategy
+from helpers.netbox_cache import netbox_vm_cache
+from helpers.node_routing import node_routes
+from helpers.task_watcher import task_watchers
+from helpers.transport import transport
+from helpers.vmid_allocator import vmid_allocator
+from helpers.warm_pool import warm_pool
+from helpers.dedupe_store import WebhookDedupeStore, DEDUPE_STATE_DONE, IN_PROGRESS_RETRY_AFTER
+from helpers.disk_batch import is_batchable_disk_webhook, merge_disk_webhooks
+from helpers.webhook_event import WebhookEvent
+from helpers.webhook_router import WebhookRouter
+from helpers.webhook_logging import webhook_logger, log_webhook, webhook_capture_logger, capture_webhook, WebhookPayload, DEFAULT_PAYLOAD_MAX_BYTES, DEFAULT_PAYLOAD_SAMPLE_RATE
+from helpers.netbox_proxmox_async import AsyncProxmoxAPI, AsyncNetBoxAPI, AsyncNetBoxProxmoxHelper, AsyncNetBoxProxmoxHelperVM, AsyncNetBoxProxmoxHelperLXC, AsyncNetBoxProxmoxHelperMigrate
+
+VERSION = '2025.11.01'
+
+APP_NAME = "netbox-proxmox-webhook-listener"
+
+app_config_file = 'app_config.yml'
+
+with open(app_config_file) as yaml_cfg:
+    try:
+        app_config = yaml.safe_load(yaml_cfg)
+    except yaml.YAMLError as exc:
+        print(exc)
+
+if not 'netbox_webhook_name' in app_config:
+    raise ValueError(f"'netbox_webhook_name' missing in {app_config_file}")
+
+DEBUG = False
+
+# JSON lines, written by a background thread and rotated by size
+logger = webhook_logger(APP_NAME, app_config.get('logging'))
+payload_sample_rate = float((app_config.get('logging') or {}).get('payload_sample_rate', DEFAULT_PAYLOAD_SAMPLE_RATE))
+payload_max_bytes = int((app_config.get('logging') or {}).get('payload_max_bytes', DEFAULT_PAYLOAD_MAX_BYTES))
+
+# optionally record every incoming webhook for replay_webhooks.py
+webhook_capture = None
+
+if (app_config.get('webhook_capture') or {}).get('file'):
+    webhook_capture = webhook_capture_logger(app_config['webhook_capture']['file'])
+
+if app_config.get('transport'):
+    transport.configure(
+        connect_timeout=app_config['transport'].get('connect_timeout'),
+        read_timeout=app_config['transport'].get('read_timeout'),
+        retries=app_config['transport'].get('retries'),
+        backoff=app_config['transport'].get('backoff'),
+        max_backoff=app_config['transport'].get('max_backoff'),
+        retry_budget=app_config['transport'].get('retry_budget'),
+        failure_threshold=app_config['transport'].get('failure_threshold'),
+        reset_timeout=app_config['transport'].get('reset_timeout')
+    )
+
+if app_config.get('node_routing'):
+    node_routes.configure(
+        enabled=app_config['node_routing'].get('enabled'),
+        refresh_interval=app_config['node_routing'].get('refresh_interval'),
+        retry_after=app_config['node_routing'].get('retry_after'),
+        addresses=app_config['node_routing'].get('addresses')
+    )
+
+if app_config.get('task_watcher'):
+    task_watchers.configure(
+        min_interval=app_config['task_watcher'].get('min_interval'),
+        max_interval=app_config['task_watcher'].get('max_interval'),
+        backoff=app_config['task_watcher'].get('backoff'),
+        max_errors=app_config['task_watcher'].get('max_errors'),
+        timeout=app_config['task_watcher'].get('timeout')
+    )
+
+if app_config.get('netbox_cache'):
+    netbox_vm_cache.configure(
+        ttl=app_config['netbox_cache'].get('ttl'),
+        max_entries=app_config['netbox_cache'].get('max_entries')
+    )
+
+if app_config.get('cluster_inventory'):
+    cluster_inventory.configure(
+        enabled=app_config['cluster_inventory'].get('enabled'),
+        refresh_interval=app_config['cluster_inventory'].get('refresh_interval'),
+        max_age=app_config['cluster_inventory'].get('max_age')
+    )
+
+if app_config.get('vmid_allocator'):
+    vmid_allocator.configure(
+        enabled=app_config['vmid_allocator'].get('enabled'),
+        vmid_min=app_config['vmid_allocator'].get('vmid_min'),
+        vmid_max=app_config['vmid_allocator'].get('vmid_max'),
+        lease_ttl=app_config['vmid_allocator'].get('lease_ttl'),
+        sqlite_path=app_config['vmid_allocator'].get('sqlite_path')
+    )
+
+if app_config.get('clone_strategy'):
+    clone_strategy.configure(
+        default=app_config['clone_strategy'].get('default'),
+        templates=app_config['clone_strategy'].get('templates'),
+        tags=app_config['clone_strategy'].get('tags'),
+        local_storage=app_config['clone_strategy'].get('local_storage'),
+        linked_storage_types=app_config['clone_strategy'].get('linked_storage_types'),
+        cache_ttl=app_config['clone_strategy'].get('cache_ttl')
+    )
+
+if app_config.get('warm_pool'):
+    warm_pool.configure(
+        enabled=app_config['warm_pool'].get('enabled'),
+        pools=app_config['warm_pool'].get('pools'),
+        name_prefix=app_config['warm_pool'].get('name_prefix'),
+        refill_interval=app_config['warm_pool'].get('refill_interval'),
+        clone_timeout=app_config['warm_pool'].get('clone_timeout')
+    )
+
+session = {
+  'name': "netbox-webhook-asyncio-app",
+  'version': VERSION,
+  'version_lastrun': VERSION,
+  'server_start': "",
+  'status': {
+    'requests': 0,
+    'last_called': ""
+  },
+}
+
+webhook_dedupe = None
+
+if (app_config.get('webhook_dedupe') or {}).get('enabled', True):
+    webhook_dedupe = WebhookDedupeStore(
+        max_entries=(app_config.get('webhook_dedupe') or {}).get('max_entries', 10000),
+        ttl=(app_config.get('webhook_dedupe') or {}).get('ttl', 3600),
+        sqlite_path=(app_config.get('webhook_dedupe') or {}).get('sqlite_path'),
+        in_progress_ttl=(app_config.get('webhook_dedupe') or {}).get('in_progress_ttl', 900)
+    )
+
+# webhooks for the same VM run in order, webhooks for different VMs run concurrently
+webhook_lane_locks = {}
+
+# 'updated' webhooks for a staged VM that arrive within `window` seconds are folded together,
+# and disk webhooks for a VM that arrive within `disk_window` seconds are applied together
+webhook_coalesce = {
+    'window': float((app_config.get('webhook_coalesce') or {}).get('window', 0)),
+    'disk_window': float((app_config.get('webhook_coalesce') or {}).get('disk_window', 0)),
+    'max_delay': float((app_config.get('webhook_coalesce') or {}).get('max_delay', 10))
+}
+
+# (lane key, merge key) -> batch that has not started yet
+webhook_batches = {}
+webhook_batch_stats = {'coalesced': 0}
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="NetBox-Proxmox Webhook Listener (asyncio)")
+    parser.add_argument("--host", default='0.0.0.0', help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument("--debug", action='store_true', default=False, help="Enable debug (verbose) output")
+
+    return parser.parse_args()
+
+
+def webhook_vm_helper(web_app, proxmox_node):
+    return AsyncNetBoxProxmoxHelperVM(app_config, proxmox_node, web_app['proxmox_api'], web_app['netbox_api'], DEBUG)
+
+
+def webhook_lxc_helper(web_app, proxmox_node):
+    return AsyncNetBoxProxmoxHelperLXC(app_config, proxmox_node, web_app['proxmox_api'], web_app['netbox_api'], DEBUG)
+
+
+async def webhook_disk_node(web_app, webhook_event):
+    tcall = AsyncNetBoxProxmoxHelper(app_config, None, web_app['proxmox_api'], web_app['netbox_api'], DEBUG)
+    return await tcall.netbox_get_proxmox_node_from_vm_id(webhook_event.netbox_vm_id)
+
+
+async def migrate_vm(web_app, webhook_event):
+    pxmx_migrate = AsyncNetBoxProxmoxHelperMigrate(app_config, None, web_app['proxmox_api'], web_app['netbox_api'], DEBUG)
+
+    return await pxmx_migrate.migrate_vm(webhook_event.vmid, webhook_event.prechange_node, webhook_event.node)
+
+
+async def update_lxc_config(web_app, webhook_event):
+    tc = webhook_lxc_helper(web_app, webhook_event.node)
+
+    if webhook_event.payload['data']['primary_ip'] and webhook_event.payload['data']['primary_ip']['address']:
+        results = await tc.proxmox_lxc_set_net0(webhook_event.payload)
+
+    if webhook_event.changed('vcpus', 'memory'):
+        results = await tc.proxmox_update_lxc_vpus_and_memory(webhook_event.payload)
+    else:
+        results = (200, {'result': 'No resources to change'})
+
+    return results
+
+
+def webhook_handlers(web_app):
+    # handlers get a WebhookEvent (helpers/webhook_event.py); the helpers take the payload as NetBox sent it
+    async def vm_operation(operation, webhook_event):
+        tc = webhook_vm_helper(web_app, webhook_event.node)
+        return await getattr(tc, operation)(webhook_event.payload)
+
+    async def lxc_operation(operation, webhook_event):
+        tc = webhook_lxc_helper(web_app, webhook_event.node)
+        return await getattr(tc, operation)(webhook_event.payload)
+
+    async def vm_disk_operation(operation, webhook_event):
+        tc = webhook_vm_helper(web_app, await webhook_disk_node(web_app, webhook_event))
+        return await getattr(tc, operation)(webhook_event.payload)
+
+    async def lxc_resize_disk(webhook_event):
+        tc = webhook_lxc_helper(web_app, await webhook_disk_node(web_app, webhook_event))
+        return await tc.proxmox_lxc_resize_disk(webhook_event.payload)
+
+    async def fixed_result(results):
+        return results
+
+    return {
+        'missing-proxmox-node': lambda webhook_event: fixed_result((500, {'result': 'Missing proxmox_node in custom_fields'})),
+        'unknown-status': lambda webhook_event: fixed_result((500, {'result': f"Unknown value {webhook_event.status}"})),
+        'unknown-event': lambda webhook_event: fixed_result((500, {'result': f"Unknown event: {webhook_event.event}"})),
+        'vm-clone': lambda webhook_event: vm_operation('proxmox_clone_vm', webhook_event),
+        'vm-update-config': lambda webhook_event: vm_operation('proxmox_update_vm_config', webhook_event),
+        'vm-delete': lambda webhook_event: vm_operation('proxmox_delete_vm', webhook_event),
+        'vm-start': lambda webhook_event: vm_operation('proxmox_start_vm', webhook_event),
+        'vm-stop': lambda webhook_event: vm_operation('proxmox_stop_vm', webhook_event),
+        'vm-migrate': lambda webhook_event: migrate_vm(web_app, webhook_event),
+        'lxc-create': lambda webhook_event: lxc_operation('proxmox_create_lxc', webhook_event),
+        'lxc-update-config': lambda webhook_event: update_lxc_config(web_app, webhook_event),
+        'lxc-delete': lambda webhook_event: lxc_operation('proxmox_delete_lxc', webhook_event),
+        'lxc-start': lambda webhook_event: lxc_operation('proxmox_start_lxc', webhook_event),
+        'lxc-stop': lambda webhook_event: lxc_operation('proxmox_stop_lxc', webhook_event),
+        'lxc-resize-disk': lxc_resize_disk,
+        'lxc-delete-disk': lambda webhook_event: fixed_result((200, {'result': 'All good'})),
+        'vm-add-disk': lambda webhook_event: vm_disk_operation('proxmox_add_disk', webhook_event),
+        'vm-resize-disk': lambda webhook_event: vm_disk_operation('proxmox_resize_disk', webhook_event),
+        'vm-delete-disk': lambda webhook_event: vm_disk_operation('proxmox_delete_disk', webhook_event),
+        'vm-disk-batch': lambda webhook_event: vm_disk_operation('proxmox_apply_disk_batch', webhook_event)
+    }
+
+
+async def process_webhook(web_app, webhook_event):
+    with netbox_vm_cache.request_scope():
+        results = await web_app['webhook_router'].dispatch_async(webhook_event)
+
+    if DEBUG:
+        print("RAW RESULTS", results)
+
+    return results
+
+
+async def process_webhook_in_lane(web_app, webhook_event):
+    lane_key = webhook_event.lane_key
+
+    if not lane_key:
+        return await process_webhook(web_app, webhook_event)
+
+    coalesce_options = webhook_coalesce_options(webhook_event)
+
+    if coalesce_options:
+        return await process_webhook_batch(web_app, lane_key, webhook_event, *coalesce_options)
+
+    return await run_in_lane(lane_key, lambda: process_webhook(web_app, webhook_event))
+
+
+def webhook_coalesce_options(webhook_event):
+    # disk webhooks for a VM are applied as one batch
+    if webhook_coalesce['disk_window'] and is_batchable_disk_webhook(webhook_event):
+        return 'vm-disks', merge_disk_webhook_events, webhook_coalesce['disk_window']
+
+    # bursts of 'updated' webhooks for a staged VM are folded into the latest desired state
+    if not webhook_coalesce['window']:
+        return None
+
+    if webhook_event.model != 'virtualmachine' or webhook_event.event != 'updated':
+        return None
+
+    if webhook_event.vm_type != 'vm' or webhook_event.status != 'staged':
+        return None
+
+    return 'vm-staged-updated', merge_webhook_updates, webhook_coalesce['window']
+
+
+def merge_webhook_updates(pending_event, incoming_event):
+    # NetBox sends the full object with every webhook, so the newest payload is the desired
+    # state; keep the oldest prechange snapshot so the merged event covers the whole burst
+    merged_json_data = dict(incoming_event.payload)
+
+    if 'snapshots' in pending_event.payload and 'snapshots' in merged_json_data:
+        merged_json_data['snapshots'] = dict(merged_json_data['snapshots'])
+        merged_json_data['snapshots']['prechange'] = pending_event.payload['snapshots'].get('prechange')
+
+    return WebhookEvent.from_json(merged_json_data)
+
+
+def merge_disk_webhook_events(pending_event, incoming_event):
+    return WebhookEvent.from_json(merge_disk_webhooks(pending_event.payload, incoming_event.payload))
+
+
+async def process_webhook_batch(web_app, lane_key, webhook_event, merge_key, merge, window):
+    # like the Flask application's KeyedExecutor merge: a webhook joins the VM's batch with the
+    # same merge key while that batch waits for its lane or its window, and every webhook in it
+    # gets the batch result
+    loop = asyncio.get_running_loop()
+    batch_key = (lane_key, merge_key)
+    batch = webhook_batches.get(batch_key)
+
+    if batch:
+        batch['webhook'] = merge(batch['webhook'], webhook_event)
+        batch['not_before'] = min(loop.time() + window, batch['deadline'])
+        batch['joined'] += 1
+        webhook_batch_stats['coalesced'] += 1
+
+        return await asyncio.shield(batch['future'])
+
+    batch = webhook_batches[batch_key] = {
+        'webhook': webhook_event,
+        'future': loop.create_future(),
+        'not_before': loop.time() + window,
+        'deadline': loop.time() + max(window, webhook_coalesce['max_delay']),
+        'joined': 0
+    }
+
+    async def apply_batch():
+        while batch['not_before'] > loop.time():
+            await asyncio.sleep(batch['not_before'] - loop.time())
+
+        # webhooks from here on start a new batch
+        del webhook_batches[batch_key]
+
+        return await process_webhook(web_app, batch['webhook'])
+
+    try:
+        results = await run_in_lane(lane_key, apply_batch)
+    except BaseException as e:
+        if webhook_batches.get(batch_key) is batch:
+            del webhook_batches[batch_key]
+
+        if isinstance(e, Exception) and batch['joined']:
+            batch['future'].set_exception(e)
+        else:
+            batch['future'].cancel()
+
+        raise
+
+    batch['future'].set_result(results)
+
+    return results
+
+
+async def run_in_lane(lane_key, work):
+    # [lock, number of webhooks holding or waiting for it]
+    if lane_key not in webhook_lane_locks:
+        webhook_lane_locks[lane_key] = [asyncio.Lock(), 0]
+
+    lane = webhook_lane_locks[lane_key]
+    lane[1] += 1
+
+    try:
+        async with lane[0]:
+            return await work()
+    finally:
+        lane[1] -= 1
+
+        if not lane[1]:
+            del webhook_lane_locks[lane_key]
+
+
+async def webhook_status(request):
+    session['version_lastrun'] = VERSION
+    session['status']['requests'] += 1
+    session['status']['last_called'] = datetime.now().isoformat()
+
+    status_info = dict(session, routes=request.app['webhook_router'].get_stats(), lanes={'active': len(webhook_lane_locks), 'queued': sum(lane[1] for lane in webhook_lane_locks.values()), 'coalesced': webhook_batch_stats['coalesced']})
+    status_info['netbox_cache'] = netbox_vm_cache.get_stats()
+    status_info['inventory'] = cluster_inventory.get_stats()
+    status_info['vmids'] = vmid_allocator.get_stats()
+    status_info['warm_pool'] = warm_pool.get_stats()
+    status_info['clones'] = clone_strategy.get_stats()
+    status_info['transport'] = transport.get_stats()
+    status_info['node_routing'] = node_routes.get_stats()
+
+    if webhook_dedupe:
+        status_info['dedupe'] = webhook_dedupe.get_stats()
+
+    logger.info("Status request", extra={'path': request.path_qs, 'remote_addr': request.remote or 'Unknown'})
+
+    return web.json_response(status_info)
+
+
+def webhook_response_body(results):
+    response_body = {'result': results[1]['result']}
+
+    # per-field outcome of VM config updates
+    if 'fields' in results[1]:
+        response_body['fields'] = results[1]['fields']
+
+    # per-disk outcome of disk batches
+    if 'disks' in results[1]:
+        response_body['disks'] = results[1]['disks']
+
+    return response_body
+
+
+async def dedupe_call(method, *args):
+    # with sqlite_path, the dedupe store does blocking SQLite I/O: keep it off the event loop
+    if webhook_dedupe.sqlite_path:
+        return await asyncio.to_thread(method, *args)
+
+    return method(*args)
+
+
+async def webhook_post(request):
+    try:
+        webhook_json_data = await request.json()
+    except ValueError:
+        webhook_json_data = {}
+
+    payload = WebhookPayload(webhook_json_data, request.content_length)
+    capture_webhook(webhook_capture, payload)
+    log_webhook(logger, payload, payload_sample_rate, payload_max_bytes, remote_addr=request.remote or 'Unknown')
+
+    if not isinstance(webhook_json_data, dict) or "model" not in webhook_json_data or "event" not in webhook_json_data:
+        return web.json_response({"result": "invalid input"}, status=400)
+
+    if not isinstance(webhook_json_data.get('data'), dict):
+        return web.json_response({"result": "invalid input"}, status=400)
+
+    netbox_vm_cache.invalidate_from_webhook(webhook_json_data)
+
+    # parsed once; everything after this works on the event
+    try:
+        webhook_event = WebhookEvent.from_json(webhook_json_data)
+    except (TypeError, ValueError):
+        # e.g. a proxmox_vmid that is not a number
+        return web.json_response({"result": "invalid input"}, status=400)
+
+    dedupe_key = webhook_event.dedupe_key if webhook_dedupe else None
+
+    if dedupe_key:
+        is_new_delivery, dedupe_entry = await dedupe_call(webhook_dedupe.begin, dedupe_key)
+
+        if not is_new_delivery:
+            if dedupe_entry['state'] == DEDUPE_STATE_DONE:
+                return web.json_response(webhook_response_body(dedupe_entry['results']), status=dedupe_entry['results'][0])
+
+            # not a 2xx: NetBox has to keep retrying in case the first delivery fails
+            return web.json_response({'result': 'in progress', 'request_id': webhook_event.request_id}, status=409, headers={'Retry-After': str(IN_PROGRESS_RETRY_AFTER)})
+
+    webhooks_in_flight.inc()
+
+    try:
+        results = await process_webhook_in_lane(request.app, webhook_event)
+    except Exception:
+        if dedupe_key:
+            await dedupe_call(webhook_dedupe.release, dedupe_key)
+
+        raise
+    finally:
+        webhooks_in_flight.dec()
+
+    if dedupe_key:
+        await dedupe_call(webhook_dedupe.complete, dedupe_key, results)
+
+    return web.json_response(webhook_response_body(results), status=results[0])
+
+
+async def webhook_metrics(request):
+    return web.Response(body=metrics_output(), headers={'Content-Type': METRICS_CONTENT_TYPE})
+
+
+async def on_startup(web_app):
+    pool_maxsize = (app_config.get('client_pool') or {}).get('pool_maxsize', 100)
+
+    web_app['http_session'] = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=pool_maxsize))
+    web_app['proxmox_api'] = AsyncProxmoxAPI(app_config['proxmox_api_config'], web_app['http_session'])
+    web_app['netbox_api'] = AsyncNetBoxAPI(app_config['netbox_api_config'], web_app['http_session'])
+
+    if cluster_inventory.enabled:
+        web_app['inventory_refresh'] = asyncio.ensure_future(cluster_inventory.run_async(lambda: web_app['proxmox_api'].get('cluster/resources', type='vm')))
+
+    if warm_pool.enabled:
+        web_app['warm_pool_refill'] = asyncio.ensure_future(warm_pool.run_async(webhook_vm_helper(web_app, None)))
+
+    session['server_start'] = datetime.now().isoformat()
+
+
+async def on_cleanup(web_app):
+    if 'inventory_refresh' in web_app:
+        web_app['inventory_refresh'].cancel()
+
+    if 'warm_pool_refill' in web_app:
+        web_app['warm_pool_refill'].cancel()
+
+    await web_app['http_session'].close()
+
+
+def create_app():
+    web_app = web.Application()
+
+    web_app['webhook_router'] = WebhookRouter(webhook_handlers(web_app))
+
+    web_app.router.add_get(f"/{app_config['netbox_webhook_name']}/status/", webhook_status)
+    web_app.router.add_post(f"/{app_config['netbox_webhook_name']}/", webhook_post)
+    web_app.router.add_get("/metrics", webhook_metrics)
+
+    web_app.on_startup.append(on_startup)
+    web_app.on_cleanup.append(on_cleanup)
+
+    return web_app
+
+
+if __name__ == "__main__":
+    args = get_arguments()
+
+    DEBUG = args.debug
+
+    web.run_app(create_app(), host=args.host, port=args.port)
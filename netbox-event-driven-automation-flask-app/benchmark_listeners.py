@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import aiohttp
+import copy
+import json
+import math
+import time
+import uuid
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Replay the same NetBox webhook payloads against one or more running listeners and compare them")
+    parser.add_argument("--payloads", required=True, help="JSONL file with one NetBox webhook payload per line")
+    parser.add_argument("--url", required=True, action='append', help="Listener webhook URL, optionally as name=url (repeat to compare listeners)")
+    parser.add_argument("--concurrency", type=int, default=10, help="Number of webhooks in flight at once")
+    parser.add_argument("--repeat", type=int, default=1, help="Replay the payload file this many times")
+    parser.add_argument("--timeout", type=float, default=900, help="Per-request timeout in seconds")
+    parser.add_argument("--keep-request-ids", action='store_true', default=False, help="Do not give each replayed webhook a fresh request_id")
+
+    return parser.parse_args()
+
+
+def load_records(payloads_file):
+    # returns [(received, payload)]; received is None for bare payloads
+    records = []
+
+    with open(payloads_file) as payloads_jsonl:
+        for line in payloads_jsonl:
+            line = line.strip()
+
+            if not line:
+                continue
+
+            payload = json.loads(line)
+            received = None
+
+            # accept captured records ({"received": ..., "payload": {...}}) as well as bare payloads
+            if 'payload' in payload and 'model' not in payload:
+                received = payload.get('received')
+                payload = payload['payload']
+
+            records.append((received, payload))
+
+    return records
+
+
+def load_payloads(payloads_file):
+    return [payload for _, payload in load_records(payloads_file)]
+
+
+def is_error_response(status, body):
+    # the Flask listener answers 200 with the operation status code as body
+    body = body.strip()
+
+    return status >= 400 or body.isdigit() and int(body) >= 400
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, math.ceil(pct / 100 * len(values)) - 1))
+
+    return values[index]
+
+
+async def replay(url, payloads, concurrency, timeout, keep_request_ids):
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as http_session:
+        async def send(payload):
+            nonlocal errors
+
+            if not keep_request_ids:
+                payload = copy.copy(payload)
+                payload['request_id'] = str(uuid.uuid4())
+
+            async with semaphore:
+                start_time = time.perf_counter()
+
+                try:
+                    async with http_session.post(url, json=payload) as resp:
+                        body = await resp.text()
+
+                        if is_error_response(resp.status, body):
+                            errors += 1
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    errors += 1
+
+                latencies.append(time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        await asyncio.gather(*(send(payload) for payload in payloads))
+        elapsed = time.perf_counter() - start_time
+
+    return {
+        'requests': len(payloads),
+        'errors': errors,
+        'elapsed': elapsed,
+        'throughput': len(payloads) / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99)
+    }
+
+
+def main():
+    args = get_arguments()
+
+    payloads = load_payloads(args.payloads) * args.repeat
+
+    if not payloads:
+        raise ValueError(f"No payloads found in {args.payloads}")
+
+    print(f"{'listener':<24} {'requests':>8} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+
+    for listener in args.url:
+        name, url = listener.split('=', 1) if '=' in listener and not listener.startswith('http') else (listener, listener)
+
+        stats = asyncio.run(replay(url, payloads, args.concurrency, args.timeout, args.keep_request_ids))
+
+        print(f"{name[:24]:<24} {stats['requests']:>8} {stats['errors']:>7} {stats['throughput']:>9.1f} {stats['p50'] * 1000:>9.1f} {stats['p95'] * 1000:>9.1f} {stats['p99'] * 1000:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
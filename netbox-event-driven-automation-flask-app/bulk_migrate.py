@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import sys
+import time
+import yaml
+
+from helpers.bulk_migration import BulkMigration, plan_bulk_migration, DEFAULT_MAX_PER_SOURCE, DEFAULT_MAX_PER_TARGET, DEFAULT_MIGRATION_TIMEOUT, MIGRATION_STATE_DONE
+from helpers.netbox_proxmox import NetBoxProxmoxHelper
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Migrate many Proxmox guests at once (e.g. drain a node for maintenance), a few at a time per node")
+
+    guests = parser.add_mutually_exclusive_group(required=True)
+    guests.add_argument("--source-node", help="Migrate every guest (except templates) off this node")
+    guests.add_argument("--vmids", help="Comma-separated vmids to migrate")
+
+    parser.add_argument("--target-nodes", help="Comma-separated nodes to migrate to (default: every other online node)")
+    parser.add_argument("--max-per-source", type=int, help=f"Concurrent migrations leaving any one node (default: {DEFAULT_MAX_PER_SOURCE})")
+    parser.add_argument("--max-per-target", type=int, help=f"Concurrent migrations arriving at any one node (default: {DEFAULT_MAX_PER_TARGET})")
+    parser.add_argument("--bwlimit", type=int, help="Migration bandwidth limit per guest, in KiB/s (default: Proxmox's datacenter setting)")
+    parser.add_argument("--timeout", type=float, help=f"Seconds to wait for a single migration (default: {DEFAULT_MIGRATION_TIMEOUT})")
+    parser.add_argument("--config", default='app_config.yml', help="Listener configuration with proxmox_api_config (default: app_config.yml)")
+    parser.add_argument("--dry-run", action='store_true', default=False, help="Only show which guests would be migrated")
+    parser.add_argument("--json", action='store_true', default=False, help="Print progress events as JSON lines")
+
+    return parser.parse_args()
+
+
+def print_event(event, use_json):
+    if use_json:
+        print(json.dumps(event), flush=True)
+        return
+
+    target = event['target'] or '?'
+    line = f"{event['vmid']:>6} {str(event['name'] or ''):<24} {event['source']} -> {target:<10} {event['state']}"
+
+    if event['seconds'] is not None:
+        line += f" ({event['seconds']:.1f} s)"
+
+    if event['error']:
+        line += f": {event['error']}"
+
+    print(line, flush=True)
+
+
+def main():
+    args = get_arguments()
+
+    with open(args.config) as yaml_cfg:
+        app_config = yaml.safe_load(yaml_cfg)
+
+    bulk_migration_config = app_config.get('bulk_migration') or {}
+
+    helper = NetBoxProxmoxHelper(app_config, None)
+    proxmox_api = helper.proxmox_api
+
+    guests, target_nodes = plan_bulk_migration(
+        proxmox_api,
+        source_node=args.source_node,
+        vmids=[int(vmid) for vmid in args.vmids.split(',') if vmid.strip()] if args.vmids else None,
+        target_nodes=[node.strip() for node in args.target_nodes.split(',') if node.strip()] if args.target_nodes else None
+    )
+
+    if args.dry_run:
+        for guest in guests:
+            print(f"{guest.vmid:>6} {str(guest.name or ''):<24} {guest.guest_type:<5} {guest.source} ({'running' if guest.online else 'stopped'})")
+
+        print(f"{len(guests)} guest(s), target node(s): {', '.join(target_nodes)}")
+        return
+
+    bulk_migration = BulkMigration(
+        proxmox_api,
+        guests,
+        target_nodes,
+        max_per_source=args.max_per_source or bulk_migration_config.get('max_per_source', DEFAULT_MAX_PER_SOURCE),
+        max_per_target=args.max_per_target or bulk_migration_config.get('max_per_target', DEFAULT_MAX_PER_TARGET),
+        bwlimit=args.bwlimit or bulk_migration_config.get('bwlimit'),
+        timeout=args.timeout or bulk_migration_config.get('timeout', DEFAULT_MIGRATION_TIMEOUT),
+        on_progress=lambda event: print_event(event, args.json),
+        netbox_api=helper.netbox_api
+    )
+
+    start_time = time.monotonic()
+    bulk_migration.start()
+
+    try:
+        while not bulk_migration.wait(1):
+            pass
+    except KeyboardInterrupt:
+        print("Cancelling: queued guests will not be migrated, waiting for running migrations to finish", file=sys.stderr, flush=True)
+        bulk_migration.cancel()
+        bulk_migration.wait()
+
+    summary = bulk_migration.to_dict(include_guests=False)
+    summary['elapsed'] = round(time.monotonic() - start_time, 3)
+
+    if args.json:
+        print(json.dumps(summary), flush=True)
+    else:
+        print(f"{', '.join(f'{state}: {count}' for state, count in sorted(summary['states'].items()))} in {summary['elapsed']:.1f} s")
+
+    sys.exit(0 if summary['states'].get(MIGRATION_STATE_DONE, 0) == len(guests) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import signal
+
+from helpers.fake_proxmox import FakeProxmoxCluster, FakeProxmoxServer
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Fake Proxmox VE API for load-testing the webhook listener without a cluster")
+    parser.add_argument("--host", default='127.0.0.1', help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8006, help="Port to listen on (plain HTTP; set api_proto: http in proxmox_api_config)")
+    parser.add_argument("--nodes", default='pve1,pve2,pve3', help="Comma-separated Proxmox node names")
+    parser.add_argument("--node-addresses", default='', help="Comma-separated node=address pairs for cluster/status (default: --host)")
+    parser.add_argument("--templates", default='9000', help="Comma-separated VM template IDs to create on the first node")
+    parser.add_argument("--vms", type=int, default=0, help="Number of existing VMs to create, spread over the nodes")
+    parser.add_argument("--task-duration", type=float, default=0.5, help="Seconds that a Proxmox task takes to finish")
+    parser.add_argument("--task-duration-jitter", type=float, default=0.5, help="Task durations vary by up to this fraction")
+    parser.add_argument("--task-failure-rate", type=float, default=0.0, help="Fraction of tasks that finish with an error")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of API calls that fail with HTTP 500")
+    parser.add_argument("--error-status", type=int, default=500, help="HTTP status of the failed API calls (e.g. 503)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every API call")
+    parser.add_argument("--seed", type=int, help="Random seed, for repeatable runs")
+    parser.add_argument("--verbose", action='store_true', default=False, help="Log every API call")
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_arguments()
+
+    nodes = [node.strip() for node in args.nodes.split(',') if node.strip()]
+    node_addresses = {node: args.host for node in nodes}
+    node_addresses.update(pair.strip().split('=', 1) for pair in args.node_addresses.split(',') if '=' in pair)
+
+    cluster = FakeProxmoxCluster(
+        nodes=nodes,
+        task_duration=args.task_duration,
+        task_duration_jitter=args.task_duration_jitter,
+        task_failure_rate=args.task_failure_rate,
+        templates=[int(template) for template in args.templates.split(',') if template.strip()],
+        node_addresses=node_addresses,
+        seed=args.seed
+    )
+
+    for vm_num in range(args.vms):
+        cluster.add_guest(1000 + vm_num, f"fake-vm-{vm_num}", nodes[vm_num % len(nodes)], status='running')
+
+    server = FakeProxmoxServer(cluster, host=args.host, port=args.port, latency=args.latency, error_rate=args.error_rate, error_status=args.error_status, verbose=args.verbose, seed=args.seed)
+
+    print(f"Fake Proxmox VE API listening on http://{args.host}:{server.port}/api2/json (nodes: {', '.join(nodes)})")
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.get_stats(), indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# gunicorn settings for netbox-event-driven-automation-flask-app
+#
+#   gunicorn -c gunicorn.conf.py app:app
+#
+# Settings are taken from the optional 'server' section of app_config.yml.
+
+import os
+import shutil
+import tempfile
+import yaml
+
+app_config_file = 'app_config.yml'
+
+with open(app_config_file) as yaml_cfg:
+    app_config = yaml.safe_load(yaml_cfg) or {}
+
+server_config = app_config.get('server') or {}
+
+bind = f"{server_config.get('host', '0.0.0.0')}:{server_config.get('port', 8000)}"
+
+# one worker: per-VM ordering, coalescing, in-memory duplicate detection, jobs and bulk
+# migrations are kept per process, so webhooks for one VM must all reach the same process.
+# Webhooks mostly wait on Proxmox, so threads (not processes) give the parallelism
+workers = int(server_config.get('workers', 1))
+threads = int(server_config.get('threads', 32))
+worker_class = 'gthread'
+
+# state that must be shared for several workers to be safe at all: otherwise a NetBox retry
+# that reaches another worker runs again, and two workers can hand out the same vmid
+if workers > 1:
+    shared_state = {
+        'webhook_dedupe': (app_config.get('webhook_dedupe') or {}).get('enabled', True),
+        'vmid_allocator': (app_config.get('vmid_allocator') or {}).get('enabled', True)
+    }
+
+    for section, enabled in shared_state.items():
+        if enabled and not (app_config.get(section) or {}).get('sqlite_path'):
+            raise ValueError(f"server.workers is {workers}: set {section}.sqlite_path in {app_config_file} so that the workers share it, or run one worker")
+
+# load app_config.yml and the application once in the master process, so that the shared
+# /status/ counters are created before the workers are forked
+preload_app = True
+
+# synchronous webhooks are held open until Proxmox has finished (clones, migrations)
+timeout = int(server_config.get('timeout', 900))
+graceful_timeout = int(server_config.get('graceful_timeout', 30))
+keepalive = int(server_config.get('keepalive', 5))
+
+accesslog = server_config.get('accesslog', '-')
+
+# /metrics totals across workers: prometheus_client keeps per-process files in this directory.
+# It has to be set before the application (and prometheus_client) is loaded.
+if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = server_config.get('metrics_dir') or tempfile.mkdtemp(prefix='netbox-proxmox-metrics-')
+
+# start from empty counters on every (re)start. This runs here and not in on_starting, which
+# gunicorn calls after preload_app has loaded the application and opened the master's files
+shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+
+def post_worker_init(worker):
+    # background work that needs Proxmox connections runs in the workers, not in the master
+    from app import start_warm_pool
+
+    start_warm_pool()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
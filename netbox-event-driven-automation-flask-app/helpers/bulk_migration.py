@@ -0,0 +1,429 @@
+import logging
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from helpers.cluster_inventory import cluster_inventory
+from helpers.metrics import time_task_wait
+from helpers.netbox_cache import netbox_vm_cache
+from helpers.task_watcher import task_watchers
+from proxmoxer import ResourceException
+
+
+MIGRATION_STATE_QUEUED = 'queued'
+MIGRATION_STATE_MIGRATING = 'migrating'
+MIGRATION_STATE_DONE = 'done'
+MIGRATION_STATE_FAILED = 'failed'
+MIGRATION_STATE_CANCELLED = 'cancelled'
+
+BULK_STATE_RUNNING = 'running'
+BULK_STATE_FINISHED = 'finished'
+
+DEFAULT_MAX_PER_SOURCE = 2
+DEFAULT_MAX_PER_TARGET = 2
+DEFAULT_MIGRATION_TIMEOUT = 3600
+
+# each progress stream holds a gunicorn thread until its migration has finished
+DEFAULT_MAX_EVENT_STREAMS = 4
+
+
+class GuestMigration:
+    __slots__ = ('vmid', 'name', 'guest_type', 'source', 'target', 'online', 'state', 'upid', 'error', 'started', 'finished')
+
+    def __init__(self, vmid, name, guest_type, source, target=None, online=False):
+        self.vmid = vmid
+        self.name = name
+        self.guest_type = guest_type
+        self.source = source
+        self.target = target
+        self.online = online
+        self.state = MIGRATION_STATE_QUEUED
+        self.upid = None
+        self.error = None
+        self.started = None
+        self.finished = None
+
+
+    def to_dict(self):
+        return {
+            'vmid': self.vmid,
+            'name': self.name,
+            'type': self.guest_type,
+            'source': self.source,
+            'target': self.target,
+            'online': self.online,
+            'state': self.state,
+            'upid': self.upid,
+            'error': self.error,
+            'seconds': round(self.finished - self.started, 3) if self.started and self.finished else None
+        }
+
+
+def plan_bulk_migration(proxmox_api, source_node=None, vmids=None, target_nodes=None):
+    # guests to move (every guest on source_node, or the given vmids) and the nodes they may go to
+    if not source_node and not vmids:
+        raise ValueError("Either a source node or a list of vmids is required")
+
+    online_nodes = [resource['name'] for resource in proxmox_api.cluster.status.get() if resource.get('type') == 'node' and resource.get('online')]
+    resources = [resource for resource in proxmox_api.cluster.resources.get(type='vm') if 'vmid' in resource]
+
+    if vmids:
+        resources_by_vmid = {int(resource['vmid']): resource for resource in resources}
+        unknown_vmids = [vmid for vmid in vmids if int(vmid) not in resources_by_vmid]
+
+        if unknown_vmids:
+            raise ValueError(f"Unknown vmid(s): {', '.join(str(vmid) for vmid in unknown_vmids)}")
+
+        resources = [resources_by_vmid[int(vmid)] for vmid in vmids]
+    else:
+        if source_node not in online_nodes:
+            raise ValueError(f"Proxmox node {source_node} is not an online cluster node")
+
+        resources = sorted((resource for resource in resources if resource.get('node') == source_node and not resource.get('template')), key=lambda resource: int(resource['vmid']))
+
+    source_nodes = {resource['node'] for resource in resources}
+
+    if target_nodes:
+        offline_targets = [node for node in target_nodes if node not in online_nodes]
+
+        if offline_targets:
+            raise ValueError(f"Target node(s) not online: {', '.join(offline_targets)}")
+    else:
+        target_nodes = [node for node in online_nodes if node not in source_nodes]
+
+    if resources and not target_nodes:
+        raise ValueError("No online node to migrate to")
+
+    guests = [
+        GuestMigration(int(resource['vmid']), resource.get('name'), resource['type'], resource['node'], online=resource.get('status') == 'running')
+        for resource in resources
+    ]
+
+    return guests, list(target_nodes)
+
+
+class BulkMigration:
+    # migrates guests with at most max_per_source migrations leaving, and max_per_target
+    # arriving at, any one node. A guest goes to whichever allowed target node has a free
+    # slot and has been given the fewest guests so far. With netbox_api, the guest's NetBox
+    # VM gets its new proxmox_node once it has been migrated.
+    def __init__(self, proxmox_api, guests, target_nodes, max_per_source=DEFAULT_MAX_PER_SOURCE, max_per_target=DEFAULT_MAX_PER_TARGET, bwlimit=None, timeout=DEFAULT_MIGRATION_TIMEOUT, on_progress=None, netbox_api=None):
+        self.id = uuid.uuid4().hex
+        self.proxmox_api = proxmox_api
+        self.netbox_api = netbox_api
+        self.guests = guests
+        self.target_nodes = list(target_nodes)
+        self.max_per_source = max(1, int(max_per_source))
+        self.max_per_target = max(1, int(max_per_target))
+        self.bwlimit = int(bwlimit) if bwlimit else None
+        self.timeout = float(timeout)
+        self.on_progress = on_progress
+
+        self.state = BULK_STATE_RUNNING
+        self.submitted = time.time()
+        self.finished = None
+
+        self._condition = threading.Condition()
+        self._running_from = {}
+        self._running_to = {}
+        self._assigned_to = {node: 0 for node in self.target_nodes}
+        self._cancelled = False
+        self._events = []
+        self._thread = None
+
+
+    def start(self):
+        for guest in self.guests:
+            if not [node for node in self.target_nodes if node != guest.source]:
+                guest.state = MIGRATION_STATE_FAILED
+                guest.error = f"No target node other than {guest.source}"
+
+            self.__event(guest)
+
+        self._thread = threading.Thread(target=self.__run, name=f"bulk-migration-{self.id[:8]}", daemon=True)
+        self._thread.start()
+
+        return self
+
+
+    def cancel(self):
+        # guests that are already migrating are left to finish
+        with self._condition:
+            self._cancelled = True
+            self._condition.notify_all()
+
+
+    def wait(self, timeout=None):
+        if self._thread:
+            self._thread.join(timeout)
+
+        return self.state == BULK_STATE_FINISHED
+
+
+    def __event(self, guest):
+        # progress callbacks run without the condition held, so a slow consumer cannot stall scheduling
+        with self._condition:
+            event = dict(guest.to_dict(), seq=len(self._events) + 1, time=time.time())
+            self._events.append(event)
+            self._condition.notify_all()
+
+        if self.on_progress:
+            try:
+                self.on_progress(event)
+            except Exception:
+                logging.exception(f"Bulk migration {self.id}: progress callback failed")
+
+
+    def __pick_target(self, guest):
+        candidates = [
+            node for node in self.target_nodes
+            if node != guest.source and self._running_to.get(node, 0) < self.max_per_target
+        ]
+
+        if not candidates:
+            return None
+
+        return min(candidates, key=lambda node: (self._assigned_to[node], self.target_nodes.index(node)))
+
+
+    def __next_guest(self):
+        # first queued guest whose source node, and some target node, have a free slot
+        for guest in self.guests:
+            if guest.state != MIGRATION_STATE_QUEUED:
+                continue
+
+            if self._running_from.get(guest.source, 0) >= self.max_per_source:
+                continue
+
+            target = self.__pick_target(guest)
+
+            if target:
+                return guest, target
+
+        return None, None
+
+
+    def __run(self):
+        while True:
+            cancelled_guests = []
+
+            with self._condition:
+                if self._cancelled:
+                    for guest in self.guests:
+                        if guest.state == MIGRATION_STATE_QUEUED:
+                            guest.state = MIGRATION_STATE_CANCELLED
+                            cancelled_guests.append(guest)
+
+                guest, target = self.__next_guest()
+
+                if guest:
+                    guest.target = target
+                    guest.state = MIGRATION_STATE_MIGRATING
+                    guest.started = time.time()
+
+                    self._running_from[guest.source] = self._running_from.get(guest.source, 0) + 1
+                    self._running_to[target] = self._running_to.get(target, 0) + 1
+                    self._assigned_to[target] += 1
+                elif not cancelled_guests:
+                    if not sum(self._running_from.values()) and not any(queued.state == MIGRATION_STATE_QUEUED for queued in self.guests):
+                        break
+
+                    # wait for a migration to finish (or the run to be cancelled)
+                    self._condition.wait(5)
+
+            for cancelled_guest in cancelled_guests:
+                self.__event(cancelled_guest)
+
+            if guest:
+                threading.Thread(target=self.__migrate, args=(guest,), name=f"bulk-migration-{guest.vmid}", daemon=True).start()
+
+        with self._condition:
+            self.state = BULK_STATE_FINISHED
+            self.finished = time.time()
+            self._condition.notify_all()
+
+
+    def __migrate(self, guest):
+        migrate_data = {'target': guest.target}
+
+        if guest.online:
+            # running VMs are live-migrated; running containers are restarted on the target
+            migrate_data['online' if guest.guest_type == 'qemu' else 'restart'] = 1
+
+        if self.bwlimit:
+            migrate_data['bwlimit'] = self.bwlimit
+
+        try:
+            if guest.guest_type == 'qemu':
+                guest.upid = self.proxmox_api.nodes(guest.source).qemu(guest.vmid).migrate.post(**migrate_data)
+            else:
+                guest.upid = self.proxmox_api.nodes(guest.source).lxc(guest.vmid).migrate.post(**migrate_data)
+
+            self.__event(guest)
+
+            with time_task_wait('migration') as task_wait:
+                try:
+                    task_status = task_watchers.wait(self.proxmox_api, guest.source, guest.upid, self.timeout)
+                except FutureTimeoutError:
+                    task_wait['value'] = 'timeout'
+                    raise
+
+                task_wait['value'] = 'ok' if task_status.get('exitstatus') == 'OK' else 'failed'
+
+            if task_status.get('exitstatus') == 'OK':
+                guest.state = MIGRATION_STATE_DONE
+                cluster_inventory.move_guest(guest.vmid, guest.target)
+                self.__update_netbox(guest)
+            else:
+                guest.state = MIGRATION_STATE_FAILED
+                guest.error = f"Task exit status: {task_status.get('exitstatus')}"
+        except FutureTimeoutError:
+            guest.state = MIGRATION_STATE_FAILED
+            guest.error = f"Migration did not finish within {self.timeout:g} seconds"
+        except ResourceException as e:
+            guest.state = MIGRATION_STATE_FAILED
+            guest.error = f"Proxmox API error: {e.content}"
+        except Exception as e:
+            logging.exception(f"Bulk migration {self.id}: migrating {guest.vmid} failed")
+            guest.state = MIGRATION_STATE_FAILED
+            guest.error = str(e)
+
+        guest.finished = time.time()
+
+        # report before freeing the slot, so that the run cannot finish ahead of its last event
+        self.__event(guest)
+
+        with self._condition:
+            self._running_from[guest.source] -= 1
+            self._running_to[guest.target] -= 1
+            self._condition.notify_all()
+
+
+    def __update_netbox(self, guest):
+        # the guest is migrated either way: a failed NetBox update is reported, not fatal
+        if not self.netbox_api:
+            return
+
+        try:
+            for nb_obj in self.netbox_api.virtualization.virtual_machines.filter(cf_proxmox_vmid=guest.vmid):
+                if (nb_obj.custom_fields or {}).get('proxmox_node') != guest.target:
+                    nb_obj.update({'custom_fields': {'proxmox_node': guest.target}})
+                    netbox_vm_cache.invalidate(nb_obj.id)
+        except Exception as e:
+            logging.warning(f"Bulk migration {self.id}: unable to set proxmox_node of {guest.vmid} in NetBox: {e}")
+            guest.error = f"Migrated, but proxmox_node was not updated in NetBox: {e}"
+
+
+    def events(self, since=0, timeout=None):
+        # events after sequence number `since`; waits up to `timeout` seconds for new ones
+        with self._condition:
+            if timeout and len(self._events) <= since and self.state != BULK_STATE_FINISHED:
+                self._condition.wait(timeout)
+
+            return list(self._events[since:])
+
+
+    def iter_events(self, since=0, keepalive=15):
+        # progress events after `since` until the run has finished; None every `keepalive`
+        # seconds without news, so that a streaming response can keep the connection open
+
+        while True:
+            events = self.events(since, keepalive)
+
+            for event in events:
+                yield event
+
+            since += len(events)
+
+            if self.state == BULK_STATE_FINISHED and since >= len(self._events):
+                return
+
+            if not events:
+                yield None
+
+
+    def to_dict(self, include_guests=True):
+        with self._condition:
+            states = {}
+
+            for guest in self.guests:
+                states[guest.state] = states.get(guest.state, 0) + 1
+
+            bulk_info = {
+                'id': self.id,
+                'state': self.state,
+                'submitted': self.submitted,
+                'finished': self.finished,
+                'target_nodes': self.target_nodes,
+                'max_per_source': self.max_per_source,
+                'max_per_target': self.max_per_target,
+                'bwlimit': self.bwlimit,
+                'guests': len(self.guests),
+                'states': states
+            }
+
+            if include_guests:
+                bulk_info['migrations'] = [guest.to_dict() for guest in self.guests]
+
+            return bulk_info
+
+
+class BulkMigrations:
+    # bulk migrations started by this process, by id
+    def __init__(self, max_finished=100, max_event_streams=DEFAULT_MAX_EVENT_STREAMS):
+        self.max_finished = int(max_finished)
+        self.max_event_streams = int(max_event_streams)
+
+        self._lock = threading.Lock()
+        self._migrations = OrderedDict()
+        self._event_streams = 0
+
+
+    def configure(self, max_event_streams=None):
+        with self._lock:
+            if max_event_streams is not None:
+                self.max_event_streams = int(max_event_streams)
+
+
+    def open_event_stream(self):
+        # False when max_event_streams progress streams are already open
+        with self._lock:
+            if self._event_streams >= self.max_event_streams:
+                return False
+
+            self._event_streams += 1
+            return True
+
+
+    def close_event_stream(self):
+        with self._lock:
+            self._event_streams -= 1
+
+
+    def start(self, bulk_migration):
+        with self._lock:
+            self._migrations[bulk_migration.id] = bulk_migration
+
+            finished = [migration_id for migration_id, migration in self._migrations.items() if migration.state == BULK_STATE_FINISHED]
+
+            for migration_id in finished[:max(0, len(finished) - self.max_finished)]:
+                del self._migrations[migration_id]
+
+        return bulk_migration.start()
+
+
+    def get(self, migration_id):
+        with self._lock:
+            return self._migrations.get(migration_id)
+
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'running': sum(1 for migration in self._migrations.values() if migration.state == BULK_STATE_RUNNING),
+                'finished': sum(1 for migration in self._migrations.values() if migration.state == BULK_STATE_FINISHED),
+                'event_streams': self._event_streams,
+                'max_event_streams': self.max_event_streams
+            }
@@ -0,0 +1,160 @@
+import hashlib
+import os
+import pynetbox
+import requests
+import threading
+
+from helpers.metrics import instrument_session
+from helpers.node_routing import node_routes
+from helpers.transport import transport, ResilientHTTPAdapter
+from proxmoxer import ProxmoxAPI
+
+
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 20
+
+
+class ClientRegistry:
+    def __init__(self, pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._proxmox_clients = {}
+        self._netbox_clients = {}
+
+        self.stats = {
+            'proxmox': {'created': 0, 'reused': 0},
+            'netbox': {'created': 0, 'reused': 0}
+        }
+
+
+    def configure(self, pool_connections=None, pool_maxsize=None):
+        with self._lock:
+            if pool_connections:
+                self.pool_connections = int(pool_connections)
+
+            if pool_maxsize:
+                self.pool_maxsize = int(pool_maxsize)
+
+
+    def __check_pid(self):
+        # a forked process (gunicorn worker) must not use the connections of its parent: start
+        # with new clients. Called with the lock held
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._proxmox_clients = {}
+            self._netbox_clients = {}
+
+
+    def __secret_digest(self, secret):
+        return hashlib.sha256(str(secret).encode('utf-8')).hexdigest()
+
+
+    def __mount_pooled_adapter(self, session, backend, **kwargs):
+        # timeouts, retries and circuit breakers come from helpers/transport.py
+        adapter = ResilientHTTPAdapter(backend, transport, pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize, **kwargs)
+
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers['Connection'] = 'keep-alive'
+
+
+    def proxmox_client_key(self, proxmox_api_config):
+        return (
+            proxmox_api_config.get('api_proto', 'https'),
+            proxmox_api_config['api_host'],
+            int(proxmox_api_config['api_port']),
+            proxmox_api_config['api_user'],
+            proxmox_api_config['api_token_id'],
+            self.__secret_digest(proxmox_api_config['api_token_secret'])
+        )
+
+
+    def netbox_client_key(self, netbox_api_config):
+        return (
+            netbox_api_config['api_proto'],
+            netbox_api_config['api_host'],
+            int(netbox_api_config['api_port']),
+            self.__secret_digest(netbox_api_config['api_token']),
+            bool(netbox_api_config['verify_ssl'])
+        )
+
+
+    def get_proxmox_api(self, proxmox_api_config):
+        key = self.proxmox_client_key(proxmox_api_config)
+
+        with self._lock:
+            self.__check_pid()
+
+            if key in self._proxmox_clients:
+                self.stats['proxmox']['reused'] += 1
+                return self._proxmox_clients[key]
+
+            proxmox_api = ProxmoxAPI(
+                proxmox_api_config['api_host'],
+                port=proxmox_api_config['api_port'],
+                user=proxmox_api_config['api_user'],
+                token_name=proxmox_api_config['api_token_id'],
+                token_value=proxmox_api_config['api_token_secret'],
+                verify_ssl=False
+            )
+
+            # proxmoxer always builds an https:// URL; api_proto: http is for fake_proxmox_server.py
+            if proxmox_api_config.get('api_proto', 'https') == 'http':
+                proxmox_api._store['base_url'] = proxmox_api._store['base_url'].replace('https://', 'http://', 1)
+
+            # proxmoxer keeps its requests session in the resource store; node-scoped calls
+            # can go straight to the node (helpers/node_routing.py)
+            self.__mount_pooled_adapter(proxmox_api._store['session'], 'proxmox', node_routes=node_routes, load_node_addresses=proxmox_api.cluster.status.get)
+            instrument_session(proxmox_api._store['session'], 'proxmox')
+
+            self._proxmox_clients[key] = proxmox_api
+            self.stats['proxmox']['created'] += 1
+
+            return proxmox_api
+
+
+    def get_netbox_api(self, netbox_api_config):
+        key = self.netbox_client_key(netbox_api_config)
+
+        with self._lock:
+            self.__check_pid()
+
+            if key in self._netbox_clients:
+                self.stats['netbox']['reused'] += 1
+                return self._netbox_clients[key]
+
+            nb_url = f"{netbox_api_config['api_proto']}://{netbox_api_config['api_host']}:{netbox_api_config['api_port']}"
+
+            netbox_api = pynetbox.api(
+                nb_url,
+                token=netbox_api_config['api_token']
+            )
+
+            http_session = requests.Session()
+            self.__mount_pooled_adapter(http_session, 'netbox')
+            http_session.verify = netbox_api_config['verify_ssl']
+            instrument_session(http_session, 'netbox')
+
+            netbox_api.http_session = http_session
+
+            self._netbox_clients[key] = netbox_api
+            self.stats['netbox']['created'] += 1
+
+            return netbox_api
+
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'pool_connections': self.pool_connections,
+                'pool_maxsize': self.pool_maxsize,
+                'proxmox': dict(self.stats['proxmox']),
+                'netbox': dict(self.stats['netbox'])
+            }
+
+
+# process-wide registry shared by all helper instances
+client_registry = ClientRegistry()
@@ -0,0 +1,215 @@
+import re
+import threading
+import time
+
+
+STRATEGY_FULL = 'full'
+STRATEGY_LINKED = 'linked'
+STRATEGY_FULL_LOCAL = 'full-local'
+
+CLONE_STRATEGIES = (STRATEGY_FULL, STRATEGY_LINKED, STRATEGY_FULL_LOCAL)
+
+# storage types whose volumes can be the base of linked clones
+DEFAULT_LINKED_STORAGE_TYPES = ('zfspool', 'lvmthin', 'rbd')
+
+# templates and storage definitions rarely change
+DEFAULT_CACHE_TTL = 300
+
+DISK_KEY = re.compile(r'^(scsi|virtio|sata|ide|efidisk|tpmstate)\d+$')
+
+
+def template_disk_storages(template_config):
+    # storage ids of the template's disks (CD-ROMs and empty drives do not count)
+    storages = set()
+
+    for key, value in template_config.items():
+        if not DISK_KEY.match(key) or 'media=cdrom' in str(value) or ':' not in str(value):
+            continue
+
+        storages.add(str(value).split(':', 1)[0])
+
+    return storages
+
+
+class ClonePlan:
+    __slots__ = ('strategy', 'requested', 'source_node', 'storage', 'reason')
+
+    def __init__(self, strategy, requested, source_node, storage=None, reason=None):
+        self.strategy = strategy
+        self.requested = requested
+        self.source_node = source_node
+        self.storage = storage
+        self.reason = reason
+
+
+    def clone_args(self):
+        # linked clones stay on the template's storage
+        if self.strategy == STRATEGY_LINKED:
+            return {'full': 0}
+
+        return {'full': 1, 'storage': self.storage}
+
+
+    def to_dict(self):
+        return {
+            'strategy': self.strategy,
+            'requested': self.requested,
+            'source_node': self.source_node,
+            'storage': self.storage,
+            'reason': self.reason
+        }
+
+
+class CloneStrategy:
+    # decides per clone between a full clone to proxmox_vm_storage, a linked clone (on the
+    # template's storage, when it supports them) and a full clone to node-local storage.
+    # The policy is looked up by template vmid, then by NetBox tag, then the default.
+    def __init__(self, default=STRATEGY_FULL, templates=None, tags=None, local_storage=None, linked_storage_types=DEFAULT_LINKED_STORAGE_TYPES, cache_ttl=DEFAULT_CACHE_TTL):
+        self.default = default
+        self.templates = {}
+        self.tags = {}
+        self.local_storage = local_storage
+        self.linked_storage_types = tuple(linked_storage_types)
+        self.cache_ttl = float(cache_ttl)
+
+        self._lock = threading.Lock()
+        self._cache = {}
+
+        self.stats = {strategy: 0 for strategy in CLONE_STRATEGIES}
+        self.stats['fallbacks'] = 0
+
+        self.configure(templates=templates, tags=tags)
+
+
+    def configure(self, default=None, templates=None, tags=None, local_storage=None, linked_storage_types=None, cache_ttl=None):
+        with self._lock:
+            if default:
+                self.default = self.__strategy(default)
+
+            if templates is not None:
+                self.templates = {int(template): self.__strategy(strategy) for template, strategy in templates.items()}
+
+            if tags is not None:
+                self.tags = {str(tag): self.__strategy(strategy) for tag, strategy in tags.items()}
+
+            if local_storage:
+                self.local_storage = local_storage
+
+            if linked_storage_types:
+                self.linked_storage_types = tuple(linked_storage_types)
+
+            if cache_ttl is not None:
+                self.cache_ttl = float(cache_ttl)
+
+            self._cache = {}
+
+
+    def __strategy(self, strategy):
+        if strategy not in CLONE_STRATEGIES:
+            raise ValueError(f"Unknown clone strategy '{strategy}' (expected one of: {', '.join(CLONE_STRATEGIES)})")
+
+        return strategy
+
+
+    def requested_strategy(self, template, vm_tags=None):
+        # vm_tags are NetBox tags ({'name': ..., 'slug': ...}) or plain names
+        if int(template) in self.templates:
+            return self.templates[int(template)]
+
+        tag_names = set()
+
+        for tag in vm_tags or []:
+            if isinstance(tag, dict):
+                tag_names.update(str(tag.get(key)) for key in ('slug', 'name') if tag.get(key))
+            else:
+                tag_names.add(str(tag))
+
+        for tag, strategy in self.tags.items():
+            if tag in tag_names:
+                return strategy
+
+        return self.default
+
+
+    def cached(self, key, load):
+        # load() for template configs and storage definitions, kept for cache_ttl seconds
+        now = time.monotonic()
+
+        with self._lock:
+            if key in self._cache and self._cache[key][0] > now:
+                return self._cache[key][1]
+
+        value = load()
+
+        with self._lock:
+            self._cache[key] = (now + self.cache_ttl, value)
+
+        return value
+
+
+    async def cached_async(self, key, load):
+        now = time.monotonic()
+
+        with self._lock:
+            if key in self._cache and self._cache[key][0] > now:
+                return self._cache[key][1]
+
+        value = await load()
+
+        with self._lock:
+            self._cache[key] = (now + self.cache_ttl, value)
+
+        return value
+
+
+    def plan(self, requested, template_config, storage_configs, source_node, target_node, storage):
+        # storage_configs: storage id -> storage/{storage} of the template's disks
+        if requested == STRATEGY_LINKED:
+            reason = None
+
+            if not template_config.get('template'):
+                reason = "source is not a template"
+            elif not storage_configs:
+                reason = "template has no disks"
+            elif any(storage_config.get('type') not in self.linked_storage_types for storage_config in storage_configs.values()):
+                storage_types = ', '.join(f"{storage_id} ({storage_config.get('type')})" for storage_id, storage_config in sorted(storage_configs.items()))
+                reason = f"template storage does not support linked clones: {storage_types}"
+            elif source_node != target_node and not all(storage_config.get('shared') for storage_config in storage_configs.values()):
+                reason = f"template storage is local to {source_node}"
+
+            if not reason:
+                return self.__planned(ClonePlan(STRATEGY_LINKED, requested, source_node))
+
+            return self.__planned(ClonePlan(STRATEGY_FULL, requested, source_node, storage, reason))
+
+        if requested == STRATEGY_FULL_LOCAL:
+            if self.local_storage:
+                return self.__planned(ClonePlan(STRATEGY_FULL_LOCAL, requested, source_node, self.local_storage))
+
+            return self.__planned(ClonePlan(STRATEGY_FULL, requested, source_node, storage, "no local_storage configured"))
+
+        return self.__planned(ClonePlan(STRATEGY_FULL, requested, source_node, storage))
+
+
+    def __planned(self, clone_plan):
+        with self._lock:
+            self.stats[clone_plan.strategy] += 1
+
+            if clone_plan.strategy != clone_plan.requested:
+                self.stats['fallbacks'] += 1
+
+        return clone_plan
+
+
+    def get_stats(self):
+        with self._lock:
+            return dict(
+                self.stats,
+                default=self.default,
+                templates=len(self.templates),
+                tags=len(self.tags)
+            )
+
+
+# process-wide policy shared by all helper instances
+clone_strategy = CloneStrategy()
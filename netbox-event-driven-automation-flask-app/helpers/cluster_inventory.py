@@ -0,0 +1,286 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+
+
+DEFAULT_REFRESH_INTERVAL = 60
+
+
+class ClusterInventory:
+    # name -> vmid and vmid -> node/type for every guest in the Proxmox cluster, built from
+    # one cluster/resources?type=vm call and refreshed in the background. Our own creates,
+    # deletes and migrations update it in place, so that lookups do not have to wait for a refresh.
+    def __init__(self, refresh_interval=DEFAULT_REFRESH_INTERVAL, max_age=None, enabled=True):
+        self.enabled = enabled
+        self.refresh_interval = float(refresh_interval)
+        self.max_age = float(max_age) if max_age else 3 * self.refresh_interval
+
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._async_refresh_lock = None
+        self._guests = {}
+        self._names = {}
+        self._loaded = None
+        self._journals = []
+
+        self._load = None
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+
+        self.stats = {
+            'lookups': 0,
+            'refreshes': 0,
+            'refresh_errors': 0,
+            'last_refresh_seconds': 0.0,
+            'updates': 0
+        }
+
+
+    def configure(self, refresh_interval=None, max_age=None, enabled=None):
+        with self._lock:
+            if enabled is not None:
+                self.enabled = bool(enabled)
+
+            if refresh_interval:
+                self.refresh_interval = float(refresh_interval)
+
+            self.max_age = float(max_age) if max_age else 3 * self.refresh_interval
+
+
+    def __index(self, guests, names, change):
+        action, guest = change
+
+        if action in ('remove', 'move', 'add') and guest['vmid'] in guests:
+            old_guest = guests[guest['vmid']]
+
+            if old_guest['name'] in names:
+                names[old_guest['name']].discard(old_guest['vmid'])
+
+                if not names[old_guest['name']]:
+                    del names[old_guest['name']]
+
+        if action == 'remove':
+            guests.pop(guest['vmid'], None)
+            return
+
+        if action == 'move':
+            if guest['vmid'] not in guests:
+                return
+
+            guest = dict(guests[guest['vmid']], node=guest['node'])
+
+        guests[guest['vmid']] = guest
+
+        # templates cannot be cloned over, so they are not found by name
+        if guest['name'] and not guest['template']:
+            names.setdefault(guest['name'], set()).add(guest['vmid'])
+
+
+    def __apply(self, action, guest):
+        with self._lock:
+            self.stats['updates'] += 1
+            self.__index(self._guests, self._names, (action, guest))
+
+            # a refresh that is running may have read the cluster before this change
+            for journal in self._journals:
+                journal.append((action, guest))
+
+
+    def __install(self, resources, journal, seconds):
+        guests = {}
+        names = {}
+
+        for resource in resources or []:
+            if 'vmid' not in resource:
+                continue
+
+            self.__index(guests, names, ('add', {
+                'vmid': int(resource['vmid']),
+                'name': resource.get('name'),
+                'node': resource.get('node'),
+                'type': resource.get('type'),
+                'template': bool(resource.get('template')),
+                'status': resource.get('status')
+            }))
+
+        with self._lock:
+            for change in journal:
+                self.__index(guests, names, change)
+
+            self._journals.remove(journal)
+            self._guests = guests
+            self._names = names
+            self._loaded = time.monotonic()
+
+            self.stats['refreshes'] += 1
+            self.stats['last_refresh_seconds'] = seconds
+
+
+    def __begin_refresh(self):
+        journal = []
+
+        with self._lock:
+            self._journals.append(journal)
+
+        return journal, time.monotonic()
+
+
+    def __refresh_failed(self, journal):
+        with self._lock:
+            self._journals.remove(journal)
+            self.stats['refresh_errors'] += 1
+
+
+    def is_fresh(self):
+        return self._loaded is not None and time.monotonic() - self._loaded < self.max_age
+
+
+    def refresh(self, load):
+        # load() returns cluster/resources?type=vm
+        journal, start_time = self.__begin_refresh()
+
+        try:
+            resources = load()
+        except Exception:
+            self.__refresh_failed(journal)
+            raise
+
+        self.__install(resources, journal, time.monotonic() - start_time)
+
+
+    async def refresh_async(self, load):
+        journal, start_time = self.__begin_refresh()
+
+        try:
+            resources = await load()
+        except Exception:
+            self.__refresh_failed(journal)
+            raise
+
+        self.__install(resources, journal, time.monotonic() - start_time)
+
+
+    def ensure(self, load):
+        # load the index (once, however many webhooks ask at the same time) and keep it fresh
+        if self._pid != os.getpid():
+            self.start(load)
+
+        if not self.is_fresh():
+            with self._refresh_lock:
+                if not self.is_fresh():
+                    self.refresh(load)
+
+
+    async def ensure_async(self, load):
+        if not self.is_fresh():
+            if self._async_refresh_lock is None:
+                self._async_refresh_lock = asyncio.Lock()
+
+            async with self._async_refresh_lock:
+                if not self.is_fresh():
+                    await self.refresh_async(load)
+
+
+    def start(self, load):
+        # threads do not survive a fork (gunicorn preload_app); start one in every process
+        with self._lock:
+            if self._thread and self._pid == os.getpid():
+                return
+
+            self._load = load
+            self._pid = os.getpid()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self.__run, name='cluster-inventory-refresh', daemon=True)
+            self._thread.start()
+
+
+    def stop(self):
+        self._stop.set()
+
+
+    def __run(self):
+        while not self._stop.wait(self.refresh_interval):
+            try:
+                self.refresh(self._load)
+            except Exception as e:
+                logging.warning(f"Unable to refresh Proxmox cluster inventory: {e}")
+
+
+    async def run_async(self, load):
+        # for the asyncio listener: refresh on the event loop instead of a thread
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+
+            try:
+                await self.refresh_async(load)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"Unable to refresh Proxmox cluster inventory: {e}")
+
+
+    def get_vmid(self, name, guest_type=None):
+        # guest_type is 'qemu' or 'lxc'; with several guests of the same name, the lowest vmid
+        with self._lock:
+            self.stats['lookups'] += 1
+
+            vmids = [vmid for vmid in self._names.get(name, ()) if guest_type is None or self._guests[vmid]['type'] == guest_type]
+
+            return min(vmids) if vmids else None
+
+
+    def get_guest(self, vmid):
+        with self._lock:
+            self.stats['lookups'] += 1
+
+            guest = self._guests.get(int(vmid))
+
+            return dict(guest) if guest else None
+
+
+    def get_guests(self, guest_type=None):
+        with self._lock:
+            self.stats['lookups'] += 1
+
+            return [dict(guest) for guest in self._guests.values() if guest_type is None or guest['type'] == guest_type]
+
+
+    def has_vmid(self, vmid):
+        with self._lock:
+            self.stats['lookups'] += 1
+
+            return int(vmid) in self._guests
+
+
+    def has_name(self, name):
+        return self.get_vmid(name) is not None
+
+
+    def add_guest(self, vmid, name, node, guest_type, template=False, status=None):
+        self.__apply('add', {'vmid': int(vmid), 'name': name, 'node': node, 'type': guest_type, 'template': bool(template), 'status': status})
+
+
+    def remove_guest(self, vmid):
+        self.__apply('remove', {'vmid': int(vmid)})
+
+
+    def move_guest(self, vmid, node):
+        self.__apply('move', {'vmid': int(vmid), 'node': node})
+
+
+    def get_stats(self):
+        with self._lock:
+            return dict(
+                self.stats,
+                enabled=self.enabled,
+                refresh_interval=self.refresh_interval,
+                guests=len(self._guests),
+                age=round(time.monotonic() - self._loaded, 3) if self._loaded is not None else None
+            )
+
+
+# process-wide inventory shared by all helper instances
+cluster_inventory = ClusterInventory()
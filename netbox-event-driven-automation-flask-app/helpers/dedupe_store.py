@@ -0,0 +1,199 @@
+import json
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import closing
+
+
+DEDUPE_STATE_IN_PROGRESS = 'in_progress'
+DEDUPE_STATE_DONE = 'done'
+
+# a webhook that is still being handled after this many seconds is assumed lost (its process
+# died), and the next delivery runs it again; keep it above the longest webhook
+DEFAULT_IN_PROGRESS_TTL = 900
+
+# seconds, for the Retry-After header of duplicates that arrive while the first is running
+IN_PROGRESS_RETRY_AFTER = 30
+
+
+def dedupe_key(request_id, model, object_id, event):
+    # NetBox reuses one request_id for every object changed by the same API request,
+    # so the object and event are part of the key
+    if not request_id:
+        return None
+
+    return f"{request_id}:{model}:{object_id}:{event}"
+
+
+def webhook_dedupe_key(webhook_json_data):
+    object_id = None
+
+    if isinstance(webhook_json_data.get('data'), dict):
+        object_id = webhook_json_data['data'].get('id')
+
+    return dedupe_key(webhook_json_data.get('request_id'), webhook_json_data.get('model'), object_id, webhook_json_data.get('event'))
+
+
+class WebhookDedupeStore:
+    def __init__(self, max_entries=10000, ttl=3600, sqlite_path=None, in_progress_ttl=DEFAULT_IN_PROGRESS_TTL):
+        self.max_entries = int(max_entries)
+        self.ttl = float(ttl)
+        self.in_progress_ttl = min(float(in_progress_ttl), self.ttl)
+        self.sqlite_path = sqlite_path
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+        self.stats = {
+            'new': 0,
+            'duplicates': 0,
+            'in_progress_hits': 0,
+            'released': 0,
+            'evicted': 0
+        }
+
+        if self.sqlite_path:
+            with self.__sqlite() as db:
+                db.execute("""
+                    CREATE TABLE IF NOT EXISTS webhook_requests (
+                        dedupe_key TEXT PRIMARY KEY,
+                        state TEXT NOT NULL,
+                        job_id TEXT,
+                        results TEXT,
+                        created REAL NOT NULL
+                    )
+                """)
+
+
+    def __sqlite(self):
+        # short-lived autocommit connections so several listener processes can share the file
+        return closing(sqlite3.connect(self.sqlite_path, timeout=10, isolation_level=None))
+
+
+    def __expired(self, entry):
+        if entry['state'] == DEDUPE_STATE_IN_PROGRESS:
+            return time.time() - entry['created'] > self.in_progress_ttl
+
+        return time.time() - entry['created'] > self.ttl
+
+
+    def __remember(self, dedupe_key, entry):
+        self._entries[dedupe_key] = entry
+        self._entries.move_to_end(dedupe_key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats['evicted'] += 1
+
+
+    def __sqlite_claim(self, dedupe_key, entry):
+        with self.__sqlite() as db:
+            db.execute(
+                "DELETE FROM webhook_requests WHERE created < ? OR (state = ? AND created < ?)",
+                (time.time() - self.ttl, DEDUPE_STATE_IN_PROGRESS, time.time() - self.in_progress_ttl)
+            )
+
+            inserted = db.execute(
+                "INSERT OR IGNORE INTO webhook_requests (dedupe_key, state, job_id, results, created) VALUES (?, ?, ?, ?, ?)",
+                (dedupe_key, entry['state'], entry['job_id'], None, entry['created'])
+            ).rowcount
+
+            if inserted:
+                return None
+
+            row = db.execute("SELECT state, job_id, results, created FROM webhook_requests WHERE dedupe_key = ?", (dedupe_key,)).fetchone()
+
+        if not row:
+            return None
+
+        return {
+            'state': row[0],
+            'job_id': row[1],
+            'results': tuple(json.loads(row[2])) if row[2] else None,
+            'created': row[3]
+        }
+
+
+    def begin(self, dedupe_key):
+        # returns (True, entry) for a first delivery, (False, entry) for a duplicate
+        with self._lock:
+            entry = self._entries.get(dedupe_key)
+
+            if entry and self.__expired(entry):
+                del self._entries[dedupe_key]
+                entry = None
+
+            # with SQLite, the table is authoritative: another listener process may have
+            # finished (or given up on) the work since we last looked
+            if self.sqlite_path and (not entry or entry['state'] == DEDUPE_STATE_IN_PROGRESS):
+                new_entry = {'state': DEDUPE_STATE_IN_PROGRESS, 'job_id': None, 'results': None, 'created': time.time()}
+                entry = self.__sqlite_claim(dedupe_key, new_entry)
+
+                if not entry:
+                    entry = new_entry
+                    self.__remember(dedupe_key, entry)
+                    self.stats['new'] += 1
+
+                    return True, dict(entry)
+
+                self.__remember(dedupe_key, entry)
+            elif not entry:
+                entry = {'state': DEDUPE_STATE_IN_PROGRESS, 'job_id': None, 'results': None, 'created': time.time()}
+                self.__remember(dedupe_key, entry)
+                self.stats['new'] += 1
+
+                return True, dict(entry)
+
+            self.stats['duplicates'] += 1
+
+            if entry['state'] == DEDUPE_STATE_IN_PROGRESS:
+                self.stats['in_progress_hits'] += 1
+
+            return False, dict(entry)
+
+
+    def attach_job(self, dedupe_key, job_id):
+        with self._lock:
+            if dedupe_key in self._entries:
+                self._entries[dedupe_key]['job_id'] = job_id
+
+            if self.sqlite_path:
+                with self.__sqlite() as db:
+                    db.execute("UPDATE webhook_requests SET job_id = ? WHERE dedupe_key = ?", (job_id, dedupe_key))
+
+
+    def complete(self, dedupe_key, results):
+        # failures are released so that NetBox's retry runs the work again (duplicates that
+        # arrived meanwhile were answered with 409, so NetBox keeps retrying those too)
+        if not results or results[0] >= 400:
+            self.release(dedupe_key)
+            return
+
+        with self._lock:
+            if dedupe_key in self._entries:
+                self._entries[dedupe_key]['state'] = DEDUPE_STATE_DONE
+                self._entries[dedupe_key]['results'] = tuple(results)
+
+            if self.sqlite_path:
+                with self.__sqlite() as db:
+                    db.execute(
+                        "UPDATE webhook_requests SET state = ?, results = ? WHERE dedupe_key = ?",
+                        (DEDUPE_STATE_DONE, json.dumps(list(results)), dedupe_key)
+                    )
+
+
+    def release(self, dedupe_key):
+        with self._lock:
+            self._entries.pop(dedupe_key, None)
+            self.stats['released'] += 1
+
+            if self.sqlite_path:
+                with self.__sqlite() as db:
+                    db.execute("DELETE FROM webhook_requests WHERE dedupe_key = ?", (dedupe_key,))
+
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), backend='sqlite' if self.sqlite_path else 'memory')
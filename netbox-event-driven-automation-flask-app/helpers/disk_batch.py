@@ -0,0 +1,91 @@
+BATCH_EVENT = 'batch'
+
+DISK_ADDED = 'added'
+DISK_RESIZED = 'resized'
+DISK_DELETED = 'deleted'
+DISK_UNCHANGED = 'unchanged'
+DISK_FAILED = 'failed'
+
+DISK_OP_ADD = 'add'
+DISK_OP_RESIZE = 'resize'
+DISK_OP_DELETE = 'delete'
+
+# a disk that was deleted and then created again within one batch
+DISK_OP_REPLACE = 'replace'
+
+
+def is_batchable_disk_webhook(webhook_event):
+    # VM disk webhooks (LXC root filesystems are handled on their own)
+    return (
+        webhook_event.model == 'virtualdisk'
+        and webhook_event.event in ('created', 'updated', 'deleted')
+        and webhook_event.vm_type == 'vm'
+    )
+
+
+def disk_batch_events(json_in):
+    return json_in.get('disks') or [json_in]
+
+
+def merge_disk_webhooks(pending_json_in, incoming_json_in):
+    # one 'batch' event for the VM that carries every disk webhook, in the order they arrived
+    return {
+        'model': 'virtualdisk',
+        'event': BATCH_EVENT,
+        'data': incoming_json_in['data'],
+        'disks': disk_batch_events(pending_json_in) + disk_batch_events(incoming_json_in)
+    }
+
+
+def fold_disk_events(events):
+    # disk name -> (operation, latest disk data) that gets the disk from before the batch to
+    # after it; an operation of None means the disk needs no change
+    disk_events = {}
+
+    for event in events:
+        disk_events.setdefault(event['data']['name'], []).append(event)
+
+    disks = {}
+
+    for name, events in disk_events.items():
+        kinds = [event['event'] for event in events]
+
+        # the OS disk comes with the clone, so it always exists in Proxmox
+        existed_before = kinds[0] != 'created' or name == 'scsi0'
+        exists_after = kinds[-1] != 'deleted'
+
+        if not exists_after:
+            operation = DISK_OP_DELETE if existed_before else None
+        elif not existed_before:
+            operation = DISK_OP_ADD
+        elif 'deleted' in kinds and name != 'scsi0':
+            operation = DISK_OP_REPLACE
+        else:
+            operation = DISK_OP_RESIZE
+
+        disks[name] = (operation, events[-1]['data'])
+
+    return disks
+
+
+def disk_config_value(disk_data):
+    return f"{disk_data['custom_fields']['proxmox_disk_storage_volume']}:{int(disk_data['size'])/1000},backup=0,ssd=0"
+
+
+def disk_size(disk_data):
+    return f"{int(disk_data['size'])/1000}G"
+
+
+def disk_batch_results(proxmox_vmid, disks, errors):
+    # disks: name -> DISK_* result, errors: name -> error message
+    failed = sorted(name for name, result in disks.items() if result == DISK_FAILED)
+
+    if failed:
+        return 500, {'result': f"Unable to change disk(s) {', '.join(failed)} for VM {proxmox_vmid}: " + '; '.join(f"{name}: {errors.get(name)}" for name in failed), 'disks': disks}
+
+    changed = sorted(name for name, result in disks.items() if result != DISK_UNCHANGED)
+
+    if not changed:
+        return 200, {'result': f"Nothing changed for disks of VM {proxmox_vmid}", 'disks': disks}
+
+    return 200, {'result': f"Disk(s) {', '.join(changed)} for VM {proxmox_vmid} changed successfully", 'disks': disks}
@@ -0,0 +1,604 @@
+import json
+import random
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+
+# A stand-in for the parts of the Proxmox VE API that the webhook listener uses, so that
+# the event pipeline can be load-tested without a cluster. Not a Proxmox emulator: state
+# changes are applied when a task starts, and tasks finish after a configurable duration.
+
+DEFAULT_TEMPLATE_VMID = 9000
+DEFAULT_LXC_ROOTFS_SIZE = '8G'
+
+DISK_KEY_PATTERN = re.compile(r'^(scsi|virtio|sata|ide|mp)(\d+)$|^rootfs$')
+
+# '<storage>:<size in GiB>[,options]' in a config update asks Proxmox to allocate a new volume
+DISK_ALLOCATION_PATTERN = re.compile(r'^([^:,]+):(\d+(?:\.\d+)?)((?:,[^,]+)*)$')
+
+
+def size_to_mb(size):
+    m = re.match(r'^\+?(\d+(?:\.\d+)?)([KMGT]?)$', str(size))
+
+    if not m:
+        raise ValueError(f"Invalid size {size}")
+
+    return float(m.group(1)) * {'K': 1 / 1024, 'M': 1, 'G': 1024, 'T': 1024 * 1024, '': 1 / (1024 * 1024)}[m.group(2)]
+
+
+def mb_to_size(size_mb):
+    return f"{int(size_mb / 1024)}G" if size_mb % 1024 == 0 else f"{int(size_mb)}M"
+
+
+def allocate_disk(vmid, key, value):
+    # the volume Proxmox would create for a disk allocation, with size= last like the volumes
+    # it reports; anything else (an existing volume, 'none', a CD-ROM) is stored as it is
+    m = DISK_ALLOCATION_PATTERN.match(str(value))
+
+    if not DISK_KEY_PATTERN.match(key) or not m:
+        return value
+
+    storage, size_gb, options = m.groups()
+    disk_number = re.sub(r'\D', '', key) or '0'
+
+    return f"{storage}:vm-{vmid}-disk-{disk_number}{options},size={mb_to_size(float(size_gb) * 1024)}"
+
+
+class FakeProxmoxError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+class FakeProxmoxCluster:
+    def __init__(self, nodes=('pve1',), cluster_name='fake-cluster', task_duration=0.5, task_duration_jitter=0.5,
+                 task_failure_rate=0.0, templates=(DEFAULT_TEMPLATE_VMID,), storage='local-lvm', storage_types=None, node_addresses=None, seed=None):
+        self.nodes = list(nodes)
+        self.cluster_name = cluster_name
+        self.task_duration = float(task_duration)
+        self.task_duration_jitter = float(task_duration_jitter)
+        self.task_failure_rate = float(task_failure_rate)
+        self.storage = storage
+
+        # storage id -> (type, shared), for storage/{storage}
+        self.storage_types = storage_types or {storage: ('lvmthin', 0)}
+
+        # node -> address reported by cluster/status
+        self.node_addresses = dict(node_addresses or {})
+
+        self._lock = threading.RLock()
+        self._random = random.Random(seed)
+        self._guests = {}
+        self._tasks = {}
+        self._task_counter = 0
+
+        for template_vmid in templates:
+            self.add_guest(int(template_vmid), f"template-{template_vmid}", self.nodes[0], template=True)
+
+
+    def add_guest(self, vmid, name, node, guest_type='qemu', status='stopped', template=False, cores=1, memory=1024, disk_size='32G'):
+        with self._lock:
+            if guest_type == 'qemu':
+                config = {
+                    'name': name,
+                    'cores': cores,
+                    'memory': memory,
+                    'bootdisk': 'scsi0',
+                    'scsi0': f"{self.storage}:vm-{vmid}-disk-0,size={disk_size}"
+                }
+            else:
+                config = {
+                    'hostname': name,
+                    'cores': cores,
+                    'memory': memory,
+                    'rootfs': f"{self.storage}:vm-{vmid}-disk-0,size={disk_size}"
+                }
+
+            self._guests[vmid] = {
+                'vmid': vmid,
+                'type': guest_type,
+                'node': node,
+                'status': status,
+                'template': 1 if template else 0,
+                'config': config
+            }
+
+
+    def __guest(self, node, guest_type, vmid):
+        guest = self._guests.get(int(vmid))
+
+        if not guest or guest['type'] != guest_type or guest['node'] != node:
+            config_dir = 'qemu-server' if guest_type == 'qemu' else 'lxc'
+            raise FakeProxmoxError(500, f"Configuration file 'nodes/{node}/{config_dir}/{vmid}.conf' does not exist")
+
+        return guest
+
+
+    def __node(self, node):
+        if node not in self.nodes:
+            raise FakeProxmoxError(595, f"no such cluster node '{node}'")
+
+
+    def __task(self, node, task_type, vmid, apply=None):
+        # the change is applied right away unless the task is going to fail
+        now = time.time()
+        duration = max(0.0, self.task_duration * (1 + self._random.uniform(-self.task_duration_jitter, self.task_duration_jitter)))
+        failed = self._random.random() < self.task_failure_rate
+
+        self._task_counter += 1
+        upid = f"UPID:{node}:{self._task_counter:08X}:{self._task_counter:08X}:{int(now):08X}:{task_type}:{vmid}:root@pam:"
+
+        self._tasks[upid] = {
+            'upid': upid,
+            'node': node,
+            'type': task_type,
+            'id': str(vmid),
+            'user': 'root@pam',
+            'starttime': int(now),
+            'finishes': now + duration,
+            'exitstatus': 'fake task failure' if failed else 'OK'
+        }
+
+        if apply and not failed:
+            apply()
+
+        return upid
+
+
+    def __task_status(self, task):
+        task_status = {key: task[key] for key in ('upid', 'node', 'type', 'id', 'user', 'starttime')}
+
+        if time.time() >= task['finishes']:
+            task_status['status'] = 'stopped'
+            task_status['exitstatus'] = task['exitstatus']
+            task_status['endtime'] = int(task['finishes'])
+        else:
+            task_status['status'] = 'running'
+
+        return task_status
+
+
+    # cluster
+
+    def cluster_resources(self, params):
+        with self._lock:
+            resources = []
+
+            if params.get('type') in (None, 'vm'):
+                for guest in self._guests.values():
+                    resources.append({
+                        'id': f"{guest['type']}/{guest['vmid']}",
+                        'type': guest['type'],
+                        'vmid': guest['vmid'],
+                        'name': guest['config'].get('name', guest['config'].get('hostname')),
+                        'node': guest['node'],
+                        'status': guest['status'],
+                        'template': guest['template']
+                    })
+
+            if params.get('type') in (None, 'node'):
+                for node in self.nodes:
+                    resources.append({'id': f"node/{node}", 'type': 'node', 'node': node, 'status': 'online'})
+
+            return resources
+
+
+    def cluster_nextid(self, params):
+        with self._lock:
+            # with ?vmid=N, Proxmox only checks whether N is free
+            if params.get('vmid'):
+                if int(params['vmid']) in self._guests:
+                    raise FakeProxmoxError(400, f"VM {params['vmid']} already exists")
+
+                return str(params['vmid'])
+
+            vmid = 100
+
+            while vmid in self._guests:
+                vmid += 1
+
+            return str(vmid)
+
+
+    def cluster_status(self, params):
+        cluster_status = [{'type': 'cluster', 'id': 'cluster', 'name': self.cluster_name, 'nodes': len(self.nodes), 'quorate': 1}]
+
+        for node_index, node in enumerate(self.nodes):
+            cluster_status.append({
+                'type': 'node',
+                'id': f"node/{node}",
+                'name': node,
+                'nodeid': node_index + 1,
+                'ip': self.node_addresses.get(node, '127.0.0.1'),
+                'online': 1,
+                'local': 1 if node_index == 0 else 0
+            })
+
+        return cluster_status
+
+
+    # nodes
+
+    def node_guests(self, node, guest_type):
+        with self._lock:
+            self.__node(node)
+
+            return [
+                dict(guest['config'], vmid=guest['vmid'], name=guest['config'].get('name', guest['config'].get('hostname')), status=guest['status'], template=guest['template'])
+                for guest in self._guests.values() if guest['node'] == node and guest['type'] == guest_type
+            ]
+
+
+    def node_tasks(self, node, params):
+        with self._lock:
+            self.__node(node)
+
+            since = int(params.get('since', 0))
+            limit = int(params.get('limit', 50))
+
+            tasks = [self.__task_status(task) for task in self._tasks.values() if task['node'] == node and task['starttime'] >= since]
+            tasks.sort(key=lambda task: task['starttime'], reverse=True)
+
+            # the task list reports the exit status as 'status' for finished tasks
+            for task in tasks:
+                if task['status'] == 'stopped':
+                    task['status'] = task.pop('exitstatus')
+                else:
+                    del task['status']
+
+            return tasks[:limit]
+
+
+    def task_status(self, node, upid):
+        with self._lock:
+            if upid not in self._tasks or self._tasks[upid]['node'] != node:
+                raise FakeProxmoxError(500, f"no such task '{upid}'")
+
+            return self.__task_status(self._tasks[upid])
+
+
+    def __config_digest(self, guest):
+        return f"{hash(json.dumps(guest['config'], sort_keys=True)) & 0xffffffff:08x}"
+
+
+    def guest_config(self, node, guest_type, vmid):
+        with self._lock:
+            guest = self.__guest(node, guest_type, vmid)
+
+            config = dict(guest['config'], digest=self.__config_digest(guest))
+
+            if guest['template']:
+                config['template'] = 1
+
+            return config
+
+
+    def storage_config(self, storage):
+        if storage not in self.storage_types:
+            raise FakeProxmoxError(500, f"storage '{storage}' does not exist")
+
+        storage_type, shared = self.storage_types[storage]
+
+        return {'storage': storage, 'type': storage_type, 'shared': shared, 'content': 'images,rootdir'}
+
+
+    def update_guest_config(self, node, guest_type, vmid, data, asynchronous):
+        with self._lock:
+            guest = self.__guest(node, guest_type, vmid)
+
+            # like Proxmox, refuse the change if the config was modified since it was read
+            if data.get('digest') and data['digest'] != self.__config_digest(guest):
+                raise FakeProxmoxError(500, "detected modified configuration - file changed by other user? Try again.")
+
+            def apply():
+                for key, value in data.items():
+                    if key in ('delete', 'digest'):
+                        continue
+
+                    guest['config'][key] = int(value) if key in ('cores', 'memory') else allocate_disk(vmid, key, value)
+
+                for key in str(data.get('delete', '')).split(','):
+                    guest['config'].pop(key.strip(), None)
+
+            # qemu POST config is a task, PUT config (qemu and lxc) is synchronous
+            if asynchronous:
+                return self.__task(node, 'qmconfig', vmid, apply)
+
+            apply()
+
+            return None
+
+
+    def resize_guest_disk(self, node, guest_type, vmid, data):
+        with self._lock:
+            guest = self.__guest(node, guest_type, vmid)
+            disk = data.get('disk')
+
+            if disk not in guest['config']:
+                raise FakeProxmoxError(500, f"disk '{disk}' does not exist")
+
+            disk_info, _, current_size = guest['config'][disk].rpartition(',size=')
+            new_size_mb = size_to_mb(data['size'])
+
+            if str(data['size']).startswith('+'):
+                new_size_mb += size_to_mb(current_size)
+
+            if new_size_mb < size_to_mb(current_size):
+                raise FakeProxmoxError(500, "shrinking disks is not supported")
+
+            def apply():
+                guest['config'][disk] = f"{disk_info},size={mb_to_size(new_size_mb)}"
+
+            return self.__task(node, 'resize', vmid, apply)
+
+
+    def unlink_guest_disks(self, node, vmid, data):
+        with self._lock:
+            guest = self.__guest(node, 'qemu', vmid)
+
+            for disk in str(data.get('idlist', '')).split(','):
+                guest['config'].pop(disk.strip(), None)
+
+            return None
+
+
+    def clone_guest(self, node, vmid, data):
+        with self._lock:
+            source = self.__guest(node, 'qemu', vmid)
+            new_vmid = int(data['newid'])
+            target = data.get('target') or node
+
+            self.__node(target)
+
+            if new_vmid in self._guests:
+                raise FakeProxmoxError(500, f"unable to create VM {new_vmid}: config file already exists")
+
+            # full defaults to 1 for VMs and 0 for templates, like Proxmox
+            linked = not int(data.get('full', 0 if source['template'] else 1))
+
+            if linked and not source['template']:
+                raise FakeProxmoxError(500, f"Linked clone feature for VM {vmid} is only possible for templates")
+
+            if linked and data.get('storage'):
+                raise FakeProxmoxError(400, "parameter verification failed: storage: option is only allowed for full clones")
+
+            def apply():
+                storage = data.get('storage') or self.storage
+                config = dict(source['config'], name=data.get('name') or f"Copy-of-VM-{source['config'].get('name')}")
+
+                if data.get('description'):
+                    config['description'] = data['description']
+
+                for key, value in list(config.items()):
+                    if re.match(r'^(scsi|virtio|sata|ide)\d+$', key) and 'size=' in str(value):
+                        if linked:
+                            config[key] = f"{value.split(':', 1)[0]}:base-{vmid}-disk-{key[-1]}/vm-{new_vmid}-disk-{key[-1]},size={value.rpartition(',size=')[2]}"
+                        else:
+                            config[key] = f"{storage}:vm-{new_vmid}-disk-{key[-1]},size={value.rpartition(',size=')[2]}"
+
+                self._guests[new_vmid] = {'vmid': new_vmid, 'type': 'qemu', 'node': target, 'status': 'stopped', 'template': 0, 'config': config}
+
+            return self.__task(node, 'qmclone', vmid, apply)
+
+
+    def create_lxc(self, node, data):
+        with self._lock:
+            self.__node(node)
+            vmid = int(data['vmid'])
+
+            if vmid in self._guests:
+                raise FakeProxmoxError(500, f"CT {vmid} already exists on node '{self._guests[vmid]['node']}'")
+
+            def apply():
+                self.add_guest(vmid, data.get('hostname', f"CT{vmid}"), node, 'lxc', cores=int(data.get('cores', 1)), memory=int(data.get('memory', 512)), disk_size=DEFAULT_LXC_ROOTFS_SIZE)
+
+                for key in ('net0', 'ostemplate'):
+                    if key in data:
+                        self._guests[vmid]['config'][key] = data[key]
+
+            return self.__task(node, 'vzcreate', vmid, apply)
+
+
+    def set_guest_status(self, node, guest_type, vmid, action):
+        with self._lock:
+            guest = self.__guest(node, guest_type, vmid)
+
+            def apply():
+                guest['status'] = 'running' if action == 'start' else 'stopped'
+
+            return self.__task(node, f"{'qm' if guest_type == 'qemu' else 'vz'}{action}", vmid, apply)
+
+
+    def delete_guest(self, node, guest_type, vmid):
+        with self._lock:
+            guest = self.__guest(node, guest_type, vmid)
+
+            if guest['status'] == 'running':
+                raise FakeProxmoxError(500, f"{'VM' if guest_type == 'qemu' else 'CT'} {vmid} is running - destroy failed")
+
+            def apply():
+                del self._guests[int(vmid)]
+
+            return self.__task(node, f"{'qm' if guest_type == 'qemu' else 'vz'}destroy", vmid, apply)
+
+
+    def migrate_guest(self, node, guest_type, vmid, data):
+        with self._lock:
+            guest = self.__guest(node, guest_type, vmid)
+            target = data.get('target')
+
+            self.__node(target)
+
+            if target == node:
+                raise FakeProxmoxError(500, f"target is local node.")
+
+            def apply():
+                guest['node'] = target
+
+            return self.__task(node, f"{'qm' if guest_type == 'qemu' else 'vz'}migrate", vmid, apply)
+
+
+class FakeProxmoxRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # (method, path regex, handler(cluster, match, params)) under /api2/json
+    ROUTES = [
+        ('GET', r'^cluster/resources$', lambda cluster, m, params: cluster.cluster_resources(params)),
+        ('GET', r'^cluster/nextid$', lambda cluster, m, params: cluster.cluster_nextid(params)),
+        ('GET', r'^cluster/status$', lambda cluster, m, params: cluster.cluster_status(params)),
+        ('GET', r'^storage/(?P<storage>[^/]+)$', lambda cluster, m, params: cluster.storage_config(m['storage'])),
+        ('GET', r'^nodes/(?P<node>[^/]+)/(?P<type>qemu|lxc)$', lambda cluster, m, params: cluster.node_guests(m['node'], m['type'])),
+        ('POST', r'^nodes/(?P<node>[^/]+)/lxc$', lambda cluster, m, params: cluster.create_lxc(m['node'], params)),
+        ('GET', r'^nodes/(?P<node>[^/]+)/tasks$', lambda cluster, m, params: cluster.node_tasks(m['node'], params)),
+        ('GET', r'^nodes/(?P<node>[^/]+)/tasks/(?P<upid>[^/]+)/status$', lambda cluster, m, params: cluster.task_status(m['node'], m['upid'])),
+        ('GET', r'^nodes/(?P<node>[^/]+)/(?P<type>qemu|lxc)/(?P<vmid>\d+)/config$', lambda cluster, m, params: cluster.guest_config(m['node'], m['type'], m['vmid'])),
+        ('POST', r'^nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/config$', lambda cluster, m, params: cluster.update_guest_config(m['node'], 'qemu', m['vmid'], params, True)),
+        ('PUT', r'^nodes/(?P<node>[^/]+)/(?P<type>qemu|lxc)/(?P<vmid>\d+)/config$', lambda cluster, m, params: cluster.update_guest_config(m['node'], m['type'], m['vmid'], params, False)),
+        ('PUT', r'^nodes/(?P<node>[^/]+)/(?P<type>qemu|lxc)/(?P<vmid>\d+)/resize$', lambda cluster, m, params: cluster.resize_guest_disk(m['node'], m['type'], m['vmid'], params)),
+        ('PUT', r'^nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/unlink$', lambda cluster, m, params: cluster.unlink_guest_disks(m['node'], m['vmid'], params)),
+        ('POST', r'^nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/clone$', lambda cluster, m, params: cluster.clone_guest(m['node'], m['vmid'], params)),
+        ('POST', r'^nodes/(?P<node>[^/]+)/(?P<type>qemu|lxc)/(?P<vmid>\d+)/status/(?P<action>start|stop)$', lambda cluster, m, params: cluster.set_guest_status(m['node'], m['type'], m['vmid'], m['action'])),
+        ('POST', r'^nodes/(?P<node>[^/]+)/(?P<type>qemu|lxc)/(?P<vmid>\d+)/migrate$', lambda cluster, m, params: cluster.migrate_guest(m['node'], m['type'], m['vmid'], params)),
+        ('DELETE', r'^nodes/(?P<node>[^/]+)/(?P<type>qemu|lxc)/(?P<vmid>\d+)$', lambda cluster, m, params: cluster.delete_guest(m['node'], m['type'], m['vmid'])),
+    ]
+
+    # e.g. 'nodes/{node}/{type}/{vmid}/config', for request statistics
+    COMPILED_ROUTES = [
+        (method, re.compile(path), re.sub(r'\(\?P<(\w+)>[^)]*\)', r'{\1}', path.strip('^$')), handler)
+        for method, path, handler in ROUTES
+    ]
+
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+    def __send(self, status_code, body, reason=None):
+        content = json.dumps(body).encode('utf-8')
+
+        # Proxmox (and proxmoxer) put the error message in the HTTP reason phrase
+        self.send_response(status_code, reason)
+        self.send_header('Content-Type', 'application/json;charset=UTF-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+    def __params(self, url):
+        params = dict(parse_qsl(url.query, keep_blank_values=True))
+        content_length = int(self.headers.get('Content-Length') or 0)
+
+        if content_length:
+            body = self.rfile.read(content_length).decode('utf-8')
+
+            if 'json' in (self.headers.get('Content-Type') or ''):
+                params.update(json.loads(body) or {})
+            else:
+                params.update(dict(parse_qsl(body, keep_blank_values=True)))
+
+        return params
+
+
+    def __handle(self, method):
+        url = urlsplit(self.path)
+        params = self.__params(url)
+        path = url.path.strip('/')
+
+        if not path.startswith('api2/json/'):
+            return self.__send(404, {'data': None}, 'Not Found')
+
+        path = path[len('api2/json/'):]
+
+        if not self.headers.get('Authorization', '').startswith('PVEAPIToken='):
+            return self.__send(401, {'data': None}, 'No ticket')
+
+        for route_method, route_path, route_name, handler in self.COMPILED_ROUTES:
+            m = route_path.match(path)
+
+            if route_method != method or not m:
+                continue
+
+            self.server.record(method, route_name)
+
+            if self.server.latency:
+                time.sleep(self.server.latency)
+
+            if self.server.error_rate and self.server.random.random() < self.server.error_rate:
+                return self.__send(self.server.error_status, {'data': None}, 'fake API error')
+
+            try:
+                return self.__send(200, {'data': handler(self.server.cluster, m.groupdict(), params)})
+            except FakeProxmoxError as e:
+                return self.__send(e.status_code, {'data': None, 'message': e.message}, e.message)
+            except (KeyError, ValueError) as e:
+                return self.__send(400, {'data': None, 'errors': {'parameter': str(e)}}, f"Parameter verification failed. {e}")
+
+        return self.__send(501, {'data': None}, f"Method '{method} /{path}' not implemented")
+
+
+    def do_GET(self):
+        self.__handle('GET')
+
+
+    def do_POST(self):
+        self.__handle('POST')
+
+
+    def do_PUT(self):
+        self.__handle('PUT')
+
+
+    def do_DELETE(self):
+        self.__handle('DELETE')
+
+
+class FakeProxmoxServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, cluster=None, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, error_status=500, verbose=False, seed=None):
+        super().__init__((host, port), FakeProxmoxRequestHandler)
+
+        self.cluster = cluster or FakeProxmoxCluster(seed=seed)
+        self.latency = float(latency)
+        self.error_rate = float(error_rate)
+        self.error_status = int(error_status)
+        self.verbose = verbose
+        self.random = random.Random(seed)
+
+        self._stats_lock = threading.Lock()
+        self.stats = {}
+        self._thread = None
+
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+    def record(self, method, route):
+        with self._stats_lock:
+            self.stats[f"{method} {route}"] = self.stats.get(f"{method} {route}", 0) + 1
+
+
+    def get_stats(self):
+        with self._stats_lock:
+            return dict(self.stats)
+
+
+    def start(self):
+        # serve from a background thread (for use inside tests and benchmarks)
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-proxmox-server', daemon=True)
+        self._thread.start()
+
+        return self
+
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
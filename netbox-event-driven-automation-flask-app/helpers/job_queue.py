@@ -0,0 +1,165 @@
+import logging
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+from helpers.keyed_executor import KeyedExecutor
+
+
+JOB_STATE_QUEUED = 'queued'
+JOB_STATE_RUNNING = 'running'
+JOB_STATE_FINISHED = 'finished'
+JOB_STATE_FAILED = 'failed'
+
+
+class WebhookJob:
+    def __init__(self, job_id, model=None, event=None, on_finished=None):
+        self.id = job_id
+        self.model = model
+        self.event = event
+        self.state = JOB_STATE_QUEUED
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.coalesced = 0
+        self.results = None
+        self.on_finished = on_finished
+
+
+    def to_dict(self):
+        job_info = {
+            'id': self.id,
+            'model': self.model,
+            'event': self.event,
+            'state': self.state,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+            'coalesced': self.coalesced,
+            'queued_seconds': None,
+            'run_seconds': None,
+            'status': None,
+            'result': None
+        }
+
+        if self.started:
+            job_info['queued_seconds'] = round(self.started - self.submitted, 3)
+
+        if self.started and self.finished:
+            job_info['run_seconds'] = round(self.finished - self.started, 3)
+
+        if self.results:
+            job_info['status'] = self.results[0]
+            job_info['result'] = self.results[1]
+
+        return job_info
+
+
+class WebhookJobQueue:
+    def __init__(self, workers=4, max_finished_jobs=1000, debug=False, executor=None):
+        self.max_finished_jobs = int(max_finished_jobs)
+        self.debug = debug
+
+        if executor is None:
+            executor = KeyedExecutor(workers, name='webhook-job-worker')
+
+        self.executor = executor
+
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+
+
+    def start(self):
+        self.executor.start()
+
+
+    def submit(self, fn, *args, model=None, event=None, key=None, merge_key=None, merge=None, delay=0, max_delay=0, on_finished=None):
+        job = WebhookJob(uuid.uuid4().hex, model, event, on_finished)
+
+        with self._lock:
+            self._jobs[job.id] = job
+            self.__expire_finished_jobs()
+
+        # jobs without a key get a lane of their own
+        if key is None:
+            key = job.id
+
+        job_merge = None
+
+        if merge:
+            # folded jobs share one run and one result
+            job_merge = lambda pending, incoming: (pending[0] + incoming[0], pending[1], merge(pending[2], incoming[2]))
+
+        self.executor.submit(key, self.__run_jobs, [job], fn, args, merge_key=merge_key, merge=job_merge, delay=delay, max_delay=max_delay)
+
+        return job
+
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+
+            if not job:
+                return None
+
+            return job.to_dict()
+
+
+    def get_stats(self):
+        with self._lock:
+            states = {JOB_STATE_QUEUED: 0, JOB_STATE_RUNNING: 0, JOB_STATE_FINISHED: 0, JOB_STATE_FAILED: 0}
+
+            for job in self._jobs.values():
+                states[job.state] += 1
+
+        return {
+            'jobs': states,
+            'executor': self.executor.get_stats()
+        }
+
+
+    def __expire_finished_jobs(self):
+        # only finished jobs count against the retention limit; pending work is never dropped
+        finished_jobs = [job_id for job_id, job in self._jobs.items() if job.state in (JOB_STATE_FINISHED, JOB_STATE_FAILED)]
+
+        for job_id in finished_jobs[:max(0, len(finished_jobs) - self.max_finished_jobs)]:
+            del self._jobs[job_id]
+
+
+    def __run_jobs(self, jobs, fn, args):
+        with self._lock:
+            started = time.time()
+
+            for job in jobs:
+                job.state = JOB_STATE_RUNNING
+                job.started = started
+                job.coalesced = len(jobs) - 1
+
+        try:
+            results = fn(*args)
+            state = JOB_STATE_FINISHED
+        except Exception as e:
+            logging.exception(f"Webhook job(s) {', '.join(job.id for job in jobs)} failed")
+            results = (500, {'result': f"Job failed: {e}"})
+            state = JOB_STATE_FAILED
+
+        with self._lock:
+            finished = time.time()
+
+            for job in jobs:
+                job.results = results
+                job.state = state
+                job.finished = finished
+
+        for job in jobs:
+            if job.on_finished:
+                try:
+                    job.on_finished(job)
+                except Exception:
+                    logging.exception(f"Webhook job {job.id} completion callback failed")
+
+        if self.debug:
+            print("JOB(S) FINISHED", [job.to_dict() for job in jobs])
+
+        return results
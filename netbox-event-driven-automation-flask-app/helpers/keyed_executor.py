@@ -0,0 +1,169 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import Future
+
+
+class LaneItem:
+    __slots__ = ('futures', 'fn', 'args', 'kwargs', 'merge_key', 'merge', 'not_before', 'deadline', 'started')
+
+    def __init__(self, future, fn, args, kwargs, merge_key=None, merge=None, delay=0, max_delay=0):
+        now = time.monotonic()
+
+        self.futures = [future]
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.merge_key = merge_key
+        self.merge = merge
+        self.not_before = now + delay
+        self.deadline = now + max(delay, max_delay)
+        self.started = False
+
+
+class KeyedExecutor:
+    def __init__(self, workers=8, name='keyed-executor'):
+        self.workers = int(workers)
+        self.name = name
+
+        self._lock = threading.Lock()
+        self._lanes = {}
+        self._active = set()
+        self._ready = queue.Queue()
+        self._threads = []
+        self._pid = None
+
+        self.stats = {
+            'submitted': 0,
+            'completed': 0,
+            'coalesced': 0,
+            'max_lane_depth': 0
+        }
+
+
+    def start(self):
+        with self._lock:
+            # threads do not survive a fork (e.g. gunicorn preload_app); start new ones in the child
+            if self._threads and self._pid == os.getpid():
+                return
+
+            # the ready queue may still list waiters from the parent's (now gone) threads,
+            # which would swallow wakeups: start over with a fresh queue
+            if self._threads:
+                self._ready = queue.Queue()
+
+                for key in self._active:
+                    self._ready.put(key)
+
+            self._threads = []
+            self._pid = os.getpid()
+
+            for worker_num in range(self.workers):
+                worker = threading.Thread(target=self.__worker, name=f"{self.name}-{worker_num}", daemon=True)
+                worker.start()
+                self._threads.append(worker)
+
+
+    def submit(self, key, fn, *args, merge_key=None, merge=None, delay=0, max_delay=0, **kwargs):
+        # work for the same key runs in submission order; different keys run in parallel.
+        # with a merge_key, work that has not started yet and carries the same merge_key is
+        # folded together with merge(old_args, new_args), and held back for `delay` seconds
+        # after the last fold (but no longer than `max_delay` after the first submission)
+        future = Future()
+
+        with self._lock:
+            self.stats['submitted'] += 1
+
+            if key not in self._lanes:
+                self._lanes[key] = deque()
+
+            lane = self._lanes[key]
+
+            if merge_key is not None and lane and not lane[-1].started and lane[-1].merge_key == merge_key:
+                pending = lane[-1]
+                pending.args = pending.merge(pending.args, args)
+                pending.kwargs = kwargs
+                pending.futures.append(future)
+                pending.not_before = min(time.monotonic() + delay, pending.deadline)
+
+                self.stats['coalesced'] += 1
+
+                return future
+
+            lane.append(LaneItem(future, fn, args, kwargs, merge_key, merge, delay, max_delay))
+
+            self.stats['max_lane_depth'] = max(self.stats['max_lane_depth'], len(lane))
+
+            if key not in self._active:
+                self._active.add(key)
+                self._ready.put(key)
+
+        if self._pid != os.getpid():
+            self.start()
+
+        return future
+
+
+    def lane_depth(self, key):
+        with self._lock:
+            return len(self._lanes.get(key, ()))
+
+
+    def get_stats(self, top=10):
+        with self._lock:
+            lane_depths = {str(key): len(lane) for key, lane in self._lanes.items()}
+
+            return dict(
+                self.stats,
+                workers=self.workers,
+                lanes=len(lane_depths),
+                queued=sum(lane_depths.values()),
+                busiest_lanes=dict(sorted(lane_depths.items(), key=lambda lane: lane[1], reverse=True)[:top])
+            )
+
+
+    def __worker(self):
+        while True:
+            key = self._ready.get()
+
+            with self._lock:
+                item = self._lanes[key][0]
+                wait_seconds = item.not_before - time.monotonic()
+
+                # still inside its coalescing window: come back to this lane later
+                if wait_seconds > 0:
+                    timer = threading.Timer(wait_seconds, self._ready.put, [key])
+                    timer.daemon = True
+                    timer.start()
+                    continue
+
+                item.started = True
+
+            running_futures = [future for future in item.futures if future.set_running_or_notify_cancel()]
+
+            if running_futures:
+                try:
+                    result = item.fn(*item.args, **item.kwargs)
+
+                    for future in running_futures:
+                        future.set_result(result)
+                except Exception as e:
+                    logging.exception(f"{self.name}: work for lane {key} failed")
+
+                    for future in running_futures:
+                        future.set_exception(e)
+
+            with self._lock:
+                self._lanes[key].popleft()
+                self.stats['completed'] += 1
+
+                # hand the lane back to the pool so one busy key cannot starve the others
+                if self._lanes[key]:
+                    self._ready.put(key)
+                else:
+                    del self._lanes[key]
+                    self._active.discard(key)
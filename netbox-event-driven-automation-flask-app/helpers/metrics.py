@@ -0,0 +1,207 @@
+import os
+import re
+import time
+
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client import multiprocess
+
+
+# provisioning work ranges from milliseconds (status reads) to many minutes (clones, migrations)
+WEBHOOK_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200)
+API_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+METRICS_CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+webhook_request_seconds = Histogram(
+    'netbox_proxmox_webhook_request_seconds',
+    'Time spent handling NetBox webhooks, per route',
+    ['route', 'model', 'event'],
+    buckets=WEBHOOK_BUCKETS
+)
+
+webhook_requests = Counter(
+    'netbox_proxmox_webhook_requests',
+    'NetBox webhooks handled, per route and result status code',
+    ['route', 'model', 'event', 'status']
+)
+
+webhooks_in_flight = Gauge(
+    'netbox_proxmox_webhooks_in_flight',
+    'Webhooks accepted but not finished yet (queued or running)',
+    multiprocess_mode='livesum'
+)
+
+webhooks_running = Gauge(
+    'netbox_proxmox_webhooks_running',
+    'Webhooks running right now, per route',
+    ['route'],
+    multiprocess_mode='livesum'
+)
+
+proxmox_api_requests = Counter(
+    'netbox_proxmox_proxmox_api_requests',
+    'Proxmox API calls, per method, endpoint and HTTP status code',
+    ['method', 'endpoint', 'status']
+)
+
+proxmox_api_request_seconds = Histogram(
+    'netbox_proxmox_proxmox_api_request_seconds',
+    'Proxmox API call latency, per method and endpoint',
+    ['method', 'endpoint'],
+    buckets=API_BUCKETS
+)
+
+proxmox_task_wait_seconds = Histogram(
+    'netbox_proxmox_proxmox_task_wait_seconds',
+    'Time spent waiting for Proxmox tasks to finish',
+    ['kind', 'outcome'],
+    buckets=WEBHOOK_BUCKETS
+)
+
+proxmox_clone_seconds = Histogram(
+    'netbox_proxmox_proxmox_clone_seconds',
+    'Time from requesting a VM clone until Proxmox has finished it, per clone strategy',
+    ['strategy', 'outcome'],
+    buckets=WEBHOOK_BUCKETS
+)
+
+netbox_api_requests = Counter(
+    'netbox_proxmox_netbox_api_requests',
+    'NetBox API calls, per method, endpoint and HTTP status code',
+    ['method', 'endpoint', 'status']
+)
+
+netbox_api_request_seconds = Histogram(
+    'netbox_proxmox_netbox_api_request_seconds',
+    'NetBox API call latency, per method and endpoint',
+    ['method', 'endpoint'],
+    buckets=API_BUCKETS
+)
+
+netbox_vm_cache_lookups = Counter(
+    'netbox_proxmox_netbox_vm_cache_lookups',
+    'NetBox VM lookups, per cache result (request_hit, hit or miss)',
+    ['result']
+)
+
+netbox_vm_cache_invalidations = Counter(
+    'netbox_proxmox_netbox_vm_cache_invalidations',
+    'NetBox VM cache entries dropped because the VM changed'
+)
+
+warm_pool_claims = Counter(
+    'netbox_proxmox_warm_pool_claims',
+    'New VMs taken from the warm pool (claimed) or cloned because the pool was empty (empty)',
+    ['result']
+)
+
+# path segments that identify one object are folded so that endpoints stay low-cardinality
+NUMERIC_SEGMENT = re.compile(r'^\d+$')
+NAMED_SEGMENTS = {
+    'nodes': '{node}',
+    'tasks': '{upid}',
+    'storage': '{storage}'
+}
+
+# webhook payloads are user input; keep label values to the ones we know about
+WEBHOOK_MODELS = ('virtualmachine', 'virtualdisk')
+WEBHOOK_EVENTS = ('created', 'updated', 'deleted')
+
+
+def api_endpoint(url):
+    segments = urlsplit(url).path.strip('/').split('/')
+
+    # drop the API prefix (/api2/json for Proxmox, /api for NetBox)
+    if segments[:2] == ['api2', 'json']:
+        segments = segments[2:]
+    elif segments[:1] == ['api']:
+        segments = segments[1:]
+
+    endpoint = []
+
+    for index, segment in enumerate(segments):
+        if index and segments[index - 1] in NAMED_SEGMENTS:
+            endpoint.append(NAMED_SEGMENTS[segments[index - 1]])
+        elif NUMERIC_SEGMENT.match(segment):
+            endpoint.append('{id}')
+        else:
+            endpoint.append(segment)
+
+    return '/' + '/'.join(endpoint)
+
+
+def instrument_session(http_session, api):
+    # count and time every call made through a requests session ('proxmox' or 'netbox')
+    if api == 'proxmox':
+        requests_counter, request_seconds = proxmox_api_requests, proxmox_api_request_seconds
+    else:
+        requests_counter, request_seconds = netbox_api_requests, netbox_api_request_seconds
+
+    def record_response(response, *args, **kwargs):
+        endpoint = api_endpoint(response.request.url)
+
+        requests_counter.labels(response.request.method, endpoint, str(response.status_code)).inc()
+        request_seconds.labels(response.request.method, endpoint).observe(response.elapsed.total_seconds())
+
+    http_session.hooks['response'].append(record_response)
+
+
+def record_api_call(api, method, url, status, seconds):
+    # for clients that do not use requests (the asyncio listener)
+    if api == 'proxmox':
+        requests_counter, request_seconds = proxmox_api_requests, proxmox_api_request_seconds
+    else:
+        requests_counter, request_seconds = netbox_api_requests, netbox_api_request_seconds
+
+    endpoint = api_endpoint(url)
+
+    requests_counter.labels(method, endpoint, str(status)).inc()
+    request_seconds.labels(method, endpoint).observe(seconds)
+
+
+def record_webhook(route, model, event, results, seconds):
+    status = str(results[0]) if results else 'exception'
+    model = model if model in WEBHOOK_MODELS else 'other'
+    event = event if event in WEBHOOK_EVENTS else 'other'
+
+    webhook_requests.labels(route, model, event, status).inc()
+    webhook_request_seconds.labels(route, model, event).observe(seconds)
+
+
+@contextmanager
+def time_task_wait(kind):
+    # outcome is 'ok', 'failed' (task exit status other than OK), 'timeout' or 'error'
+    start_time = time.monotonic()
+    outcome = {'value': 'error'}
+
+    try:
+        yield outcome
+    finally:
+        proxmox_task_wait_seconds.labels(kind, outcome['value']).observe(time.monotonic() - start_time)
+
+
+@contextmanager
+def time_clone(strategy):
+    # outcome is 'ok', 'failed' or 'error', as for time_task_wait
+    start_time = time.monotonic()
+    outcome = {'value': 'error'}
+
+    try:
+        yield outcome
+    finally:
+        proxmox_clone_seconds.labels(strategy, outcome['value']).observe(time.monotonic() - start_time)
+
+
+def metrics_output():
+    # under gunicorn, every worker writes to PROMETHEUS_MULTIPROC_DIR and any worker can
+    # report the totals (see gunicorn.conf.py)
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+
+        return generate_latest(registry)
+
+    return generate_latest()
@@ -0,0 +1,171 @@
+import contextvars
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from helpers.metrics import netbox_vm_cache_lookups, netbox_vm_cache_invalidations
+
+
+DEFAULT_TTL = 10
+DEFAULT_MAX_ENTRIES = 1000
+
+
+class NetBoxVMCache:
+    # NetBox VM records by NetBox VM ID. Within one webhook (request_scope) a VM is fetched
+    # at most once; across webhooks records are kept for `ttl` seconds (0 turns that off).
+    # Cached records are shared: treat them as read-only.
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = float(ttl)
+        self.max_entries = int(max_entries)
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._request_entries = contextvars.ContextVar('netbox_vm_request_cache', default=None)
+
+        self.stats = {
+            'request_hits': 0,
+            'hits': 0,
+            'misses': 0,
+            'invalidations': 0,
+            'evicted': 0
+        }
+
+
+    def configure(self, ttl=None, max_entries=None):
+        with self._lock:
+            if ttl is not None:
+                self.ttl = float(ttl)
+
+            if max_entries:
+                self.max_entries = int(max_entries)
+
+            if not self.ttl:
+                self._entries.clear()
+
+
+    @contextmanager
+    def request_scope(self):
+        # contextvars keep scopes apart for both worker threads and asyncio tasks
+        token = self._request_entries.set({})
+
+        try:
+            yield
+        finally:
+            self._request_entries.reset(token)
+
+
+    def __lookup(self, nb_vm_id):
+        request_entries = self._request_entries.get()
+
+        if request_entries is not None and nb_vm_id in request_entries:
+            with self._lock:
+                self.stats['request_hits'] += 1
+
+            netbox_vm_cache_lookups.labels('request_hit').inc()
+            return request_entries[nb_vm_id], None
+
+        with self._lock:
+            entry = self._entries.get(nb_vm_id)
+
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(nb_vm_id)
+                self.stats['hits'] += 1
+                nb_vm_data = entry[1]
+            else:
+                if entry:
+                    del self._entries[nb_vm_id]
+
+                self.stats['misses'] += 1
+                nb_vm_data = None
+
+            generation = self._generation
+
+        netbox_vm_cache_lookups.labels('hit' if nb_vm_data is not None else 'miss').inc()
+
+        if nb_vm_data is not None and request_entries is not None:
+            request_entries[nb_vm_id] = nb_vm_data
+
+        return nb_vm_data, generation
+
+
+    def __store(self, nb_vm_id, nb_vm_data, generation):
+        request_entries = self._request_entries.get()
+
+        if request_entries is not None:
+            request_entries[nb_vm_id] = nb_vm_data
+
+        with self._lock:
+            # a VM webhook arrived while we were fetching: the record may already be stale
+            if not self.ttl or generation != self._generation:
+                return
+
+            self._entries[nb_vm_id] = (time.monotonic() + self.ttl, nb_vm_data)
+            self._entries.move_to_end(nb_vm_id)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evicted'] += 1
+
+
+    def get(self, nb_vm_id, load):
+        # load() fetches the record from NetBox; None (not found) is not cached
+        nb_vm_id = str(nb_vm_id)
+        nb_vm_data, generation = self.__lookup(nb_vm_id)
+
+        if nb_vm_data is None:
+            nb_vm_data = load()
+
+            if nb_vm_data is not None:
+                self.__store(nb_vm_id, nb_vm_data, generation)
+
+        return nb_vm_data
+
+
+    async def get_async(self, nb_vm_id, load):
+        nb_vm_id = str(nb_vm_id)
+        nb_vm_data, generation = self.__lookup(nb_vm_id)
+
+        if nb_vm_data is None:
+            nb_vm_data = await load()
+
+            if nb_vm_data is not None:
+                self.__store(nb_vm_id, nb_vm_data, generation)
+
+        return nb_vm_data
+
+
+    def invalidate(self, nb_vm_id):
+        nb_vm_id = str(nb_vm_id)
+        request_entries = self._request_entries.get()
+
+        if request_entries is not None:
+            request_entries.pop(nb_vm_id, None)
+
+        with self._lock:
+            self._generation += 1
+            self.stats['invalidations'] += 1
+            self._entries.pop(nb_vm_id, None)
+
+        netbox_vm_cache_invalidations.inc()
+
+
+    def invalidate_from_webhook(self, webhook_json_data):
+        # any virtualmachine webhook means NetBox's copy of that VM changed
+        if webhook_json_data.get('model') == 'virtualmachine' and isinstance(webhook_json_data.get('data'), dict) and webhook_json_data['data'].get('id'):
+            self.invalidate(webhook_json_data['data']['id'])
+
+
+    def get_stats(self):
+        with self._lock:
+            return dict(
+                self.stats,
+                ttl=self.ttl,
+                max_entries=self.max_entries,
+                entries=len(self._entries)
+            )
+
+
+# process-wide cache shared by all helper instances
+netbox_vm_cache = NetBoxVMCache()
@@ -1,15 +1,28 @@
-import os
 import pynetbox
 import re
 import requests
-import time
 import urllib
 
-from proxmoxer import ProxmoxAPI, ResourceException
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from helpers.client_registry import client_registry as default_client_registry
+from helpers.cluster_inventory import cluster_inventory
+from helpers.disk_batch import disk_batch_events, disk_batch_results, disk_config_value, disk_size, fold_disk_events, DISK_ADDED, DISK_DELETED, DISK_FAILED, DISK_OP_ADD, DISK_OP_DELETE, DISK_OP_REPLACE, DISK_OP_RESIZE, DISK_RESIZED, DISK_UNCHANGED
+from helpers.clone_strategy import clone_strategy, template_disk_storages, STRATEGY_FULL
+from helpers.metrics import time_clone, time_task_wait
+from helpers.netbox_cache import netbox_vm_cache
+from helpers.task_watcher import task_watchers, ProxmoxTaskTimeoutError
+from helpers.vm_config import desired_vm_config, vm_config_changes, vm_config_failed
+from helpers.vmid_allocator import vmid_allocator, VMID_RESERVE_ATTEMPTS
+from helpers.warm_pool import warm_pool
+from proxmoxer import ResourceException
 import logging
 
+# upper bound on concurrent per-node listings when the cluster inventory is turned off
+MAX_PARALLEL_NODE_REQUESTS = 8
+
+
 class NetBoxProxmoxHelper:
-    def __init__(self, cfg_data, proxmox_node, debug=False):
+    def __init__(self, cfg_data, proxmox_node, debug=False, client_registry=None):
         self.debug = debug
 
         self.netbox_api_config = {
@@ -22,6 +35,7 @@ class NetBoxProxmoxHelper:
 
         self.proxmox_api_config = {
             'node': proxmox_node,
+            'api_proto': cfg_data['proxmox_api_config'].get('api_proto', 'https'),
             'api_host': cfg_data['proxmox_api_config']['api_host'],
             'api_port': cfg_data['proxmox_api_config']['api_port'],
             'api_user': cfg_data['proxmox_api_config']['api_user'],
@@ -30,23 +44,14 @@ class NetBoxProxmoxHelper:
             'verify_ssl': cfg_data['proxmox_api_config']['verify_ssl']
         }
 
-        self.proxmox_api = ProxmoxAPI(
-            self.proxmox_api_config['api_host'],
-            port=self.proxmox_api_config['api_port'],
-            user=self.proxmox_api_config['api_user'],
-            token_name=self.proxmox_api_config['api_token_id'],
-            token_value=self.proxmox_api_config['api_token_secret'],
-            verify_ssl=False
-        )
-
-        nb_url = f"{self.netbox_api_config['api_proto']}://{self.netbox_api_config['api_host']}:{self.netbox_api_config['api_port']}"
+        if client_registry is None:
+            client_registry = default_client_registry
 
-        self.netbox_api = pynetbox.api(
-            nb_url,
-            token=self.netbox_api_config['api_token']
-        )
+        self.client_registry = client_registry
 
-        self.netbox_api.http_session.verify = self.netbox_api_config['verify_ssl']
+        # Proxmox and NetBox clients (and their keep-alive sessions) are shared process-wide
+        self.proxmox_api = self.client_registry.get_proxmox_api(self.proxmox_api_config)
+        self.netbox_api = self.client_registry.get_netbox_api(self.netbox_api_config)
 
 
     def json_data_check_proxmox_vmid_exists(self, json_in):
@@ -54,44 +59,53 @@ class NetBoxProxmoxHelper:
             raise ValueError("Missing value for 'proxmox_vmid'")
 
 
-    def netbox_get_proxmox_vmid(self, nb_vm_obj_proxmox_vmid):
-        try:
-            nb_obj = self.netbox_api.virtualization.virtual_machines.get(id=nb_vm_obj_proxmox_vmid)
-
-            if not nb_obj:
-                raise ValueError("Unable to get Proxmox vmid from NetBox")
+    def netbox_get_vm(self, nb_vm_id):
+        # virtual disk webhooks look up the same VM more than once; see helpers/netbox_cache.py
+        def load_vm():
+            nb_obj = self.netbox_api.virtualization.virtual_machines.get(id=nb_vm_id)
 
-            nb_obj_data = dict(nb_obj)
+            return dict(nb_obj) if nb_obj else None
 
-            return nb_obj_data['custom_fields']['proxmox_vmid']
+        try:
+            nb_obj_data = netbox_vm_cache.get(nb_vm_id, load_vm)
         except pynetbox.core.query.RequestError as e:
             raise pynetbox.core.query.RequestError(e)
 
+        if not nb_obj_data:
+            raise ValueError("Unable to get Proxmox vmid from NetBox")
 
-    def netbox_get_proxmox_node_from_vm_id(self, nb_vm_id=0):
-        try:
-            nb_obj = self.netbox_api.virtualization.virtual_machines.get(id=nb_vm_id)
+        return nb_obj_data
 
-            if not nb_obj:
-                raise ValueError("Unable to get Proxmox vmid from NetBox")
 
-            nb_obj_data = dict(nb_obj)
+    def netbox_get_proxmox_vmid(self, nb_vm_obj_proxmox_vmid):
+        return self.netbox_get_vm(nb_vm_obj_proxmox_vmid)['custom_fields']['proxmox_vmid']
 
-            return nb_obj_data['custom_fields']['proxmox_node']
-        except pynetbox.core.query.RequestError as e:
-            raise pynetbox.core.query.RequestError(e)
+
+    def netbox_get_proxmox_node_from_vm_id(self, nb_vm_id=0):
+        return self.netbox_get_vm(nb_vm_id)['custom_fields']['proxmox_node']
     
 
-    def proxmox_job_get_status(self, job_in):
+    def proxmox_job_get_status(self, job_in, timeout=None):
+        if timeout is None:
+            timeout = task_watchers.timeout
+
         try:
-            while True:
-                task_status = self.proxmox_api.nodes(self.proxmox_api_config['node']).tasks(job_in).status.get()
+            # tasks are polled by a shared per-node watcher instead of one busy loop per request
+            with time_task_wait('task') as task_wait:
+                try:
+                    task_status = task_watchers.wait(self.proxmox_api, self.proxmox_api_config['node'], job_in, timeout)
+                except FutureTimeoutError:
+                    task_wait['value'] = 'timeout'
+                    raise
 
-                if self.debug:
-                    print("RAW TASK STATUS", task_status)
+                task_wait['value'] = 'ok' if task_status.get('exitstatus') == 'OK' else 'failed'
 
-                if 'status' in task_status and task_status['status'] == 'stopped':
-                    break
+            if self.debug:
+                print("RAW TASK STATUS", task_status)
+
+            return task_status
+        except FutureTimeoutError:
+            raise ProxmoxTaskTimeoutError(job_in, timeout) from None
         except ResourceException as e:
             raise ResourceException(e)
         
@@ -100,6 +114,56 @@ class NetBoxProxmoxHelper:
         return '.'.join(''.join(ip_address.split('/')[0]).split('.')[0:3]) + f'.{last_quad}'
     
 
+    def proxmox_get_vm_resources(self):
+        return self.proxmox_api.cluster.resources.get(type='vm')
+
+
+    def proxmox_vmid_taken(self, vmid):
+        # cluster/nextid?vmid=N fails when N is in use
+        try:
+            self.proxmox_api.cluster.nextid.get(vmid=vmid)
+            return False
+        except ResourceException:
+            return True
+
+
+    def proxmox_reserve_vmid(self):
+        # a vmid from the listener's allocator (see helpers/vmid_allocator.py) instead of cluster/nextid,
+        # so that parallel clones never get the same one
+        if not vmid_allocator.enabled:
+            return int(self.proxmox_api.cluster.get('nextid'))
+
+        if cluster_inventory.enabled:
+            cluster_inventory.ensure(self.proxmox_get_vm_resources)
+            return vmid_allocator.reserve(cluster_inventory.has_vmid)
+
+        # without the inventory every candidate costs an API call; start at Proxmox's next free vmid
+        return vmid_allocator.reserve(self.proxmox_vmid_taken, start=int(self.proxmox_api.cluster.get('nextid')))
+
+
+    def proxmox_create_with_vmid(self, new_vm_id, create):
+        # create(vmid) starts a clone or create task; returns (vmid, task). Without new_vm_id a vmid
+        # is reserved, and one that turns out to be taken (a guest created outside the listener
+        # since the inventory was refreshed) is skipped
+        if new_vm_id:
+            return new_vm_id, create(new_vm_id)
+
+        for attempt in range(VMID_RESERVE_ATTEMPTS):
+            new_vm_id = self.proxmox_reserve_vmid()
+
+            try:
+                return new_vm_id, create(new_vm_id)
+            except ResourceException as e:
+                if not vmid_allocator.enabled:
+                    raise
+
+                if attempt + 1 < VMID_RESERVE_ATTEMPTS and re.search(r'already\s+exists', str(e.content)):
+                    continue
+
+                vmid_allocator.release(new_vm_id)
+                raise
+
+
     def proxmox_get_vms(self):
         try:
             proxmox_vms = {}
@@ -160,7 +224,42 @@ class NetBoxProxmoxHelperVM(NetBoxProxmoxHelper):
             return 500, {'result': e.content}
         
 
+    def proxmox_plan_clone(self, json_in, requested=None):
+        # linked, full or full-to-local-storage clone (see helpers/clone_strategy.py); the clone is
+        # started on the template's node when the cluster inventory knows it
+        template = int(json_in['data']['custom_fields']['proxmox_vm_templates'])
+        target_node = json_in['data']['custom_fields']['proxmox_node']
+        source_node = self.proxmox_api_config['node']
+
+        if cluster_inventory.enabled:
+            cluster_inventory.ensure(self.proxmox_get_vm_resources)
+            template_guest = cluster_inventory.get_guest(template)
+
+            if template_guest:
+                source_node = template_guest['node']
+
+        # requested: a strategy that overrides the configured one (the warm pool only keeps full clones)
+        requested = requested or clone_strategy.requested_strategy(template, json_in['data'].get('tags'))
+
+        if requested == STRATEGY_FULL:
+            return clone_strategy.plan(requested, {}, {}, source_node, target_node, json_in['data']['custom_fields']['proxmox_vm_storage'])
+
+        template_config = clone_strategy.cached(('template', source_node, template), lambda: self.proxmox_api.nodes(source_node).qemu(template).config.get())
+
+        storage_configs = {
+            storage_id: clone_strategy.cached(('storage', storage_id), lambda storage_id=storage_id: self.proxmox_api.storage(storage_id).get())
+            for storage_id in template_disk_storages(template_config)
+        }
+
+        return clone_strategy.plan(requested, template_config, storage_configs, source_node, target_node, json_in['data']['custom_fields']['proxmox_vm_storage'])
+
+
     def proxmox_check_if_vm_exists(self, vm_name = None):
+        # answered from the in-memory cluster inventory instead of downloading every guest
+        if cluster_inventory.enabled:
+            cluster_inventory.ensure(self.proxmox_get_vm_resources)
+            return cluster_inventory.has_name(vm_name)
+
         vm_exists = False
 
         proxmox_vms = self.proxmox_get_vms()
@@ -197,29 +296,56 @@ class NetBoxProxmoxHelperVM(NetBoxProxmoxHelper):
                     netbox_collected_vms[nbo_settings['name']]['tenant'].append(nbo_settings['tenant'])
 
             if json_in['data']['tenant'] not in netbox_collected_vms[json_in['data']['name']]['tenant'] or not self.proxmox_check_if_vm_exists(json_in['data']['name']):
+                new_vm_id = None
+                reserve_vm_id = False
+
                 try:
                     if 'data' in json_in and 'custom_fields' in json_in['data'] and 'proxmox_vmid' in json_in['data']['custom_fields'] and json_in['data']['custom_fields']['proxmox_vmid']:
                         self.proxmox_api.nodes(self.proxmox_api_config['node']).qemu(int(json_in['data']['custom_fields']['proxmox_vmid'])).config.get()
                     else:
-                        new_vm_id = self.proxmox_api.cluster.get('nextid')
+                        reserve_vm_id = True
                 except ResourceException as e:
                     if re.search(r'does\s+not\s+exist$', e.content):                
                         new_vm_id = int(json_in['data']['custom_fields']['proxmox_vmid'])
                     else:
                         return 500, {'result': e.content}
                 
-                if not new_vm_id:
+                if not new_vm_id and not reserve_vm_id:
                     raise ValueError(f"Unable to create VM id for {json_in['data']['name']}")
 
-                clone_data = self.proxmox_api.nodes(self.proxmox_api_config['node']).qemu(int(json_in['data']['custom_fields']['proxmox_vm_templates'])).clone.post(
-                    newid=new_vm_id,
-                    full=1,
-                    name=json_in['data']['name'],
-                    storage=json_in['data']['custom_fields']['proxmox_vm_storage'],
-                    target=json_in['data']['custom_fields']['proxmox_node']
-                )
+                # a pre-cloned VM from the warm pool, renamed, saves the full clone
+                pooled_vm_id = None
 
-                self.proxmox_job_get_status(clone_data)
+                if reserve_vm_id:
+                    pooled_vm_id = warm_pool.claim(self, int(json_in['data']['custom_fields']['proxmox_vm_templates']), json_in['data']['custom_fields']['proxmox_node'], json_in['data']['custom_fields']['proxmox_vm_storage'], json_in['data']['name'])
+
+                if pooled_vm_id:
+                    new_vm_id = pooled_vm_id
+                else:
+                    clone_plan = self.proxmox_plan_clone(json_in)
+
+                    if self.debug:
+                        print("CLONE PLAN", clone_plan.to_dict())
+
+                    with time_clone(clone_plan.strategy) as clone_timing:
+                        new_vm_id, clone_data = self.proxmox_create_with_vmid(new_vm_id, lambda vmid: self.proxmox_api.nodes(clone_plan.source_node).qemu(int(json_in['data']['custom_fields']['proxmox_vm_templates'])).clone.post(
+                            newid=vmid,
+                            name=json_in['data']['name'],
+                            target=json_in['data']['custom_fields']['proxmox_node'],
+                            **clone_plan.clone_args()
+                        ))
+
+                        clone_status = self.proxmox_job_get_status(clone_data)
+                        clone_timing['value'] = 'ok' if clone_status.get('exitstatus') == 'OK' else 'failed'
+
+                    if clone_status.get('exitstatus') != 'OK':
+                        # the clone failed: hand the vmid out again, and leave NetBox alone
+                        if reserve_vm_id:
+                            vmid_allocator.release(new_vm_id)
+
+                        return 500, {'result': f"Clone of {json_in['data']['name']} (vmid: {new_vm_id}) failed: {clone_status.get('exitstatus')}"}
+
+                    cluster_inventory.add_guest(new_vm_id, json_in['data']['name'], json_in['data']['custom_fields']['proxmox_node'], 'qemu')
 
                 # set vmid in NetBox
                 try:
@@ -233,6 +359,7 @@ class NetBoxProxmoxHelperVM(NetBoxProxmoxHelper):
                     if nb_obj_update_vmid:
                         nb_obj_update_vmid['custom_fields']['proxmox_vmid'] = new_vm_id
                         nb_obj_update_vmid.save()
+                        netbox_vm_cache.invalidate(nb_obj_update_vmid['id'])
                 except pynetbox.core.query.RequestError as e:
                     raise pynetbox.core.query.RequestError(e)
                 
@@ -270,6 +397,40 @@ class NetBoxProxmoxHelperVM(NetBoxProxmoxHelper):
         return 500, {'result': f"Unable to update vcpus (json_in['snapshots']['postchange']['vcpus']) and/or memory (json_in['snapshots']['postchange']['memory']) for {json_in['data']['custom_fields']['proxmox_vmid']}"}
 
 
+    def proxmox_update_vm_config(self, json_in):
+        # vcpus/memory, ipconfig0 and SSH key: only the keys that differ from the VM's current
+        # config, in a single config change (and a single task wait), with a result per field
+        try:
+            if not json_in['data']['custom_fields']['proxmox_vmid']:
+                return 500, {'result': "Missing value for 'proxmox_vmid'"}
+
+            vm_config = desired_vm_config(json_in, self.generate_gateway_from_ip_address)
+
+            if not vm_config:
+                return 500, {'result': f"Nothing to update for VM {json_in['data']['custom_fields']['proxmox_vmid']}"}
+
+            proxmox_vm = self.proxmox_api.nodes(json_in['data']['custom_fields']['proxmox_node']).qemu(json_in['data']['custom_fields']['proxmox_vmid'])
+
+            changes, fields = vm_config_changes(vm_config, proxmox_vm.config.get())
+
+            if not changes:
+                return 200, {'result': f"Nothing changed for VM {json_in['data']['custom_fields']['proxmox_vmid']}", 'fields': fields}
+
+            try:
+                update_vm_config = proxmox_vm.config.post(**changes)
+            except ResourceException as e:
+                return 500, {'result': e.content, 'fields': vm_config_failed(fields)}
+
+            task_status = self.proxmox_job_get_status(update_vm_config)
+
+            if task_status.get('exitstatus') != 'OK':
+                return 500, {'result': f"Updating {', '.join(changes)} for VM {json_in['data']['custom_fields']['proxmox_vmid']} failed: {task_status.get('exitstatus')}", 'fields': vm_config_failed(fields)}
+
+            return 200, {'result': f"Updated {', '.join(changes)} for VM {json_in['data']['custom_fields']['proxmox_vmid']}", 'fields': fields}
+        except ResourceException as e:
+            return 500, {'result': e.content}
+
+
     def proxmox_start_vm(self, json_in):
         try:
             self.json_data_check_proxmox_vmid_exists(json_in)
@@ -304,7 +465,8 @@ class NetBoxProxmoxHelperVM(NetBoxProxmoxHelper):
 
             delete_data = self.proxmox_api.nodes(json_in['data']['custom_fields']['proxmox_node']).qemu(json_in['data']['custom_fields']['proxmox_vmid']).delete()
 
-            self.proxmox_job_get_status(delete_data)
+            if self.proxmox_job_get_status(delete_data).get('exitstatus') == 'OK':
+                cluster_inventory.remove_guest(json_in['data']['custom_fields']['proxmox_vmid'])
 
             return 200, {'result': f"VM {json_in['data']['custom_fields']['proxmox_vmid']} deleted successfully"}
         except ResourceException as e:
@@ -403,6 +565,59 @@ class NetBoxProxmoxHelperVM(NetBoxProxmoxHelper):
             return 500, {'result': e.content}
 
 
+    def proxmox_apply_disk_batch(self, json_in):
+        # disk webhooks for one VM (see helpers/disk_batch.py): disks are deleted with one unlink
+        # call and added with one config change, resizes are done one disk at a time
+        proxmox_vmid = self.netbox_get_proxmox_vmid(json_in['data']['virtual_machine']['id'])
+        proxmox_vm = self.proxmox_api.nodes(self.proxmox_api_config['node']).qemu(proxmox_vmid)
+
+        disks = fold_disk_events(disk_batch_events(json_in))
+        results = {name: DISK_UNCHANGED for name, disk in disks.items() if disk[0] is None}
+        errors = {}
+
+        deleted_disks = [name for name, disk in disks.items() if disk[0] in (DISK_OP_DELETE, DISK_OP_REPLACE)]
+
+        if 'scsi0' in deleted_disks:
+            deleted_disks.remove('scsi0')
+            results['scsi0'] = DISK_FAILED
+            errors['scsi0'] = "Cannot delete VM OS disk"
+
+        if deleted_disks:
+            try:
+                proxmox_vm.unlink.put(idlist=','.join(deleted_disks), force=1)
+                results.update({name: DISK_DELETED for name in deleted_disks})
+            except ResourceException as e:
+                results.update({name: DISK_FAILED for name in deleted_disks})
+                errors.update({name: e.content for name in deleted_disks})
+
+        # a replaced disk is only added back once it has been deleted
+        added_disks = {name: disk_config_value(disk[1]) for name, disk in disks.items() if disk[0] == DISK_OP_ADD or (disk[0] == DISK_OP_REPLACE and results.get(name) == DISK_DELETED)}
+
+        if added_disks:
+            try:
+                add_status = self.proxmox_job_get_status(proxmox_vm.config.post(**added_disks))
+
+                if add_status.get('exitstatus') == 'OK':
+                    results.update({name: DISK_ADDED for name in added_disks})
+                else:
+                    results.update({name: DISK_FAILED for name in added_disks})
+                    errors.update({name: add_status.get('exitstatus') for name in added_disks})
+            except ResourceException as e:
+                results.update({name: DISK_FAILED for name in added_disks})
+                errors.update({name: e.content for name in added_disks})
+
+        for name, (operation, disk_data) in disks.items():
+            if operation == DISK_OP_RESIZE:
+                try:
+                    self.proxmox_job_get_status(proxmox_vm.resize.put(disk=name, size=disk_size(disk_data)))
+                    results[name] = DISK_RESIZED
+                except ResourceException as e:
+                    results[name] = DISK_FAILED
+                    errors[name] = e.content
+
+        return disk_batch_results(proxmox_vmid, results, errors)
+
+
 class NetBoxProxmoxHelperLXC(NetBoxProxmoxHelper):
     def __proxmox_update_lxc_vcpus_and_memory(self, proxmox_node=None, vmid=1, vcpus=1, memory=512):
         try:
@@ -422,6 +637,9 @@ class NetBoxProxmoxHelperLXC(NetBoxProxmoxHelper):
         try:
             # json_in['data']['name']
             # json_in['data']['custom_fields']['proxmox_lxc_template']
+            new_vm_id = None
+            reserve_vm_id = False
+
             try:
                 if self.debug:
                     print("JSON IN", json_in['data'])
@@ -429,7 +647,7 @@ class NetBoxProxmoxHelperLXC(NetBoxProxmoxHelper):
                 if 'data' in json_in and 'custom_fields' in json_in['data'] and 'proxmox_vmid' in json_in['data']['custom_fields'] and json_in['data']['custom_fields']['proxmox_vmid']:
                     self.proxmox_api.nodes(json_in['data']['custom_fields']['proxmox_node']).qemu(json_in['data']['custom_fields']['proxmox_vmid']).config.get()
                 else:
-                    new_vm_id = self.proxmox_api.cluster.get('nextid')
+                    reserve_vm_id = True
             except ResourceException as e:
                 if re.search(r'does\s+not\s+exist$', e.content):
                     if self.debug:
@@ -439,11 +657,10 @@ class NetBoxProxmoxHelperLXC(NetBoxProxmoxHelper):
                 else:
                     return 500, {'result': e.content}
             
-            if not new_vm_id:
+            if not new_vm_id and not reserve_vm_id:
                 return 500, {'result': f"Unable to create LXC id for {json_in['data']['name']}"}
 
             lxc_create_data = {
-                'vmid': new_vm_id,
                 'hostname': json_in['data']['name'],
                 'ostemplate': json_in['data']['custom_fields']['proxmox_lxc_templates'],
                 'cores': int(json_in['data']['vcpus']),
@@ -463,9 +680,18 @@ class NetBoxProxmoxHelperLXC(NetBoxProxmoxHelper):
             if self.debug:
                 print("LXC CREATE DATA", lxc_create_data, new_vm_id)
 
-            create_lxc_data = self.proxmox_api.nodes(json_in['data']['custom_fields']['proxmox_node']).lxc.create(**lxc_create_data)
+            new_vm_id, create_lxc_data = self.proxmox_create_with_vmid(new_vm_id, lambda vmid: self.proxmox_api.nodes(json_in['data']['custom_fields']['proxmox_node']).lxc.create(vmid=vmid, **lxc_create_data))
+
+            create_lxc_status = self.proxmox_job_get_status(create_lxc_data)
+
+            if create_lxc_status.get('exitstatus') != 'OK':
+                # see proxmox_clone_vm
+                if reserve_vm_id:
+                    vmid_allocator.release(new_vm_id)
 
-            self.proxmox_job_get_status(create_lxc_data)
+                return 500, {'result': f"Creating LXC {json_in['data']['name']} (vmid: {new_vm_id}) failed: {create_lxc_status.get('exitstatus')}"}
+
+            cluster_inventory.add_guest(new_vm_id, json_in['data']['name'], json_in['data']['custom_fields']['proxmox_node'], 'lxc')
 
             try:
                 nb_obj_update_vmid = self.netbox_api.virtualization.virtual_machines.get(name=json_in['data']['name'])
@@ -480,6 +706,7 @@ class NetBoxProxmoxHelperLXC(NetBoxProxmoxHelper):
 
                 nb_obj_update_vmid['custom_fields']['proxmox_vmid'] = new_vm_id
                 nb_obj_update_vmid.save()
+                netbox_vm_cache.invalidate(netbox_vm_obj_id)
 
                 """
                 'rootfs': 'local-lvm:vm-104-disk-0,size=4G'}
@@ -588,7 +815,8 @@ class NetBoxProxmoxHelperLXC(NetBoxProxmoxHelper):
 
             delete_data = self.proxmox_api.nodes(json_in['data']['custom_fields']['proxmox_node']).lxc.delete(json_in['data']['custom_fields']['proxmox_vmid'])
 
-            self.proxmox_job_get_status(delete_data)
+            if self.proxmox_job_get_status(delete_data).get('exitstatus') == 'OK':
+                cluster_inventory.remove_guest(json_in['data']['custom_fields']['proxmox_vmid'])
 
             return 200, {'result': f"LXC (vmid: {json_in['data']['custom_fields']['proxmox_vmid']}) has been deleted"}
         except ResourceException as e:
@@ -596,35 +824,71 @@ class NetBoxProxmoxHelperLXC(NetBoxProxmoxHelper):
 
 
 class NetBoxProxmoxHelperMigrate(NetBoxProxmoxHelper):
-    def __init__(self, cfg_data, proxmox_node, debug=False):
-        super().__init__(cfg_data, proxmox_node, debug)
+    def __init__(self, cfg_data, proxmox_node, debug=False, client_registry=None):
+        super().__init__(cfg_data, proxmox_node, debug, client_registry)
+
+        # cluster name, nodes and guests are only looked up when first used: a migration
+        # itself needs none of them
+        self._proxmox_cluster_name = None
+        self._proxmox_nodes = None
+        self._proxmox_vms = None
+        self._proxmox_lxc = None
+
+
+    @property
+    def proxmox_cluster_name(self):
+        if self._proxmox_nodes is None:
+            self.__get_cluster_name_and_nodes()
+
+        return self._proxmox_cluster_name
 
-        self.proxmox_cluster_name = 'default-proxmox-cluster-name'
-        self.proxmox_nodes = {}
-        self.proxmox_vms = {}
-        self.proxmox_lxc = {}
 
-        self.__get_cluster_name_and_nodes()
-        self.__get_proxmox_vms()
-        self.__get_proxmox_lxcs()
+    @property
+    def proxmox_nodes(self):
+        if self._proxmox_nodes is None:
+            self.__get_cluster_name_and_nodes()
+
+        return self._proxmox_nodes
+
+
+    @property
+    def proxmox_vms(self):
+        if self._proxmox_vms is None:
+            self._proxmox_vms = self.__get_proxmox_guests('qemu')
+
+        return self._proxmox_vms
+
+
+    @property
+    def proxmox_lxc(self):
+        if self._proxmox_lxc is None:
+            self._proxmox_lxc = self.__get_proxmox_guests('lxc')
+
+        return self._proxmox_lxc
 
 
     def __get_cluster_name_and_nodes(self):
         try:
             cluster_status = self.proxmox_api.cluster.status.get()
 
+            proxmox_cluster_name = 'default-proxmox-cluster-name'
+            proxmox_nodes = {}
+
             for resource in cluster_status:
                 if not 'type' in resource:
                     raise ValueError(f"Missing 'type' in Proxmox cluster resource {resource}")
                 
                 if resource['type'] == 'cluster':
-                    self.proxmox_cluster_name = resource['name']
+                    proxmox_cluster_name = resource['name']
                 elif resource['type'] == 'node':
-                    if not resource['name'] in self.proxmox_nodes:
-                        self.proxmox_nodes[resource['name']] = {}
+                    if not resource['name'] in proxmox_nodes:
+                        proxmox_nodes[resource['name']] = {}
+
+                    proxmox_nodes[resource['name']]['ip'] = resource['ip']
+                    proxmox_nodes[resource['name']]['online'] = resource['online']
 
-                    self.proxmox_nodes[resource['name']]['ip'] = resource['ip']
-                    self.proxmox_nodes[resource['name']]['online'] = resource['online']
+            self._proxmox_cluster_name = proxmox_cluster_name
+            self._proxmox_nodes = proxmox_nodes
         except ResourceException as e:
             raise RuntimeError(f"Proxmox API error: {e}") from e
         except requests.exceptions.ConnectionError:
@@ -632,43 +896,44 @@ class NetBoxProxmoxHelperMigrate(NetBoxProxmoxHelper):
         except requests.exceptions.HTTPError as e:
             status = e.response.status_code
             raise RuntimeError(f"HTTP {status}: {e.response.text}") from e
-        
 
-    def __get_proxmox_vms(self):
+
+    def __get_proxmox_guests(self, proxmox_type):
+        # {name: {'vmid': ..., 'node': ...}} for every qemu or lxc guest that is not a template
+        proxmox_guests = {}
+
         try:
-            for proxmox_node in self.proxmox_nodes:
-                all_vm_settings = self.proxmox_api.nodes(proxmox_node).get('qemu')
-                for vm_setting in all_vm_settings:
-                    if 'template' in vm_setting and vm_setting['template'] == 1:
-                        continue
+            if cluster_inventory.enabled:
+                # one cluster-wide listing, shared with (and usually already loaded by) the listener
+                cluster_inventory.ensure(self.proxmox_get_vm_resources)
 
-                    if not vm_setting['name'] in self.proxmox_vms:
-                        self.proxmox_vms[vm_setting['name']] = {}
+                for guest in sorted(cluster_inventory.get_guests(proxmox_type), key=lambda guest: guest['vmid']):
+                    if not guest['template'] and guest['name']:
+                        proxmox_guests[guest['name']] = {'vmid': guest['vmid'], 'node': guest['node']}
 
-                    self.proxmox_vms[vm_setting['name']]['vmid'] = vm_setting['vmid']
-                    self.proxmox_vms[vm_setting['name']]['node'] = proxmox_node
-        except ResourceException as e:
-            raise RuntimeError(f"Proxmox API error: {e}") from e
-        except requests.exceptions.ConnectionError:
-            raise RuntimeError("Failed to connect to Proxmox API")
-        except requests.exceptions.HTTPError as e:
-            status = e.response.status_code
-            raise RuntimeError(f"HTTP {status}: {e.response.text}") from e
+                return proxmox_guests
 
+            proxmox_nodes = list(self.proxmox_nodes)
 
-    def __get_proxmox_lxcs(self):
-        try:
-            for proxmox_node in self.proxmox_nodes:
-                all_lxc_settings = self.proxmox_api.nodes(proxmox_node).get('lxc')
-                for lxc_setting in all_lxc_settings:
-                    if 'template' in lxc_setting and lxc_setting['template'] == 1:
-                        continue
+            if not proxmox_nodes:
+                return proxmox_guests
+
+            # one request per node, all nodes at once
+            with ThreadPoolExecutor(max_workers=min(len(proxmox_nodes), MAX_PARALLEL_NODE_REQUESTS)) as executor:
+                node_guests = executor.map(lambda proxmox_node: self.proxmox_api.nodes(proxmox_node).get(proxmox_type), proxmox_nodes)
+
+                for proxmox_node, all_guest_settings in zip(proxmox_nodes, node_guests):
+                    for guest_setting in all_guest_settings:
+                        if 'template' in guest_setting and guest_setting['template'] == 1:
+                            continue
 
-                    if not lxc_setting['name'] in self.proxmox_lxc:
-                        self.proxmox_lxc[lxc_setting['name']] = {}
+                        if not guest_setting['name'] in proxmox_guests:
+                            proxmox_guests[guest_setting['name']] = {}
 
-                    self.proxmox_lxc[lxc_setting['name']]['vmid'] = lxc_setting['vmid']
-                    self.proxmox_lxc[lxc_setting['name']]['node'] = proxmox_node
+                        proxmox_guests[guest_setting['name']]['vmid'] = guest_setting['vmid']
+                        proxmox_guests[guest_setting['name']]['node'] = proxmox_node
+
+            return proxmox_guests
         except ResourceException as e:
             raise RuntimeError(f"Proxmox API error: {e}") from e
         except requests.exceptions.ConnectionError:
@@ -680,22 +945,21 @@ class NetBoxProxmoxHelperMigrate(NetBoxProxmoxHelper):
 
     def __wait_for_migration_task(self, proxmox_node: str, proxmox_task_id: int):
         try:
-            start_time = int(time.time())
-
-            while True:
-                current_time = int(time.time())
-                elapsed_seconds = current_time - start_time
+            with time_task_wait('migration') as task_wait:
+                try:
+                    task_status = task_watchers.wait(self.proxmox_api, proxmox_node, proxmox_task_id, 600) # 10 minutes
+                except FutureTimeoutError:
+                    task_wait['value'] = 'timeout'
+                    raise
 
-                if elapsed_seconds >= 600: # 10 minutes
-                    return 500, {'content': f"Unable to complete task {proxmox_task_id} in defined time"}
-                
-                task_status = self.proxmox_api.nodes(proxmox_node).tasks(proxmox_task_id).status.get()
+                task_wait['value'] = 'ok' if task_status.get('exitstatus') == 'OK' else 'failed'
 
-                if task_status['status'] == 'stopped':
-                    if 'exitstatus' in task_status and task_status['exitstatus'] == 'OK':
-                        return 200, {'result': "Proxmox node migration successful"}
-                    else:
-                        return 500, {'result': f"Task {proxmox_task_id} is stopped but exit status does not appear to be successful: {task_status['exit_status']}"}
+            if 'exitstatus' in task_status and task_status['exitstatus'] == 'OK':
+                return 200, {'result': "Proxmox node migration successful"}
+            else:
+                return 500, {'result': f"Task {proxmox_task_id} is stopped but exit status does not appear to be successful: {task_status.get('exitstatus')}"}
+        except FutureTimeoutError:
+            return 500, {'content': f"Unable to complete task {proxmox_task_id} in defined time"}
         except ResourceException as e:
             logging.error(f"Proxmox API ResourceException: {e}")
             return 500, {'content': "Proxmox API error occurred."}
@@ -708,6 +972,26 @@ class NetBoxProxmoxHelperMigrate(NetBoxProxmoxHelper):
             return 500, {'content': f"Proxmox API HTTP error occurred (code {status})."}
 
 
+    def __guest_node(self, proxmox_vmid: int):
+        # where Proxmox says the guest is now, whatever the inventory thinks
+        for guest in self.proxmox_get_vm_resources():
+            if str(guest.get('vmid')) == str(proxmox_vmid):
+                return guest.get('node')
+
+        return None
+
+
+    def __already_migrated(self, proxmox_vmid: int, proxmox_target_node: str):
+        # a refused migration may be for a guest that another process (e.g. bulk_migrate.py)
+        # has already moved, which the listener's inventory does not know about yet
+        if self.__guest_node(proxmox_vmid) != proxmox_target_node:
+            return False
+
+        cluster_inventory.move_guest(proxmox_vmid, proxmox_target_node)
+
+        return True
+
+
     def migrate_vm(self, proxmox_vmid: int, proxmox_node: str, proxmox_target_node: str):
         migrate_vm_data = {
             'target': proxmox_target_node,
@@ -715,8 +999,27 @@ class NetBoxProxmoxHelperMigrate(NetBoxProxmoxHelper):
         }
 
         try:
-            migrate_vm_task_id = self.proxmox_api.nodes(proxmox_node).qemu(proxmox_vmid).migrate.post(**migrate_vm_data)
-            return self.__wait_for_migration_task(proxmox_node, migrate_vm_task_id)
+            # e.g. the webhook for the proxmox_node update that a bulk migration made in NetBox
+            if cluster_inventory.enabled:
+                cluster_inventory.ensure(self.proxmox_get_vm_resources)
+
+                if (cluster_inventory.get_guest(proxmox_vmid) or {}).get('node') == proxmox_target_node:
+                    return 200, {'result': f"Guest {proxmox_vmid} is already on node {proxmox_target_node}"}
+
+            try:
+                migrate_vm_task_id = self.proxmox_api.nodes(proxmox_node).qemu(proxmox_vmid).migrate.post(**migrate_vm_data)
+            except ResourceException:
+                if self.__already_migrated(proxmox_vmid, proxmox_target_node):
+                    return 200, {'result': f"Guest {proxmox_vmid} is already on node {proxmox_target_node}"}
+
+                raise
+
+            migrate_results = self.__wait_for_migration_task(proxmox_node, migrate_vm_task_id)
+
+            if migrate_results[0] == 200:
+                cluster_inventory.move_guest(proxmox_vmid, proxmox_target_node)
+
+            return migrate_results
         except ResourceException as e:
             logging.error(f"Proxmox API ResourceException: {e}")
             return 500, {'result': "Proxmox API error occurred."}
@@ -736,8 +1039,17 @@ class NetBoxProxmoxHelperMigrate(NetBoxProxmoxHelper):
         }
 
         try:
-            migrate_lxc_task_id = self.proxmox_api.nodes(proxmox_node).lxc(proxmox_vmid).migrate.post(**migrate_lxc_data)
-            self.__wait_for_migration_task(proxmox_node, migrate_lxc_task_id)
+            try:
+                migrate_lxc_task_id = self.proxmox_api.nodes(proxmox_node).lxc(proxmox_vmid).migrate.post(**migrate_lxc_data)
+            except ResourceException:
+                if self.__already_migrated(proxmox_vmid, proxmox_target_node):
+                    return 200, {'result': f"Guest {proxmox_vmid} is already on node {proxmox_target_node}"}
+
+                raise
+
+            if self.__wait_for_migration_task(proxmox_node, migrate_lxc_task_id)[0] == 200:
+                cluster_inventory.move_guest(proxmox_vmid, proxmox_target_node)
+
             return 200, {'result': f"LXC (vmid: {proxmox_vmid}) has been migrated to node {proxmox_target_node}"}
         except ResourceException as e:
             logging.error(f"Proxmox API ResourceException: {e}")
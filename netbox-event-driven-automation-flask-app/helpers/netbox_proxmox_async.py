@@ -0,0 +1,951 @@
+import asyncio
+import aiohttp
+import logging
+import re
+import time
+
+from helpers.cluster_inventory import cluster_inventory
+from helpers.disk_batch import disk_batch_events, disk_batch_results, disk_config_value, disk_size, fold_disk_events, DISK_ADDED, DISK_DELETED, DISK_FAILED, DISK_OP_ADD, DISK_OP_DELETE, DISK_OP_REPLACE, DISK_OP_RESIZE, DISK_RESIZED, DISK_UNCHANGED
+from helpers.clone_strategy import clone_strategy, template_disk_storages, STRATEGY_FULL
+from helpers.metrics import record_api_call, time_clone, time_task_wait
+from helpers.netbox_cache import netbox_vm_cache
+from helpers.node_routing import node_routes, url_node
+from helpers.transport import transport
+from helpers.task_watcher import proxmox_node_from_upid, proxmox_starttime_from_upid, task_watchers, ProxmoxTaskTimeoutError, DEFAULT_MIN_INTERVAL, DEFAULT_MAX_INTERVAL, DEFAULT_BACKOFF, DEFAULT_MAX_ERRORS, TASK_LIST_LIMIT
+from helpers.vm_config import desired_vm_config, vm_config_changes, vm_config_failed
+from helpers.vmid_allocator import vmid_allocator, VMID_RESERVE_ATTEMPTS
+from helpers.warm_pool import warm_pool
+from proxmoxer import ResourceException
+
+
+# connection problems and timeouts, as opposed to errors that the backend answered with
+TRANSIENT_ERRORS = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+# the connection could not be made, so nothing was sent
+CONNECT_ERRORS = (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError)
+
+
+def transport_client_timeout():
+    connect_timeout, read_timeout = transport.timeout()
+
+    return aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+
+
+class AsyncNetBoxError(Exception):
+    def __init__(self, status_code, content):
+        super().__init__(f"NetBox API error {status_code}: {content}")
+        self.status_code = status_code
+        self.content = content
+
+
+class AsyncProxmoxAPI:
+    def __init__(self, proxmox_api_config, session):
+        self.session = session
+        self.base_url = f"{proxmox_api_config.get('api_proto', 'https')}://{proxmox_api_config['api_host']}:{proxmox_api_config['api_port']}/api2/json"
+        self.headers = {
+            'Authorization': f"PVEAPIToken={proxmox_api_config['api_user']}!{proxmox_api_config['api_token_id']}={proxmox_api_config['api_token_secret']}"
+        }
+
+        self.watchers = {}
+
+
+    async def request(self, method, path, **data):
+        data = {k: int(v) if isinstance(v, bool) else v for k, v in data.items() if v is not None}
+        request_args = {'params': data} if method in ('GET', 'DELETE') else {'data': data}
+
+        url = f"{self.base_url}/{path}"
+
+        # timeouts, retries and circuit breakers come from helpers/transport.py
+        return await transport.send_async('proxmox', method, url, lambda: self.__send(method, url, request_args), TRANSIENT_ERRORS)
+
+
+    async def __send(self, method, url, request_args):
+        # node-scoped calls can go straight to the node (helpers/node_routing.py)
+        if node_routes.enabled and url_node(url):
+            await node_routes.ensure_async(lambda: self.get('cluster/status'))
+            direct_url = node_routes.direct_url(url)
+
+            if direct_url:
+                try:
+                    return await self.__send_to(method, direct_url, request_args)
+                except CONNECT_ERRORS as e:
+                    node_routes.mark_unreachable(url, e)
+
+        return await self.__send_to(method, url, request_args)
+
+
+    async def __send_to(self, method, url, request_args):
+        start_time = time.monotonic()
+
+        async with self.session.request(method, url, headers=self.headers, ssl=False, timeout=transport_client_timeout(), **request_args) as resp:
+            record_api_call('proxmox', method, str(resp.url), resp.status, time.monotonic() - start_time)
+
+            if resp.status >= 400:
+                content = await resp.text()
+                errors = None
+
+                try:
+                    errors = (await resp.json(content_type=None) or {}).get('errors')
+                except ValueError:
+                    pass
+
+                raise ResourceException(resp.status, resp.reason, content, errors)
+
+            return (await resp.json(content_type=None) or {}).get('data')
+
+
+    async def get(self, path, **params):
+        return await self.request('GET', path, **params)
+
+
+    async def post(self, path, **data):
+        return await self.request('POST', path, **data)
+
+
+    async def put(self, path, **data):
+        return await self.request('PUT', path, **data)
+
+
+    async def delete(self, path, **params):
+        return await self.request('DELETE', path, **params)
+
+
+    async def wait_for_task(self, proxmox_node, upid, timeout=None, kind='task'):
+        # Proxmox returns no UPID for operations that completed synchronously
+        if not upid:
+            return {'upid': upid, 'status': 'stopped', 'exitstatus': 'OK'}
+
+        proxmox_node = proxmox_node_from_upid(upid, proxmox_node)
+
+        if proxmox_node not in self.watchers:
+            self.watchers[proxmox_node] = AsyncProxmoxNodeTaskWatcher(self, proxmox_node, **task_watchers.settings)
+
+        with time_task_wait(kind) as task_wait:
+            try:
+                task_status = await asyncio.wait_for(self.watchers[proxmox_node].watch(upid), timeout)
+            except asyncio.TimeoutError:
+                task_wait['value'] = 'timeout'
+                raise
+
+            task_wait['value'] = 'ok' if task_status.get('exitstatus') == 'OK' else 'failed'
+
+        return task_status
+
+
+class AsyncProxmoxNodeTaskWatcher:
+    def __init__(self, proxmox_api, proxmox_node, min_interval=DEFAULT_MIN_INTERVAL, max_interval=DEFAULT_MAX_INTERVAL, backoff=DEFAULT_BACKOFF, max_errors=DEFAULT_MAX_ERRORS):
+        self.proxmox_api = proxmox_api
+        self.proxmox_node = proxmox_node
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        # consecutive failed task listings before the waiters are failed
+        self.max_errors = max_errors
+
+        self._pending = {}
+        self._errors = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+
+    def watch(self, upid):
+        future = asyncio.get_running_loop().create_future()
+        idle = not self._pending
+        self._pending.setdefault(upid, []).append(future)
+
+        # a busy watcher picks the task up on its next poll, so that a burst of tasks does
+        # not cause a burst of task listings
+        if idle:
+            self._wakeup.set()
+
+        if not self._task or self._task.done():
+            self._task = asyncio.create_task(self.__run())
+
+        return asyncio.shield(future)
+
+
+    async def __list_finished_tasks(self, upids):
+        finished = {}
+        failed = {}
+
+        since = [proxmox_starttime_from_upid(upid) for upid in upids]
+        since = [starttime for starttime in since if starttime is not None]
+
+        task_list_params = {'source': 'all', 'limit': TASK_LIST_LIMIT}
+
+        if since:
+            task_list_params['since'] = min(since)
+
+        seen = set()
+
+        for task in await self.proxmox_api.get(f"nodes/{self.proxmox_node}/tasks", **task_list_params) or []:
+            seen.add(task.get('upid'))
+
+            if task.get('upid') in upids and task.get('endtime'):
+                finished[task['upid']] = {
+                    'upid': task['upid'],
+                    'node': self.proxmox_node,
+                    'status': 'stopped',
+                    'exitstatus': task.get('status'),
+                    'starttime': task.get('starttime'),
+                    'endtime': task.get('endtime')
+                }
+
+        # tasks that fell outside the listing window are checked one at a time
+        for upid in upids - seen:
+            try:
+                task_status = await self.proxmox_api.get(f"nodes/{self.proxmox_node}/tasks/{upid}/status")
+            except Exception as e:
+                failed[upid] = e
+                continue
+
+            if task_status and task_status.get('status') == 'stopped':
+                finished[upid] = task_status
+
+        return finished, failed
+
+
+    async def __run(self):
+        interval = self.min_interval
+
+        while self._pending:
+            upids = set(self._pending)
+
+            try:
+                finished, failed = await self.__list_finished_tasks(upids)
+                self._errors = 0
+            except Exception as e:
+                self._errors += 1
+                logging.error(f"Proxmox task watcher for node {self.proxmox_node} failed to list tasks: {e}")
+
+                if self._errors >= self.max_errors:
+                    for upid in upids:
+                        for future in self._pending.pop(upid, []):
+                            if not future.done():
+                                future.set_exception(e)
+
+                    self._errors = 0
+
+                finished, failed = {}, {}
+
+            for upid, task_status in finished.items():
+                for future in self._pending.pop(upid, []):
+                    if not future.done():
+                        future.set_result(task_status)
+
+            for upid, e in failed.items():
+                for future in self._pending.pop(upid, []):
+                    if not future.done():
+                        future.set_exception(e)
+
+            interval = self.min_interval if finished else min(self.max_interval, interval * self.backoff)
+
+            if self._pending:
+                self._wakeup.clear()
+
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), interval)
+                    interval = self.min_interval
+                except asyncio.TimeoutError:
+                    pass
+
+
+class AsyncNetBoxAPI:
+    def __init__(self, netbox_api_config, session):
+        self.session = session
+        self.base_url = f"{netbox_api_config['api_proto']}://{netbox_api_config['api_host']}:{netbox_api_config['api_port']}/api"
+        self.ssl = None if netbox_api_config['verify_ssl'] else False
+        self.headers = {
+            'Authorization': f"Token {netbox_api_config['api_token']}",
+            'Accept': 'application/json'
+        }
+
+
+    async def request(self, method, path, params=None, json_data=None):
+        return await transport.send_async('netbox', method, f"{self.base_url}/{path}", lambda: self.__send(method, path, params, json_data), TRANSIENT_ERRORS)
+
+
+    async def __send(self, method, path, params, json_data):
+        start_time = time.monotonic()
+
+        async with self.session.request(method, f"{self.base_url}/{path}", headers=self.headers, params=params, json=json_data, ssl=self.ssl, timeout=transport_client_timeout()) as resp:
+            record_api_call('netbox', method, str(resp.url), resp.status, time.monotonic() - start_time)
+
+            if resp.status == 404 and method == 'GET':
+                return None
+
+            if resp.status >= 400:
+                raise AsyncNetBoxError(resp.status, await resp.text())
+
+            return await resp.json(content_type=None)
+
+
+    async def get_virtual_machine(self, nb_vm_id):
+        return await self.request('GET', f"virtualization/virtual-machines/{nb_vm_id}/")
+
+
+    async def filter_virtual_machines(self, **params):
+        nb_vms = await self.request('GET', 'virtualization/virtual-machines/', params=params)
+
+        return nb_vms['results'] if nb_vms else []
+
+
+    async def update_virtual_machine(self, nb_vm_id, nb_vm_data):
+        nb_vm = await self.request('PATCH', f"virtualization/virtual-machines/{nb_vm_id}/", json_data=nb_vm_data)
+        netbox_vm_cache.invalidate(nb_vm_id)
+
+        return nb_vm
+
+
+    async def create_virtual_disk(self, nb_disk_data):
+        return await self.request('POST', 'virtualization/virtual-disks/', json_data=nb_disk_data)
+
+
+class AsyncNetBoxProxmoxHelper:
+    def __init__(self, cfg_data, proxmox_node, proxmox_api, netbox_api, debug=False):
+        self.debug = debug
+        self.cfg_data = cfg_data
+        self.proxmox_node = proxmox_node
+        self.proxmox_api = proxmox_api
+        self.netbox_api = netbox_api
+
+
+    def json_data_check_proxmox_vmid_exists(self, json_in):
+        if not json_in['data']['custom_fields']['proxmox_vmid']:
+            raise ValueError("Missing value for 'proxmox_vmid'")
+
+
+    async def netbox_get_vm(self, nb_vm_id):
+        nb_obj = await netbox_vm_cache.get_async(nb_vm_id, lambda: self.netbox_api.get_virtual_machine(nb_vm_id))
+
+        if not nb_obj:
+            raise ValueError("Unable to get Proxmox vmid from NetBox")
+
+        return nb_obj
+
+
+    async def netbox_get_proxmox_vmid(self, nb_vm_id):
+        return (await self.netbox_get_vm(nb_vm_id))['custom_fields']['proxmox_vmid']
+
+
+    async def netbox_get_proxmox_node_from_vm_id(self, nb_vm_id=0):
+        return (await self.netbox_get_vm(nb_vm_id))['custom_fields']['proxmox_node']
+
+
+    async def proxmox_job_get_status(self, job_in, timeout=None):
+        if timeout is None:
+            timeout = task_watchers.timeout
+
+        try:
+            task_status = await self.proxmox_api.wait_for_task(self.proxmox_node, job_in, timeout)
+        except asyncio.TimeoutError:
+            raise ProxmoxTaskTimeoutError(job_in, timeout) from None
+
+        if self.debug:
+            print("RAW TASK STATUS", task_status)
+
+        return task_status
+
+
+    def generate_gateway_from_ip_address(self, ip_address, last_quad=1):
+        return '.'.join(''.join(ip_address.split('/')[0]).split('.')[0:3]) + f'.{last_quad}'
+
+
+    async def proxmox_get_vm_resources(self):
+        return await self.proxmox_api.get('cluster/resources', type='vm')
+
+
+    async def proxmox_get_vms(self):
+        proxmox_vms = {}
+
+        for proxmox_vm in await self.proxmox_api.get('cluster/resources', type='vm'):
+            if not proxmox_vm.get('template'):
+                if 'name' in proxmox_vm and 'vmid' in proxmox_vm:
+                    proxmox_vms[proxmox_vm['name']] = proxmox_vm['vmid']
+
+        return proxmox_vms
+
+
+    async def create_vm_root_disk_in_netbox(self, netbox_vm_obj_id=0, disk_name='dummy', full_root_disk_info=None):
+        disk_info, disk_size = full_root_disk_info.split(',')
+        storage_volume = disk_info.split(':')[0]
+
+        m = re.search(r'^size=(\d+)([MG])$', disk_size)
+
+        if m:
+            disk_raw_size = m.group(1)
+
+            if m.group(2) == 'G':
+                disk_size = int(disk_raw_size) * 1000
+            elif m.group(2) == 'M':
+                disk_size = int(disk_raw_size)
+
+            await self.netbox_api.create_virtual_disk({
+                'virtual_machine': netbox_vm_obj_id,
+                'name': disk_name,
+                'custom_fields': {
+                    'proxmox_disk_storage_volume': storage_volume
+                },
+                'size': disk_size
+            })
+
+
+    async def proxmox_get_new_vmid(self, json_in, proxmox_type='qemu'):
+        # reuse the vmid from NetBox if it is not taken in Proxmox yet, else reserve one
+        if json_in['data']['custom_fields'].get('proxmox_vmid'):
+            try:
+                await self.proxmox_api.get(f"nodes/{json_in['data']['custom_fields']['proxmox_node']}/{proxmox_type}/{int(json_in['data']['custom_fields']['proxmox_vmid'])}/config")
+            except ResourceException as e:
+                if re.search(r'does\s+not\s+exist', e.content):
+                    return int(json_in['data']['custom_fields']['proxmox_vmid'])
+
+                raise
+
+            return None
+
+        return await self.proxmox_reserve_vmid()
+
+
+    async def proxmox_vmid_taken(self, vmid):
+        # cluster/nextid?vmid=N fails when N is in use
+        try:
+            await self.proxmox_api.get('cluster/nextid', vmid=vmid)
+            return False
+        except ResourceException:
+            return True
+
+
+    async def proxmox_reserve_vmid(self):
+        # see NetBoxProxmoxHelper.proxmox_reserve_vmid
+        if not vmid_allocator.enabled:
+            return int(await self.proxmox_api.get('cluster/nextid'))
+
+        if cluster_inventory.enabled:
+            await cluster_inventory.ensure_async(self.proxmox_get_vm_resources)
+            return await vmid_allocator.reserve_async(cluster_inventory.has_vmid)
+
+        return await vmid_allocator.reserve_async(self.proxmox_vmid_taken, start=int(await self.proxmox_api.get('cluster/nextid')))
+
+
+    async def proxmox_create_with_vmid(self, json_in, new_vm_id, create):
+        # create(vmid) starts a clone or create task; returns (vmid, task). A reserved vmid
+        # that turns out to be taken is skipped
+        if json_in['data']['custom_fields'].get('proxmox_vmid') or not vmid_allocator.enabled:
+            return new_vm_id, await create(new_vm_id)
+
+        for attempt in range(VMID_RESERVE_ATTEMPTS):
+            try:
+                return new_vm_id, await create(new_vm_id)
+            except ResourceException as e:
+                if attempt + 1 < VMID_RESERVE_ATTEMPTS and re.search(r'already\s+exists', str(e.content)):
+                    new_vm_id = await self.proxmox_reserve_vmid()
+                    continue
+
+                await vmid_allocator.release_async(new_vm_id)
+                raise
+
+
+class AsyncNetBoxProxmoxHelperVM(AsyncNetBoxProxmoxHelper):
+    async def __proxmox_update_vm_vcpus_and_memory(self, vmid=1, vcpus=1, memory=500):
+        try:
+            update_vm_vcpus = await self.proxmox_api.post(
+                f"nodes/{self.proxmox_node}/qemu/{vmid}/config",
+                cores=int(float(vcpus)),
+                memory=int(memory)
+            )
+
+            await self.proxmox_job_get_status(update_vm_vcpus)
+
+            return 200, {'result': f"Updated CPU information (cpus: {vcpus}, memory: {memory}) for {vmid}"}
+        except ResourceException as e:
+            return 500, {'result': e.content}
+
+
+    async def proxmox_plan_clone(self, json_in, requested=None):
+        # see NetBoxProxmoxHelperVM.proxmox_plan_clone
+        template = int(json_in['data']['custom_fields']['proxmox_vm_templates'])
+        target_node = json_in['data']['custom_fields']['proxmox_node']
+        source_node = self.proxmox_node
+
+        if cluster_inventory.enabled:
+            await cluster_inventory.ensure_async(self.proxmox_get_vm_resources)
+            template_guest = cluster_inventory.get_guest(template)
+
+            if template_guest:
+                source_node = template_guest['node']
+
+        requested = requested or clone_strategy.requested_strategy(template, json_in['data'].get('tags'))
+
+        if requested == STRATEGY_FULL:
+            return clone_strategy.plan(requested, {}, {}, source_node, target_node, json_in['data']['custom_fields']['proxmox_vm_storage'])
+
+        template_config = await clone_strategy.cached_async(('template', source_node, template), lambda: self.proxmox_api.get(f"nodes/{source_node}/qemu/{template}/config"))
+
+        storage_configs = {}
+
+        for storage_id in template_disk_storages(template_config):
+            storage_configs[storage_id] = await clone_strategy.cached_async(('storage', storage_id), lambda: self.proxmox_api.get(f"storage/{storage_id}"))
+
+        return clone_strategy.plan(requested, template_config, storage_configs, source_node, target_node, json_in['data']['custom_fields']['proxmox_vm_storage'])
+
+
+    async def proxmox_check_if_vm_exists(self, vm_name=None):
+        # answered from the in-memory cluster inventory instead of downloading every guest
+        if cluster_inventory.enabled:
+            await cluster_inventory.ensure_async(self.proxmox_get_vm_resources)
+            return cluster_inventory.has_name(vm_name)
+
+        return vm_name in await self.proxmox_get_vms()
+
+
+    async def proxmox_clone_vm(self, json_in):
+        try:
+            for required_netbox_object in ['proxmox_vm_templates', 'proxmox_vm_storage']:
+                if not required_netbox_object in json_in['data']['custom_fields']:
+                    return 500, {'result': f"Missing {required_netbox_object} in VM configuration"}
+
+            nb_objs = await self.netbox_api.filter_virtual_machines(name=json_in['data']['name'])
+
+            if not nb_objs:
+                raise ValueError(f"Unable to find VM {json_in['data']['name']} in NetBox")
+
+            nb_tenant_ids = [(nbo.get('tenant') or {}).get('id') for nbo in nb_objs]
+            new_vm_id = None
+
+            if (json_in['data'].get('tenant') or {}).get('id') not in nb_tenant_ids or not await self.proxmox_check_if_vm_exists(json_in['data']['name']):
+                # a pre-cloned VM from the warm pool, renamed, saves the full clone
+                if not json_in['data']['custom_fields'].get('proxmox_vmid'):
+                    new_vm_id = await warm_pool.claim_async(self, int(json_in['data']['custom_fields']['proxmox_vm_templates']), json_in['data']['custom_fields']['proxmox_node'], json_in['data']['custom_fields']['proxmox_vm_storage'], json_in['data']['name'])
+
+                if not new_vm_id:
+                    new_vm_id = await self.proxmox_get_new_vmid(json_in)
+
+                    if not new_vm_id:
+                        raise ValueError(f"Unable to create VM id for {json_in['data']['name']}")
+
+                    clone_plan = await self.proxmox_plan_clone(json_in)
+
+                    with time_clone(clone_plan.strategy) as clone_timing:
+                        new_vm_id, clone_data = await self.proxmox_create_with_vmid(json_in, new_vm_id, lambda vmid: self.proxmox_api.post(
+                            f"nodes/{clone_plan.source_node}/qemu/{int(json_in['data']['custom_fields']['proxmox_vm_templates'])}/clone",
+                            newid=vmid,
+                            name=json_in['data']['name'],
+                            target=json_in['data']['custom_fields']['proxmox_node'],
+                            **clone_plan.clone_args()
+                        ))
+
+                        clone_status = await self.proxmox_job_get_status(clone_data)
+                        clone_timing['value'] = 'ok' if clone_status.get('exitstatus') == 'OK' else 'failed'
+
+                    if clone_status.get('exitstatus') != 'OK':
+                        # the clone failed: hand the vmid out again, and leave NetBox alone
+                        if not json_in['data']['custom_fields'].get('proxmox_vmid'):
+                            await vmid_allocator.release_async(new_vm_id)
+
+                        return 500, {'result': f"Clone of {json_in['data']['name']} (vmid: {new_vm_id}) failed: {clone_status.get('exitstatus')}"}
+
+                    cluster_inventory.add_guest(new_vm_id, json_in['data']['name'], json_in['data']['custom_fields']['proxmox_node'], 'qemu')
+
+                # set vmid in NetBox
+                await self.netbox_api.update_virtual_machine(json_in['data']['id'], {'custom_fields': {'proxmox_vmid': new_vm_id}})
+
+                # set scsi0 in NetBox
+                proxmox_vm_config = await self.proxmox_api.get(f"nodes/{self.proxmox_node}/qemu/{new_vm_id}/config")
+
+                if 'bootdisk' in proxmox_vm_config:
+                    os_disk = proxmox_vm_config['bootdisk']
+
+                    await self.create_vm_root_disk_in_netbox(json_in['data']['id'], os_disk, proxmox_vm_config[os_disk])
+
+            # update VM vcpus and memory if defined
+            if json_in['data']['vcpus'] and json_in['data']['memory']:
+                if not json_in['data']['custom_fields'].get('proxmox_vmid'):
+                    json_in['data']['custom_fields']['proxmox_vmid'] = new_vm_id
+
+                return await self.__proxmox_update_vm_vcpus_and_memory(json_in['data']['custom_fields']['proxmox_vmid'], json_in['data']['vcpus'], json_in['data']['memory'])
+
+            return 200, {'result': f"VM {json_in['data']['name']} (vmid: {new_vm_id}) cloned successfully"}
+        except ResourceException as e:
+            return 500, {'result': e.content}
+
+
+    async def proxmox_update_vm_vcpus_and_memory(self, json_in):
+        if json_in['data']['custom_fields']['proxmox_vmid'] and json_in['snapshots']['postchange']['vcpus'] and json_in['snapshots']['postchange']['memory']:
+            return await self.__proxmox_update_vm_vcpus_and_memory(json_in['data']['custom_fields']['proxmox_vmid'], json_in['snapshots']['postchange']['vcpus'], json_in['snapshots']['postchange']['memory'])
+
+        return 500, {'result': f"Unable to update vcpus and/or memory for {json_in['data']['custom_fields']['proxmox_vmid']}"}
+
+
+    async def proxmox_update_vm_config(self, json_in):
+        # see NetBoxProxmoxHelperVM.proxmox_update_vm_config
+        try:
+            if not json_in['data']['custom_fields']['proxmox_vmid']:
+                return 500, {'result': "Missing value for 'proxmox_vmid'"}
+
+            vm_config = desired_vm_config(json_in, self.generate_gateway_from_ip_address)
+
+            if not vm_config:
+                return 500, {'result': f"Nothing to update for VM {json_in['data']['custom_fields']['proxmox_vmid']}"}
+
+            config_path = f"nodes/{json_in['data']['custom_fields']['proxmox_node']}/qemu/{json_in['data']['custom_fields']['proxmox_vmid']}/config"
+
+            changes, fields = vm_config_changes(vm_config, await self.proxmox_api.get(config_path))
+
+            if not changes:
+                return 200, {'result': f"Nothing changed for VM {json_in['data']['custom_fields']['proxmox_vmid']}", 'fields': fields}
+
+            try:
+                update_vm_config = await self.proxmox_api.post(config_path, **changes)
+            except ResourceException as e:
+                return 500, {'result': e.content, 'fields': vm_config_failed(fields)}
+
+            task_status = await self.proxmox_job_get_status(update_vm_config)
+
+            if task_status.get('exitstatus') != 'OK':
+                return 500, {'result': f"Updating {', '.join(changes)} for VM {json_in['data']['custom_fields']['proxmox_vmid']} failed: {task_status.get('exitstatus')}", 'fields': vm_config_failed(fields)}
+
+            return 200, {'result': f"Updated {', '.join(changes)} for VM {json_in['data']['custom_fields']['proxmox_vmid']}", 'fields': fields}
+        except ResourceException as e:
+            return 500, {'result': e.content}
+
+
+    async def __proxmox_vm_status(self, json_in, action):
+        self.json_data_check_proxmox_vmid_exists(json_in)
+
+        status_data = await self.proxmox_api.post(f"nodes/{json_in['data']['custom_fields']['proxmox_node']}/qemu/{json_in['data']['custom_fields']['proxmox_vmid']}/status/{action}")
+
+        await self.proxmox_job_get_status(status_data)
+
+
+    async def proxmox_start_vm(self, json_in):
+        try:
+            await self.__proxmox_vm_status(json_in, 'start')
+
+            return 200, {'result': f"VM {json_in['data']['custom_fields']['proxmox_vmid']} started successfully"}
+        except ResourceException as e:
+            return 500, {'result': e.content}
+
+
+    async def proxmox_stop_vm(self, json_in):
+        try:
+            await self.__proxmox_vm_status(json_in, 'stop')
+
+            return 200, {'result': f"VM {json_in['data']['custom_fields']['proxmox_vmid']} stopped successfully"}
+        except ResourceException as e:
+            return 500, {'result': e.content}
+
+
+    async def proxmox_delete_vm(self, json_in):
+        try:
+            self.json_data_check_proxmox_vmid_exists(json_in)
+
+            await self.proxmox_stop_vm(json_in)
+
+            delete_data = await self.proxmox_api.delete(f"nodes/{json_in['data']['custom_fields']['proxmox_node']}/qemu/{json_in['data']['custom_fields']['proxmox_vmid']}")
+
+            if (await self.proxmox_job_get_status(delete_data)).get('exitstatus') == 'OK':
+                cluster_inventory.remove_guest(json_in['data']['custom_fields']['proxmox_vmid'])
+
+            return 200, {'result': f"VM {json_in['data']['custom_fields']['proxmox_vmid']} deleted successfully"}
+        except ResourceException as e:
+            return 500, {'result': e.content}
+
+
+    async def proxmox_add_disk(self, json_in):
+        try:
+            if json_in['data']['name'] == 'scsi0':
+                await self.proxmox_resize_disk(json_in)
+                the_proxmox_vmid = json_in['data']['custom_fields'].get('proxmox_vmid', '')
+            else:
+                the_proxmox_vmid = await self.netbox_get_proxmox_vmid(json_in['data']['virtual_machine']['id'])
+
+                add_disk_data = await self.proxmox_api.post(
+                    f"nodes/{json_in['data']['custom_fields']['proxmox_node']}/qemu/{the_proxmox_vmid}/config",
+                    **{json_in['data']['name']: f"{json_in['data']['custom_fields']['proxmox_disk_storage_volume']}:{int(json_in['data']['size'])/1000},backup=0,ssd=0"}
+                )
+
+                await self.proxmox_job_get_status(add_disk_data)
+
+            return 200, {'result': f"Disk {json_in['data']['name']} resized for VM {the_proxmox_vmid} successfully"}
+        except ResourceException as e:
+            return 500, {'result': e.content}
+
+
+    async def proxmox_resize_disk(self, json_in):
+        try:
+            proxmox_vmid = await self.netbox_get_proxmox_vmid(json_in['data']['virtual_machine']['id'])
+
+            disk_resize_info = await self.proxmox_api.put(
+                f"nodes/{json_in['data']['custom_fields']['proxmox_node']}/qemu/{proxmox_vmid}/resize",
+                disk=json_in['data']['name'],
+                size=f"{int(json_in['data']['size'])/1000}G"
+            )
+
+            await self.proxmox_job_get_status(disk_resize_info)
+
+            return 200, {'result': f"Disk {json_in['data']['name']} for VM {proxmox_vmid} resized successfully"}
+        except ResourceException as e:
+            return 500, {'result': e.content}
+
+
+    async def proxmox_delete_disk(self, json_in):
+        try:
+            if json_in['data']['name'] == 'scsi0':
+                raise ValueError("Cannot delete VM OS disk")
+
+            proxmox_vmid = await self.netbox_get_proxmox_vmid(json_in['data']['virtual_machine']['id'])
+
+            await self.proxmox_api.put(f"nodes/{json_in['data']['custom_fields']['proxmox_node']}/qemu/{proxmox_vmid}/unlink", idlist=json_in['data']['name'], force=1)
+
+            return 200, {'result': f"Disk {json_in['data']['name']} for VM {json_in['data']['virtual_machine']['id']} deleted successfully"}
+        except ResourceException as e:
+            return 500, {'result': e.content}
+
+
+    async def proxmox_apply_disk_batch(self, json_in):
+        # see NetBoxProxmoxHelperVM.proxmox_apply_disk_batch
+        proxmox_vmid = await self.netbox_get_proxmox_vmid(json_in['data']['virtual_machine']['id'])
+
+        disks = fold_disk_events(disk_batch_events(json_in))
+        results = {name: DISK_UNCHANGED for name, disk in disks.items() if disk[0] is None}
+        errors = {}
+
+        deleted_disks = [name for name, disk in disks.items() if disk[0] in (DISK_OP_DELETE, DISK_OP_REPLACE)]
+
+        if 'scsi0' in deleted_disks:
+            deleted_disks.remove('scsi0')
+            results['scsi0'] = DISK_FAILED
+            errors['scsi0'] = "Cannot delete VM OS disk"
+
+        if deleted_disks:
+            try:
+                await self.proxmox_api.put(f"nodes/{self.proxmox_node}/qemu/{proxmox_vmid}/unlink", idlist=','.join(deleted_disks), force=1)
+                results.update({name: DISK_DELETED for name in deleted_disks})
+            except ResourceException as e:
+                results.update({name: DISK_FAILED for name in deleted_disks})
+                errors.update({name: e.content for name in deleted_disks})
+
+        # a replaced disk is only added back once it has been deleted
+        added_disks = {name: disk_config_value(disk[1]) for name, disk in disks.items() if disk[0] == DISK_OP_ADD or (disk[0] == DISK_OP_REPLACE and results.get(name) == DISK_DELETED)}
+
+        if added_disks:
+            try:
+                add_status = await self.proxmox_job_get_status(await self.proxmox_api.post(f"nodes/{self.proxmox_node}/qemu/{proxmox_vmid}/config", **added_disks))
+
+                if add_status.get('exitstatus') == 'OK':
+                    results.update({name: DISK_ADDED for name in added_disks})
+                else:
+                    results.update({name: DISK_FAILED for name in added_disks})
+                    errors.update({name: add_status.get('exitstatus') for name in added_disks})
+            except ResourceException as e:
+                results.update({name: DISK_FAILED for name in added_disks})
+                errors.update({name: e.content for name in added_disks})
+
+        for name, (operation, disk_data) in disks.items():
+            if operation == DISK_OP_RESIZE:
+                try:
+                    await self.proxmox_job_get_status(await self.proxmox_api.put(f"nodes/{self.proxmox_node}/qemu/{proxmox_vmid}/resize", disk=name, size=disk_size(disk_data)))
+                    results[name] = DISK_RESIZED
+                except ResourceException as e:
+                    results[name] = DISK_FAILED
+                    errors[name] = e.content
+
+        return disk_batch_results(proxmox_vmid, results, errors)
+
+
+class AsyncNetBoxProxmoxHelperLXC(AsyncNetBoxProxmoxHelper):
+    async def proxmox_create_lxc(self, json_in):
+        try:
+            new_vm_id = await self.proxmox_get_new_vmid(json_in, 'lxc')
+
+            if not new_vm_id:
+                return 500, {'result': f"Unable to create LXC id for {json_in['data']['name']}"}
+
+            lxc_create_data = {
+                'hostname': json_in['data']['name'],
+                'ostemplate': json_in['data']['custom_fields']['proxmox_lxc_templates'],
+                'cores': int(json_in['data']['vcpus']),
+                'memory': int(json_in['data']['memory']),
+                'storage': json_in['data']['custom_fields']['proxmox_vm_storage'],
+                'password': 'netbox-proxmox-automation',
+                'onboot': 1,
+                'unprivileged': 1,
+                'swap': 0
+            }
+
+            if json_in['data']['custom_fields']['proxmox_public_ssh_key']:
+                lxc_create_data['ssh-public-keys'] = json_in['data']['custom_fields']['proxmox_public_ssh_key']
+
+            new_vm_id, create_lxc_data = await self.proxmox_create_with_vmid(json_in, new_vm_id, lambda vmid: self.proxmox_api.post(f"nodes/{json_in['data']['custom_fields']['proxmox_node']}/lxc", vmid=vmid, **lxc_create_data))
+
+            create_lxc_status = await self.proxmox_job_get_status(create_lxc_data)
+
+            if create_lxc_status.get('exitstatus') != 'OK':
+                # see proxmox_clone_vm
+                if not json_in['data']['custom_fields'].get('proxmox_vmid'):
+                    await vmid_allocator.release_async(new_vm_id)
+
+                return 500, {'result': f"Creating LXC {json_in['data']['name']} (vmid: {new_vm_id}) failed: {create_lxc_status.get('exitstatus')}"}
+
+            cluster_inventory.add_guest(new_vm_id, json_in['data']['name'], json_in['data']['custom_fields']['proxmox_node'], 'lxc')
+
+            await self.netbox_api.update_virtual_machine(json_in['data']['id'], {'custom_fields': {'proxmox_vmid': new_vm_id}})
+
+            lxc_config_info = await self.proxmox_api.get(f"nodes/{json_in['data']['custom_fields']['proxmox_node']}/lxc/{new_vm_id}/config")
+
+            if 'rootfs' in lxc_config_info:
+                await self.create_vm_root_disk_in_netbox(json_in['data']['id'], 'rootfs', lxc_config_info['rootfs'])
+
+            return 200, {'result': f"LXC {json_in['data']['name']} (vmid: {new_vm_id}) created successfully"}
+        except ResourceException as e:
+            return 500, {'result': e.content}
+
+
+    async def proxmox_update_lxc_vpus_and_memory(self, json_in):
+        self.json_data_check_proxmox_vmid_exists(json_in)
+
+        if json_in['snapshots']['postchange']['vcpus'] and json_in['snapshots']['postchange']['memory']:
+            try:
+                await self.proxmox_api.put(
+                    f"nodes/{json_in['data']['custom_fields']['proxmox_node']}/lxc/{json_in['data']['custom_fields']['proxmox_vmid']}/config",
+                    cores=int(float(json_in['snapshots']['postchange']['vcpus'])),
+                    memory=int(json_in['snapshots']['postchange']['memory'])
+                )
+
+                return 200, {'result': f"Updated CPU and/or memory information (cpus: {json_in['snapshots']['postchange']['vcpus']}, memory {json_in['snapshots']['postchange']['memory']}) for {json_in['data']['custom_fields']['proxmox_vmid']}"}
+            except ResourceException as e:
+                return 500, {'result': e.content}
+
+        return 500, {'result': f"Unable to set vcpus ({json_in['data']['vcpus']}) and/or memory ({json_in['data']['memory']}) for LXC (vmid: {json_in['data']['custom_fields']['proxmox_vmid']})"}
+
+
+    async def proxmox_lxc_set_net0(self, json_in):
+        try:
+            self.json_data_check_proxmox_vmid_exists(json_in)
+
+            primary_ip = json_in['data']['primary_ip']['address']
+            gateway = self.generate_gateway_from_ip_address(primary_ip)
+
+            await self.proxmox_api.put(
+                f"nodes/{json_in['data']['custom_fields']['proxmox_node']}/lxc/{json_in['data']['custom_fields']['proxmox_vmid']}/config",
+                net0=f"name=net0,bridge=vmbr0,ip={primary_ip},gw={gateway},firewall=1"
+            )
+
+            return 200, {'result': f"net0 for (LXC) vmid {json_in['data']['custom_fields']['proxmox_vmid']} configured with IP {primary_ip} and gateway {gateway}"}
+        except ResourceException as e:
+            return 500, {'result': e.content}
+
+
+    async def proxmox_lxc_resize_disk(self, json_in):
+        try:
+            proxmox_vmid = await self.netbox_get_proxmox_vmid(json_in['data']['virtual_machine']['id'])
+
+            disk_size = f"{int(json_in['data']['size'])/1000}G"
+
+            disk_resize_info = await self.proxmox_api.put(f"nodes/{json_in['data']['custom_fields']['proxmox_node']}/lxc/{proxmox_vmid}/resize", disk='rootfs', size=disk_size)
+
+            await self.proxmox_job_get_status(disk_resize_info)
+
+            return 200, {'result': f"Disk rootfs resized to {disk_size}"}
+        except ResourceException as e:
+            return 500, {'result': e.content}
+
+
+    async def __proxmox_lxc_status(self, json_in, action):
+        self.json_data_check_proxmox_vmid_exists(json_in)
+
+        status_data = await self.proxmox_api.post(f"nodes/{json_in['data']['custom_fields']['proxmox_node']}/lxc/{json_in['data']['custom_fields']['proxmox_vmid']}/status/{action}")
+
+        await self.proxmox_job_get_status(status_data)
+
+
+    async def proxmox_start_lxc(self, json_in):
+        try:
+            await self.__proxmox_lxc_status(json_in, 'start')
+
+            return 200, {'result': f"LXC (vmid: {json_in['data']['custom_fields']['proxmox_vmid']}) has been started"}
+        except ResourceException as e:
+            return 500, {'result': e.content}
+
+
+    async def proxmox_stop_lxc(self, json_in):
+        try:
+            await self.__proxmox_lxc_status(json_in, 'stop')
+
+            return 200, {'result': f"LXC (vmid: {json_in['data']['custom_fields']['proxmox_vmid']}) has been stopped"}
+        except ResourceException as e:
+            return 500, {'result': e.content}
+
+
+    async def proxmox_delete_lxc(self, json_in):
+        try:
+            self.json_data_check_proxmox_vmid_exists(json_in)
+
+            await self.proxmox_stop_lxc(json_in)
+
+            delete_data = await self.proxmox_api.delete(f"nodes/{json_in['data']['custom_fields']['proxmox_node']}/lxc/{json_in['data']['custom_fields']['proxmox_vmid']}")
+
+            if (await self.proxmox_job_get_status(delete_data)).get('exitstatus') == 'OK':
+                cluster_inventory.remove_guest(json_in['data']['custom_fields']['proxmox_vmid'])
+
+            return 200, {'result': f"LXC (vmid: {json_in['data']['custom_fields']['proxmox_vmid']}) has been deleted"}
+        except ResourceException as e:
+            return 500, {'result': e.content}
+
+
+class AsyncNetBoxProxmoxHelperMigrate(AsyncNetBoxProxmoxHelper):
+    async def __already_migrated(self, proxmox_vmid, proxmox_target_node):
+        # see NetBoxProxmoxHelperMigrate.__already_migrated
+        for guest in await self.proxmox_get_vm_resources():
+            if str(guest.get('vmid')) == str(proxmox_vmid):
+                if guest.get('node') != proxmox_target_node:
+                    return False
+
+                cluster_inventory.move_guest(proxmox_vmid, proxmox_target_node)
+
+                return True
+
+        return False
+
+
+    async def __migrate(self, proxmox_type, proxmox_vmid, proxmox_node, proxmox_target_node):
+        try:
+            # e.g. the webhook for the proxmox_node update that a bulk migration made in NetBox
+            if cluster_inventory.enabled:
+                await cluster_inventory.ensure_async(self.proxmox_get_vm_resources)
+
+                if (cluster_inventory.get_guest(proxmox_vmid) or {}).get('node') == proxmox_target_node:
+                    return 200, {'result': f"Guest {proxmox_vmid} is already on node {proxmox_target_node}"}
+
+            try:
+                migrate_task_id = await self.proxmox_api.post(f"nodes/{proxmox_node}/{proxmox_type}/{proxmox_vmid}/migrate", target=proxmox_target_node, online=1)
+            except ResourceException:
+                if await self.__already_migrated(proxmox_vmid, proxmox_target_node):
+                    return 200, {'result': f"Guest {proxmox_vmid} is already on node {proxmox_target_node}"}
+
+                raise
+
+            task_status = await self.proxmox_api.wait_for_task(proxmox_node, migrate_task_id, 600, kind='migration') # 10 minutes
+
+            if task_status.get('exitstatus') == 'OK':
+                cluster_inventory.move_guest(proxmox_vmid, proxmox_target_node)
+
+                return 200, {'result': "Proxmox node migration successful"}
+
+            return 500, {'result': f"Task {migrate_task_id} is stopped but exit status does not appear to be successful: {task_status.get('exitstatus')}"}
+        except asyncio.TimeoutError:
+            return 500, {'result': f"Unable to complete migration of {proxmox_vmid} in defined time"}
+        except ResourceException as e:
+            logging.error(f"Proxmox API ResourceException: {e}")
+            return 500, {'result': "Proxmox API error occurred."}
+        except aiohttp.ClientConnectionError as e:
+            logging.error(f"Proxmox API ConnectionError: {e}")
+            return 500, {'result': "Failed to connect to Proxmox API."}
+
+
+    async def migrate_vm(self, proxmox_vmid: int, proxmox_node: str, proxmox_target_node: str):
+        return await self.__migrate('qemu', proxmox_vmid, proxmox_node, proxmox_target_node)
+
+
+    async def migrate_lxc(self, proxmox_vmid: int, proxmox_node: str, proxmox_target_node: str):
+        return await self.__migrate('lxc', proxmox_vmid, proxmox_node, proxmox_target_node)
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import threading
+import time
+
+from urllib.parse import urlsplit, urlunsplit
+
+
+# node addresses only change when nodes join or leave the cluster
+DEFAULT_REFRESH_INTERVAL = 300
+
+# how long a node that could not be reached directly is skipped
+DEFAULT_RETRY_AFTER = 60
+
+
+def url_node(url):
+    # the Proxmox node a nodes/{node}/... URL is scoped to
+    segments = urlsplit(url).path.strip('/').split('/')
+    segments = segments[2:] if segments[:2] == ['api2', 'json'] else segments
+
+    if len(segments) > 1 and segments[0] == 'nodes':
+        return segments[1]
+
+    return None
+
+
+def node_addresses(cluster_status):
+    # node name -> address of the online nodes in cluster/status
+    return {
+        entry['name']: entry['ip']
+        for entry in cluster_status or []
+        if entry.get('type') == 'node' and entry.get('ip') and entry.get('online', 1)
+    }
+
+
+class NodeRoutes:
+    # sends node-scoped Proxmox calls (nodes/{node}/...) straight to the node that owns them,
+    # at the address cluster/status reports for it, instead of having api_host proxy them.
+    # A node that cannot be reached that way is skipped for retry_after seconds, and its
+    # calls go to api_host as before.
+    def __init__(self, enabled=False, refresh_interval=DEFAULT_REFRESH_INTERVAL, retry_after=DEFAULT_RETRY_AFTER, addresses=None):
+        self.enabled = enabled
+        self.refresh_interval = float(refresh_interval)
+        self.retry_after = float(retry_after)
+        self.static_addresses = dict(addresses or {})
+
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._async_refresh_lock = None
+        self._addresses = {}
+        self._loaded = None
+        self._unreachable = {}
+
+        self.stats = {
+            'direct': 0,
+            'proxied': 0,
+            'fallbacks': 0,
+            'refreshes': 0,
+            'refresh_errors': 0
+        }
+
+
+    def configure(self, enabled=None, refresh_interval=None, retry_after=None, addresses=None):
+        with self._lock:
+            if enabled is not None:
+                self.enabled = bool(enabled)
+
+            if refresh_interval:
+                self.refresh_interval = float(refresh_interval)
+
+            if retry_after is not None:
+                self.retry_after = float(retry_after)
+
+            if addresses is not None:
+                self.static_addresses = {str(node): str(address) for node, address in addresses.items()}
+
+            self._loaded = None
+            self._unreachable = {}
+
+
+    def is_fresh(self):
+        return self._loaded is not None and time.monotonic() - self._loaded < self.refresh_interval
+
+
+    def __install(self, cluster_status):
+        with self._lock:
+            self._addresses = node_addresses(cluster_status)
+            self._loaded = time.monotonic()
+            self.stats['refreshes'] += 1
+
+
+    def __refresh_failed(self, e):
+        # keep the addresses we have, and do not ask again before the next refresh
+        logging.warning(f"Unable to get Proxmox node addresses from cluster/status: {e}")
+
+        with self._lock:
+            self._loaded = time.monotonic()
+            self.stats['refresh_errors'] += 1
+
+
+    def ensure(self, load):
+        # load() returns cluster/status
+        if self.is_fresh():
+            return
+
+        with self._refresh_lock:
+            if self.is_fresh():
+                return
+
+            try:
+                self.__install(load())
+            except Exception as e:
+                self.__refresh_failed(e)
+
+
+    async def ensure_async(self, load):
+        if self.is_fresh():
+            return
+
+        if self._async_refresh_lock is None:
+            self._async_refresh_lock = asyncio.Lock()
+
+        async with self._async_refresh_lock:
+            if self.is_fresh():
+                return
+
+            try:
+                self.__install(await load())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.__refresh_failed(e)
+
+
+    def node_address(self, node):
+        with self._lock:
+            if node in self._unreachable:
+                if self._unreachable[node] > time.monotonic():
+                    return None
+
+                del self._unreachable[node]
+
+            return self.static_addresses.get(node) or self._addresses.get(node)
+
+
+    def direct_url(self, url):
+        # url with its host replaced by the owning node's address; None when the call is not
+        # node-scoped, or has to go through api_host
+        node = url_node(url)
+
+        if not node:
+            return None
+
+        address = self.node_address(node)
+
+        if not address:
+            with self._lock:
+                self.stats['proxied'] += 1
+
+            return None
+
+        parts = urlsplit(url)
+        netloc = f"[{address}]" if ':' in address else address
+
+        if parts.port:
+            netloc = f"{netloc}:{parts.port}"
+
+        with self._lock:
+            self.stats['direct'] += 1
+
+        return urlunsplit(parts._replace(netloc=netloc))
+
+
+    def mark_unreachable(self, url, e):
+        node = url_node(url)
+
+        logging.warning(f"Unable to reach Proxmox node {node} directly, using api_host for the next {self.retry_after:.0f}s: {e}")
+
+        with self._lock:
+            self._unreachable[node] = time.monotonic() + self.retry_after
+            self.stats['fallbacks'] += 1
+
+
+    def get_stats(self):
+        with self._lock:
+            now = time.monotonic()
+
+            return dict(
+                self.stats,
+                enabled=self.enabled,
+                nodes=dict(self._addresses, **self.static_addresses),
+                unreachable=sorted(node for node, until in self._unreachable.items() if until > now),
+                age=round(now - self._loaded, 3) if self._loaded is not None else None
+            )
+
+
+# process-wide node address table shared by all Proxmox clients
+node_routes = NodeRoutes()
@@ -0,0 +1,32 @@
+import multiprocessing
+import time
+
+
+class SharedStatusStore:
+    # Counters live in shared memory created before the server forks its workers
+    # (gunicorn preload_app), so every worker process updates the same values.
+    def __init__(self, counters=('requests', 'webhooks')):
+        self._lock = multiprocessing.Lock()
+        self._counters = {counter: multiprocessing.RawValue('Q', 0) for counter in counters}
+        self._last_called = {counter: multiprocessing.RawValue('d', 0.0) for counter in counters}
+        self._server_start = multiprocessing.RawValue('d', time.time())
+
+
+    def record(self, counter):
+        with self._lock:
+            self._counters[counter].value += 1
+            self._last_called[counter].value = time.time()
+
+
+    def get(self, counter):
+        with self._lock:
+            return self._counters[counter].value, self._last_called[counter].value
+
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'server_start': self._server_start.value,
+                'counters': {counter: value.value for counter, value in self._counters.items()},
+                'last_called': {counter: value.value for counter, value in self._last_called.items()}
+            }
@@ -0,0 +1,263 @@
+import logging
+import threading
+
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from proxmoxer import ResourceException
+
+
+DEFAULT_MIN_INTERVAL = 0.25
+DEFAULT_MAX_INTERVAL = 5.0
+DEFAULT_BACKOFF = 1.5
+DEFAULT_MAX_ERRORS = 3
+
+# how long a webhook waits for a Proxmox task (migrations and the warm pool have their own)
+DEFAULT_TASK_TIMEOUT = 900
+
+# how many entries to request from nodes/{node}/tasks per tick
+TASK_LIST_LIMIT = 500
+
+
+def proxmox_node_from_upid(upid, default=None):
+    # UPID:<node>:<pid>:<pstart>:<starttime>:<type>:<id>:<user>:
+    if isinstance(upid, str) and upid.startswith('UPID:'):
+        upid_parts = upid.split(':')
+
+        if len(upid_parts) > 2 and upid_parts[1]:
+            return upid_parts[1]
+
+    return default
+
+
+def proxmox_starttime_from_upid(upid):
+    try:
+        return int(upid.split(':')[4], 16)
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+class ProxmoxTaskTimeoutError(ResourceException):
+    # a ResourceException, so that helpers report it like any other failed Proxmox call
+    def __init__(self, upid, timeout):
+        super().__init__(500, 'Task Timeout', f"Proxmox task {upid} did not finish within {timeout:g}s")
+        self.upid = upid
+
+
+class ProxmoxNodeTaskWatcher:
+    def __init__(self, proxmox_api, proxmox_node, min_interval=DEFAULT_MIN_INTERVAL, max_interval=DEFAULT_MAX_INTERVAL, backoff=DEFAULT_BACKOFF, max_errors=DEFAULT_MAX_ERRORS):
+        self.proxmox_api = proxmox_api
+        self.proxmox_node = proxmox_node
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.max_errors = max_errors
+
+        self._condition = threading.Condition()
+        self._pending = {}
+        self._interval = min_interval
+        self._errors = 0
+        self._thread = None
+
+        self.stats = {
+            'watched': 0,
+            'completed': 0,
+            'polls': 0,
+            'status_fallbacks': 0
+        }
+
+
+    def watch(self, upid):
+        future = Future()
+
+        with self._condition:
+            idle = not self._pending
+
+            # several callers may wait on the same task
+            if upid in self._pending:
+                self._pending[upid].append(future)
+            else:
+                self._pending[upid] = [future]
+
+            self.stats['watched'] += 1
+            self._interval = self.min_interval
+
+            if not self._thread or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.__run, name=f"proxmox-task-watcher-{self.proxmox_node}", daemon=True)
+                self._thread.start()
+
+            # a busy watcher picks the task up on its next poll, so that a burst of tasks does
+            # not cause a burst of task listings
+            if idle:
+                self._condition.notify()
+
+        return future
+
+
+    def unwatch(self, upid, future):
+        with self._condition:
+            if upid in self._pending and future in self._pending[upid]:
+                self._pending[upid].remove(future)
+
+                if not self._pending[upid]:
+                    del self._pending[upid]
+
+
+    def get_stats(self):
+        with self._condition:
+            return dict(self.stats, pending=len(self._pending), interval=self._interval)
+
+
+    def __list_finished_tasks(self, upids):
+        finished = {}
+        failed = {}
+
+        since = [proxmox_starttime_from_upid(upid) for upid in upids]
+        since = [starttime for starttime in since if starttime is not None]
+
+        task_list_params = {'source': 'all', 'limit': TASK_LIST_LIMIT}
+
+        if since:
+            task_list_params['since'] = min(since)
+
+        seen = set()
+
+        for task in self.proxmox_api.nodes(self.proxmox_node).tasks.get(**task_list_params):
+            if 'upid' not in task:
+                continue
+
+            seen.add(task['upid'])
+
+            if task['upid'] in upids and task.get('endtime'):
+                finished[task['upid']] = {
+                    'upid': task['upid'],
+                    'node': self.proxmox_node,
+                    'status': 'stopped',
+                    'exitstatus': task.get('status'),
+                    'starttime': task.get('starttime'),
+                    'endtime': task.get('endtime')
+                }
+
+        # tasks that fell outside the listing window are checked one at a time
+        for upid in upids:
+            if upid in seen:
+                continue
+
+            self.stats['status_fallbacks'] += 1
+
+            try:
+                task_status = self.proxmox_api.nodes(self.proxmox_node).tasks(upid).status.get()
+            except Exception as e:
+                failed[upid] = e
+                continue
+
+            if 'status' in task_status and task_status['status'] == 'stopped':
+                finished[upid] = task_status
+
+        return finished, failed
+
+
+    def __run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+
+                upids = set(self._pending)
+
+            try:
+                finished, failed = self.__list_finished_tasks(upids)
+                self._errors = 0
+            except Exception as e:
+                self._errors += 1
+                logging.error(f"Proxmox task watcher for node {self.proxmox_node} failed to list tasks: {e}")
+
+                if self._errors >= self.max_errors:
+                    with self._condition:
+                        for upid in upids:
+                            for future in self._pending.pop(upid, []):
+                                future.set_exception(e)
+
+                    self._errors = 0
+
+                finished, failed = {}, {}
+
+            with self._condition:
+                self.stats['polls'] += 1
+
+                for upid, task_status in finished.items():
+                    for future in self._pending.pop(upid, []):
+                        future.set_result(task_status)
+
+                    self.stats['completed'] += 1
+
+                for upid, e in failed.items():
+                    for future in self._pending.pop(upid, []):
+                        future.set_exception(e)
+
+                # back off while nothing completes, poll eagerly again once something does
+                if finished:
+                    self._interval = self.min_interval
+                else:
+                    self._interval = min(self.max_interval, self._interval * self.backoff)
+
+                if self._pending:
+                    self._condition.wait(self._interval)
+
+
+class ProxmoxTaskWatchers:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._watchers = {}
+        self.settings = {
+            'min_interval': DEFAULT_MIN_INTERVAL,
+            'max_interval': DEFAULT_MAX_INTERVAL,
+            'backoff': DEFAULT_BACKOFF,
+            'max_errors': DEFAULT_MAX_ERRORS
+        }
+        self.timeout = DEFAULT_TASK_TIMEOUT
+
+
+    def configure(self, timeout=None, **settings):
+        with self._lock:
+            if timeout is not None:
+                self.timeout = float(timeout)
+
+            for setting, value in settings.items():
+                if setting in self.settings and value is not None:
+                    self.settings[setting] = type(self.settings[setting])(value)
+
+
+    def get_watcher(self, proxmox_api, proxmox_node):
+        # one watcher per (Proxmox endpoint, node); clients are shared by the client registry
+        key = (id(proxmox_api), proxmox_node)
+
+        with self._lock:
+            if key not in self._watchers:
+                self._watchers[key] = ProxmoxNodeTaskWatcher(proxmox_api, proxmox_node, **self.settings)
+
+            return self._watchers[key]
+
+
+    def wait(self, proxmox_api, proxmox_node, upid, timeout=None):
+        # Proxmox returns no UPID for operations that completed synchronously
+        if not upid:
+            return {'upid': upid, 'status': 'stopped', 'exitstatus': 'OK'}
+
+        watcher = self.get_watcher(proxmox_api, proxmox_node_from_upid(upid, proxmox_node))
+        future = watcher.watch(upid)
+
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            watcher.unwatch(upid, future)
+            raise
+
+
+    def get_stats(self):
+        with self._lock:
+            watchers = list(self._watchers.values())
+
+        return {watcher.proxmox_node: watcher.get_stats() for watcher in watchers}
+
+
+# process-wide task watchers shared by all helper instances
+task_watchers = ProxmoxTaskWatchers()
@@ -0,0 +1,376 @@
+import asyncio
+import random
+import threading
+import time
+
+from proxmoxer import ResourceException
+from requests.adapters import HTTPAdapter
+from helpers.node_routing import url_node
+from requests.exceptions import ConnectionError as RequestsConnectionError, ConnectTimeout as RequestsConnectTimeout, Timeout as RequestsTimeout
+from urllib.parse import urlsplit
+from urllib3.exceptions import NewConnectionError
+
+
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 5
+DEFAULT_RETRY_BUDGET = 0.2
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+
+# only reads are retried: a POST/PUT/DELETE that timed out may still have been applied
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# responses that mean the backend (or the proxy in front of it) is unhealthy
+UNHEALTHY_STATUSES = (502, 503, 504)
+
+# retries that can be made in a burst; every request adds retry_budget retries back
+RETRY_BUCKET_SIZE = 10
+
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+BREAKER_HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(ResourceException):
+    # a ResourceException, so that helpers report it like any other failed Proxmox call
+    def __init__(self, breaker_name, retry_in=None):
+        if retry_in is None:
+            super().__init__(503, 'Service Unavailable', f"{breaker_name} is unavailable, waiting for a probe request to it")
+        else:
+            super().__init__(503, 'Service Unavailable', f"{breaker_name} is unavailable, not calling it for another {retry_in:.0f}s")
+
+        self.breaker_name = breaker_name
+
+
+def breaker_name(backend, url):
+    # one breaker per Proxmox node (cluster-wide calls share one) and per NetBox app/model
+    segments = urlsplit(url).path.strip('/').split('/')
+
+    if backend == 'proxmox':
+        segments = segments[2:] if segments[:2] == ['api2', 'json'] else segments
+
+        if len(segments) > 1 and segments[0] == 'nodes':
+            return f"proxmox:{segments[1]}"
+
+        return 'proxmox:cluster'
+
+    segments = segments[1:] if segments[:1] == ['api'] else segments
+
+    return f"{backend}:{'/'.join(segments[:2])}"
+
+
+def is_connect_error(e):
+    # the connection could not be made (refused, unreachable, timed out), so nothing was sent
+    if isinstance(e, RequestsConnectTimeout):
+        return True
+
+    return bool(e.args) and isinstance(getattr(e.args[0], 'reason', None), NewConnectionError)
+
+
+class CircuitBreaker:
+    # opens after `failure_threshold` failures in a row and fails fast for `reset_timeout`
+    # seconds; then lets one probe request through, and its outcome closes or re-opens it
+    def __init__(self, name, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = int(failure_threshold)
+        self.reset_timeout = float(reset_timeout)
+
+        self._lock = threading.Lock()
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+        self.stats = {
+            'successes': 0,
+            'failures': 0,
+            'rejected': 0,
+            'opened': 0
+        }
+
+
+    def before_request(self):
+        with self._lock:
+            if self.state == BREAKER_OPEN:
+                retry_in = self.opened_at + self.reset_timeout - time.monotonic()
+
+                if retry_in > 0:
+                    self.stats['rejected'] += 1
+                    raise CircuitOpenError(self.name, retry_in)
+
+                self.state = BREAKER_HALF_OPEN
+
+            if self.state == BREAKER_HALF_OPEN:
+                # everyone else fails fast until the probe has an outcome
+                if self.probing:
+                    self.stats['rejected'] += 1
+                    raise CircuitOpenError(self.name)
+
+                self.probing = True
+
+
+    def record_success(self):
+        with self._lock:
+            self.stats['successes'] += 1
+            self.state = BREAKER_CLOSED
+            self.failures = 0
+            self.probing = False
+
+
+    def record_failure(self):
+        with self._lock:
+            self.stats['failures'] += 1
+            self.failures += 1
+            self.probing = False
+
+            if self.state == BREAKER_HALF_OPEN or (self.state == BREAKER_CLOSED and self.failures >= self.failure_threshold):
+                self.state = BREAKER_OPEN
+                self.opened_at = time.monotonic()
+                self.stats['opened'] += 1
+
+
+    def record_aborted(self):
+        # the request ended without telling anything about the backend (e.g. it was cancelled):
+        # let the next request probe instead
+        with self._lock:
+            self.probing = False
+
+
+    def to_dict(self):
+        with self._lock:
+            return dict(
+                self.stats,
+                state=self.state,
+                consecutive_failures=self.failures,
+                open_seconds=round(time.monotonic() - self.opened_at, 3) if self.state != BREAKER_CLOSED else None
+            )
+
+
+class Transport:
+    # timeouts, retries and circuit breakers for every Proxmox and NetBox call. Retries are
+    # only made for reads, with jittered exponential backoff, and only while the retry budget
+    # (retry_budget retries per request, up to RETRY_BUCKET_SIZE) is not used up, so that
+    # retries cannot multiply the load on a backend that is already struggling.
+    def __init__(self, connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF, retry_budget=DEFAULT_RETRY_BUDGET, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.connect_timeout = float(connect_timeout)
+        self.read_timeout = float(read_timeout)
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+        self.max_backoff = float(max_backoff)
+        self.retry_budget = float(retry_budget)
+        self.failure_threshold = int(failure_threshold)
+        self.reset_timeout = float(reset_timeout)
+
+        self._lock = threading.Lock()
+        self._breakers = {}
+        self._retry_tokens = RETRY_BUCKET_SIZE
+
+        self.stats = {
+            'requests': 0,
+            'retries': 0,
+            'retries_denied': 0
+        }
+
+
+    def configure(self, connect_timeout=None, read_timeout=None, retries=None, backoff=None, max_backoff=None, retry_budget=None, failure_threshold=None, reset_timeout=None):
+        with self._lock:
+            if connect_timeout:
+                self.connect_timeout = float(connect_timeout)
+
+            if read_timeout:
+                self.read_timeout = float(read_timeout)
+
+            if retries is not None:
+                self.retries = int(retries)
+
+            if backoff is not None:
+                self.backoff = float(backoff)
+
+            if max_backoff is not None:
+                self.max_backoff = float(max_backoff)
+
+            if retry_budget is not None:
+                self.retry_budget = float(retry_budget)
+
+            if failure_threshold:
+                self.failure_threshold = int(failure_threshold)
+
+            if reset_timeout is not None:
+                self.reset_timeout = float(reset_timeout)
+
+            self._breakers = {}
+
+
+    def timeout(self):
+        return self.connect_timeout, self.read_timeout
+
+
+    def breaker(self, backend, url):
+        name = breaker_name(backend, url)
+
+        with self._lock:
+            if name not in self._breakers:
+                self._breakers[name] = CircuitBreaker(name, self.failure_threshold, self.reset_timeout)
+
+            return self._breakers[name]
+
+
+    def __begin(self):
+        with self._lock:
+            self.stats['requests'] += 1
+            self._retry_tokens = min(self._retry_tokens + self.retry_budget, RETRY_BUCKET_SIZE)
+
+
+    def __may_retry(self, method, attempt):
+        if method not in IDEMPOTENT_METHODS or attempt >= self.retries:
+            return False
+
+        with self._lock:
+            if self._retry_tokens < 1:
+                self.stats['retries_denied'] += 1
+                return False
+
+            self._retry_tokens -= 1
+            self.stats['retries'] += 1
+
+            return True
+
+
+    def retry_delay(self, attempt):
+        # "full jitter": retries of many callers do not arrive in lockstep
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+    def send(self, backend, method, url, send):
+        # send() makes one attempt and returns a requests.Response
+        breaker = self.breaker(backend, url)
+        self.__begin()
+        attempt = 0
+
+        while True:
+            breaker.before_request()
+
+            try:
+                response = send()
+            except (RequestsConnectionError, RequestsTimeout):
+                breaker.record_failure()
+
+                if not self.__may_retry(method, attempt):
+                    raise
+            except BaseException:
+                breaker.record_aborted()
+                raise
+            else:
+                if response.status_code not in UNHEALTHY_STATUSES:
+                    breaker.record_success()
+                    return response
+
+                breaker.record_failure()
+
+                if not self.__may_retry(method, attempt):
+                    return response
+
+                response.close()
+
+            time.sleep(self.retry_delay(attempt))
+            attempt += 1
+
+
+    async def send_async(self, backend, method, url, send, transient_errors=()):
+        # send() makes one attempt; transient_errors are the client's connection and timeout
+        # errors, and errors with a status_code in UNHEALTHY_STATUSES count as failures too
+        breaker = self.breaker(backend, url)
+        self.__begin()
+        attempt = 0
+
+        while True:
+            breaker.before_request()
+
+            try:
+                result = await send()
+            except asyncio.CancelledError:
+                breaker.record_aborted()
+                raise
+            except Exception as e:
+                if not isinstance(e, transient_errors) and getattr(e, 'status_code', None) not in UNHEALTHY_STATUSES:
+                    if getattr(e, 'status_code', None):
+                        # the backend answered
+                        breaker.record_success()
+                    else:
+                        breaker.record_aborted()
+
+                    raise
+
+                breaker.record_failure()
+
+                if not self.__may_retry(method, attempt):
+                    raise
+            else:
+                breaker.record_success()
+                return result
+
+            await asyncio.sleep(self.retry_delay(attempt))
+            attempt += 1
+
+
+    def get_stats(self):
+        with self._lock:
+            breakers = list(self._breakers.values())
+            transport_stats = dict(
+                self.stats,
+                connect_timeout=self.connect_timeout,
+                read_timeout=self.read_timeout,
+                retry_tokens=round(self._retry_tokens, 1)
+            )
+
+        transport_stats['breakers'] = {breaker.name: breaker.to_dict() for breaker in sorted(breakers, key=lambda breaker: breaker.name)}
+
+        return transport_stats
+
+
+class ResilientHTTPAdapter(HTTPAdapter):
+    # pooled requests adapter that sends every call through the shared transport. With
+    # node_routes (helpers/node_routing.py), node-scoped Proxmox calls go straight to the
+    # node; the adapter keeps a connection pool per host, so every node gets its own.
+    def __init__(self, backend, transport, node_routes=None, load_node_addresses=None, **kwargs):
+        self.backend = backend
+        self.transport = transport
+        self.node_routes = node_routes
+        self.load_node_addresses = load_node_addresses
+
+        super().__init__(**kwargs)
+
+
+    def send(self, request, **kwargs):
+        kwargs['timeout'] = self.transport.timeout()
+
+        return self.transport.send(self.backend, request.method, request.url, lambda: self.__send(request, **kwargs))
+
+
+    def __send(self, request, **kwargs):
+        direct_url = None
+
+        if self.node_routes and self.node_routes.enabled and url_node(request.url):
+            self.node_routes.ensure(self.load_node_addresses)
+            direct_url = self.node_routes.direct_url(request.url)
+
+        if direct_url:
+            direct_request = request.copy()
+            direct_request.url = direct_url
+
+            try:
+                return super().send(direct_request, **kwargs)
+            except RequestsConnectionError as e:
+                if not is_connect_error(e):
+                    raise
+
+                self.node_routes.mark_unreachable(request.url, e)
+
+        return super().send(request, **kwargs)
+
+
+# process-wide transport shared by all helper instances
+transport = Transport()
@@ -0,0 +1,62 @@
+import urllib.parse
+
+
+FIELD_UPDATED = 'updated'
+FIELD_UNCHANGED = 'unchanged'
+FIELD_FAILED = 'failed'
+
+
+def desired_vm_config(json_in, generate_gateway):
+    # the Proxmox config keys that NetBox's postchange snapshot asks for
+    vm_config = {}
+
+    if json_in['snapshots']['postchange']['vcpus'] and json_in['snapshots']['postchange']['memory']:
+        vm_config['cores'] = int(float(json_in['snapshots']['postchange']['vcpus']))
+        vm_config['memory'] = int(json_in['snapshots']['postchange']['memory'])
+
+    if json_in['data']['primary_ip'] and json_in['data']['primary_ip']['address']:
+        primary_ip = json_in['data']['primary_ip']['address']
+
+        vm_config['ipconfig0'] = f"ip={primary_ip},gw={generate_gateway(primary_ip)}"
+
+    if json_in['data']['custom_fields'].get('proxmox_public_ssh_key'):
+        vm_config['sshkeys'] = urllib.parse.quote(json_in['data']['custom_fields']['proxmox_public_ssh_key'].rstrip(), safe='')
+
+    return vm_config
+
+
+def comparable_config_value(key, value):
+    # Proxmox returns numbers as strings, property strings in its own order and SSH keys
+    # with its own escaping
+    if value is None:
+        return None
+
+    if key in ('cores', 'memory'):
+        return int(float(value))
+
+    if key == 'ipconfig0':
+        return dict(item.split('=', 1) for item in str(value).split(',') if '=' in item)
+
+    if key == 'sshkeys':
+        return urllib.parse.unquote(str(value)).strip()
+
+    return value
+
+
+def vm_config_changes(desired, current):
+    # (keys to send, per-field result) for moving the current config to the desired one
+    changes = {}
+    fields = {}
+
+    for key, value in desired.items():
+        if comparable_config_value(key, value) == comparable_config_value(key, current.get(key)):
+            fields[key] = FIELD_UNCHANGED
+        else:
+            changes[key] = value
+            fields[key] = FIELD_UPDATED
+
+    return changes, fields
+
+
+def vm_config_failed(fields):
+    return {key: FIELD_FAILED if result == FIELD_UPDATED else result for key, result in fields.items()}
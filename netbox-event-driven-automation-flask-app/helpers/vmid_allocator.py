@@ -0,0 +1,200 @@
+import asyncio
+import inspect
+import sqlite3
+import threading
+import time
+
+from contextlib import closing
+
+
+# Proxmox accepts vmids from 100 to 999999999
+DEFAULT_VMID_MIN = 100
+DEFAULT_VMID_MAX = 999999999
+DEFAULT_LEASE_TTL = 3600
+
+# how many taken vmids a reservation skips before giving up
+MAX_RESERVE_CANDIDATES = 100000
+
+MAX_MEMORY_LEASES = 1000
+
+# reserved vmids a clone or create tries when Proxmox reports them as taken
+VMID_RESERVE_ATTEMPTS = 3
+
+
+class VMIDAllocator:
+    # hands out vmids for new guests without asking Proxmox for cluster/nextid. A reserved
+    # vmid is leased for `lease_ttl` seconds, long enough for the guest to be created and
+    # show up in every listener's cluster inventory, so that parallel clones never get the
+    # same vmid. Set sqlite_path to share the lease table between listener processes.
+    def __init__(self, vmid_min=DEFAULT_VMID_MIN, vmid_max=DEFAULT_VMID_MAX, lease_ttl=DEFAULT_LEASE_TTL, sqlite_path=None, enabled=True):
+        self.enabled = enabled
+        self.vmid_min = int(vmid_min)
+        self.vmid_max = int(vmid_max)
+        self.lease_ttl = float(lease_ttl)
+        self.sqlite_path = sqlite_path
+
+        self._lock = threading.Lock()
+        self._leases = {}
+        self._cursor = self.vmid_min
+
+        self.stats = {
+            'reserved': 0,
+            'released': 0,
+            'skipped': 0
+        }
+
+        self.__create_table()
+
+
+    def configure(self, vmid_min=None, vmid_max=None, lease_ttl=None, sqlite_path=None, enabled=None):
+        with self._lock:
+            if enabled is not None:
+                self.enabled = bool(enabled)
+
+            if vmid_min:
+                self.vmid_min = int(vmid_min)
+
+            if vmid_max:
+                self.vmid_max = int(vmid_max)
+
+            if lease_ttl:
+                self.lease_ttl = float(lease_ttl)
+
+            if sqlite_path:
+                self.sqlite_path = sqlite_path
+
+            if self.vmid_min > self.vmid_max:
+                raise ValueError(f"vmid_min ({self.vmid_min}) is larger than vmid_max ({self.vmid_max})")
+
+            self._cursor = self.vmid_min
+
+        self.__create_table()
+
+
+    def __create_table(self):
+        if self.sqlite_path:
+            with self.__sqlite() as db:
+                db.execute("CREATE TABLE IF NOT EXISTS vmid_leases (vmid INTEGER PRIMARY KEY, expires REAL NOT NULL)")
+
+
+    def __sqlite(self):
+        # short-lived autocommit connections so several listener processes can share the file
+        return closing(sqlite3.connect(self.sqlite_path, timeout=10, isolation_level=None))
+
+
+    def __candidates(self, start=None):
+        # walk the range from `start` (or where the last reservation left off), wrapping around once
+        range_size = self.vmid_max - self.vmid_min + 1
+
+        if start is not None:
+            with self._lock:
+                self._cursor = min(max(int(start), self.vmid_min), self.vmid_max)
+
+        for _ in range(min(range_size, MAX_RESERVE_CANDIDATES)):
+            with self._lock:
+                vmid = self._cursor
+                self._cursor = vmid + 1 if vmid < self.vmid_max else self.vmid_min
+
+            yield vmid
+
+        raise ValueError(f"No free vmid between {self.vmid_min} and {self.vmid_max}")
+
+
+    def __lease(self, vmid):
+        now = time.time()
+
+        with self._lock:
+            if self._leases.get(vmid, 0) > now:
+                return False
+
+            if self.sqlite_path:
+                with self.__sqlite() as db:
+                    db.execute("DELETE FROM vmid_leases WHERE vmid = ? AND expires < ?", (vmid, now))
+
+                    if not db.execute("INSERT OR IGNORE INTO vmid_leases (vmid, expires) VALUES (?, ?)", (vmid, now + self.lease_ttl)).rowcount:
+                        return False
+
+            self._leases[vmid] = now + self.lease_ttl
+            self.stats['reserved'] += 1
+
+            # forget expired leases once the table grows
+            if len(self._leases) > MAX_MEMORY_LEASES:
+                self._leases = {leased_vmid: expires for leased_vmid, expires in self._leases.items() if expires > now}
+
+            return True
+
+
+    async def __lease_async(self, vmid):
+        # with sqlite_path, a lease is blocking SQLite I/O: keep it off the event loop
+        if self.sqlite_path:
+            return await asyncio.to_thread(self.__lease, vmid)
+
+        return self.__lease(vmid)
+
+
+    def reserve(self, is_used=None, start=None):
+        # is_used(vmid) says whether a guest with that vmid exists (see the cluster inventory)
+        for vmid in self.__candidates(start):
+            if is_used and is_used(vmid):
+                self.stats['skipped'] += 1
+                continue
+
+            if self.__lease(vmid):
+                return vmid
+
+            self.stats['skipped'] += 1
+
+
+    async def reserve_async(self, is_used=None, start=None):
+        # is_used may be a coroutine function here
+        for vmid in self.__candidates(start):
+            if is_used:
+                used = is_used(vmid)
+
+                if inspect.isawaitable(used):
+                    used = await used
+
+                if used:
+                    self.stats['skipped'] += 1
+                    continue
+
+            if await self.__lease_async(vmid):
+                return vmid
+
+            self.stats['skipped'] += 1
+
+
+    def release(self, vmid):
+        # the guest was not created after all
+        with self._lock:
+            self._leases.pop(int(vmid), None)
+            self.stats['released'] += 1
+
+            if self.sqlite_path:
+                with self.__sqlite() as db:
+                    db.execute("DELETE FROM vmid_leases WHERE vmid = ?", (int(vmid),))
+
+
+    async def release_async(self, vmid):
+        if self.sqlite_path:
+            return await asyncio.to_thread(self.release, vmid)
+
+        return self.release(vmid)
+
+
+    def get_stats(self):
+        now = time.time()
+
+        with self._lock:
+            return dict(
+                self.stats,
+                enabled=self.enabled,
+                vmid_min=self.vmid_min,
+                vmid_max=self.vmid_max,
+                leases=sum(1 for expires in self._leases.values() if expires > now),
+                backend='sqlite' if self.sqlite_path else 'memory'
+            )
+
+
+# process-wide allocator shared by all helper instances
+vmid_allocator = VMIDAllocator()
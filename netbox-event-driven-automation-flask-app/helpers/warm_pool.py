@@ -0,0 +1,439 @@
+import asyncio
+import fcntl
+import logging
+import os
+import re
+import tempfile
+import threading
+
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from helpers.clone_strategy import STRATEGY_FULL
+from helpers.cluster_inventory import cluster_inventory
+from helpers.metrics import time_task_wait, warm_pool_claims
+from helpers.task_watcher import task_watchers
+from helpers.vmid_allocator import vmid_allocator
+from proxmoxer import ResourceException
+
+
+DEFAULT_NAME_PREFIX = 'warm-pool'
+DEFAULT_REFILL_INTERVAL = 30
+DEFAULT_CLONE_TIMEOUT = 3600
+
+# gunicorn workers that share this lock file take turns refilling: one at a time
+DEFAULT_LOCK_FILE = os.path.join(tempfile.gettempdir(), 'netbox-proxmox-warm-pool.lock')
+
+# pooled VMs carry their pool in the description, which a claim removes
+POOL_DESCRIPTION = 'netbox-proxmox-automation warm pool: template={} node={} storage={}'
+POOL_DESCRIPTION_RE = re.compile(r'netbox-proxmox-automation warm pool: template=(\d+) node=(\S+) storage=(\S+)')
+
+
+def pool_key(template, node, storage):
+    return int(template), str(node), str(storage)
+
+
+class WarmPool:
+    # keeps `size` stopped full clones of a template per (template, node, storage), so that a
+    # created webhook renames one instead of waiting minutes for a full clone. Pooled VMs are
+    # named <name_prefix>-<template>-<vmid>, and are claimed by renaming them with Proxmox's
+    # config digest check, so two listener processes can never claim the same VM.
+    def __init__(self, pools=None, name_prefix=DEFAULT_NAME_PREFIX, refill_interval=DEFAULT_REFILL_INTERVAL, clone_timeout=DEFAULT_CLONE_TIMEOUT, lock_file=DEFAULT_LOCK_FILE, enabled=False):
+        self.enabled = enabled
+        self.name_prefix = name_prefix
+        self.refill_interval = float(refill_interval)
+        self.clone_timeout = float(clone_timeout)
+        self.lock_file = lock_file
+        self.pools = {}
+
+        self._lock = threading.Lock()
+        self._members = {}
+
+        self._thread = None
+        self._pid = None
+        self._lock_fd = None
+        self._refilling = False
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+
+        self.stats = {
+            'claimed': 0,
+            'misses': 0,
+            'claim_conflicts': 0,
+            'cloned': 0,
+            'clone_errors': 0
+        }
+
+        if pools:
+            self.__set_pools(pools)
+
+
+    def configure(self, pools=None, name_prefix=None, refill_interval=None, clone_timeout=None, lock_file=None, enabled=None):
+        with self._lock:
+            if enabled is not None:
+                self.enabled = bool(enabled)
+
+            if name_prefix:
+                self.name_prefix = name_prefix
+
+            if refill_interval:
+                self.refill_interval = float(refill_interval)
+
+            if clone_timeout:
+                self.clone_timeout = float(clone_timeout)
+
+            if lock_file:
+                self.lock_file = lock_file
+
+            if pools is not None:
+                self.__set_pools(pools)
+
+
+    def __set_pools(self, pools):
+        # [{'template': 9000, 'node': 'pve1', 'storage': 'local-lvm', 'size': 2}, ...]
+        self.pools = {pool_key(pool['template'], pool['node'], pool['storage']): int(pool.get('size', 1)) for pool in pools}
+
+
+    def has_pool(self, template, node, storage):
+        return self.enabled and pool_key(template, node, storage) in self.pools
+
+
+    def pool_name(self, template, vmid):
+        return f"{self.name_prefix}-{template}-{vmid}"
+
+
+    def __candidates(self, guests, key):
+        # VMs named like members of `key`'s pool, lowest vmid first
+        template, node, storage = key
+        prefix = f"{self.name_prefix}-{template}-"
+
+        return sorted(
+            int(guest['vmid']) for guest in guests
+            if guest.get('type') == 'qemu' and guest.get('node') == node and not guest.get('template') and str(guest.get('name') or '').startswith(prefix)
+        )
+
+
+    def __unknown(self, guests):
+        # pooled-looking VMs whose description has not been read yet
+        with self._lock:
+            return [
+                (int(guest['vmid']), guest['node']) for guest in guests
+                if guest.get('type') == 'qemu' and str(guest.get('name') or '').startswith(f"{self.name_prefix}-") and int(guest['vmid']) not in self._members
+            ]
+
+
+    def __learn(self, vmid, config):
+        match = POOL_DESCRIPTION_RE.search(str(config.get('description') or ''))
+
+        with self._lock:
+            self._members[vmid] = pool_key(*match.groups()) if match else None
+
+
+    def __short(self, guests):
+        # pools with fewer members than their size; VMs that are still being cloned count,
+        # VMs that were claimed (renamed) since the last refill do not
+        with self._lock:
+            present = {int(guest['vmid']) for guest in guests if str(guest.get('name') or '').startswith(f"{self.name_prefix}-")}
+            self._members = {vmid: key for vmid, key in self._members.items() if vmid in present}
+
+            return [
+                key for key, size in self.pools.items()
+                if sum(1 for vmid in self.__candidates(guests, key) if self._members.get(vmid) == key) < size
+            ]
+
+
+    def __is_ready(self, config, key):
+        # a VM that is still being cloned is locked
+        match = POOL_DESCRIPTION_RE.search(str(config.get('description') or ''))
+
+        return not config.get('lock') and match is not None and pool_key(*match.groups()) == key
+
+
+    def __clone_request(self, key):
+        # what proxmox_plan_clone needs to know about a pool's clones
+        template, node, storage = key
+
+        return {'data': {'custom_fields': {'proxmox_vm_templates': template, 'proxmox_node': node, 'proxmox_vm_storage': storage}}}
+
+
+    def __clone_data(self, key, vmid, clone_plan):
+        template, node, storage = key
+
+        return dict(
+            clone_plan.clone_args(),
+            newid=vmid,
+            name=self.pool_name(template, vmid),
+            target=node,
+            description=POOL_DESCRIPTION.format(template, node, storage)
+        )
+
+
+    def __cloned(self, key, vmid, ok):
+        with self._lock:
+            if ok:
+                self._members[vmid] = key
+                self.stats['cloned'] += 1
+            else:
+                self.stats['clone_errors'] += 1
+
+        if ok:
+            cluster_inventory.add_guest(vmid, self.pool_name(key[0], vmid), key[1], 'qemu', status='stopped')
+
+
+    def __claimed(self, vmid, name, node):
+        with self._lock:
+            self._members.pop(vmid, None)
+            self.stats['claimed'] += 1
+
+        warm_pool_claims.labels('claimed').inc()
+        cluster_inventory.add_guest(vmid, name, node, 'qemu', status='stopped')
+
+        # refill in the background
+        self._wake.set()
+
+        return vmid
+
+
+    def __missed(self):
+        with self._lock:
+            self.stats['misses'] += 1
+
+        warm_pool_claims.labels('empty').inc()
+        self._wake.set()
+
+
+    def __conflict(self):
+        with self._lock:
+            self.stats['claim_conflicts'] += 1
+
+
+    def claim(self, helper, template, node, storage, name):
+        # rename a pooled VM to `name` and return its vmid, or None when the pool is empty
+        if not self.has_pool(template, node, storage):
+            return None
+
+        key = pool_key(template, node, storage)
+
+        if cluster_inventory.enabled:
+            cluster_inventory.ensure(helper.proxmox_get_vm_resources)
+            guests = cluster_inventory.get_guests('qemu')
+        else:
+            guests = helper.proxmox_get_vm_resources()
+
+        for vmid in self.__candidates(guests, key):
+            try:
+                config = helper.proxmox_api.nodes(node).qemu(vmid).config.get()
+
+                if not self.__is_ready(config, key):
+                    continue
+
+                helper.proxmox_api.nodes(node).qemu(vmid).config.put(name=name, delete='description', digest=config['digest'])
+            except ResourceException:
+                # claimed by another listener process, or deleted
+                self.__conflict()
+                continue
+
+            return self.__claimed(vmid, name, node)
+
+        self.__missed()
+
+
+    async def claim_async(self, helper, template, node, storage, name):
+        if not self.has_pool(template, node, storage):
+            return None
+
+        key = pool_key(template, node, storage)
+
+        if cluster_inventory.enabled:
+            await cluster_inventory.ensure_async(helper.proxmox_get_vm_resources)
+            guests = cluster_inventory.get_guests('qemu')
+        else:
+            guests = await helper.proxmox_get_vm_resources()
+
+        for vmid in self.__candidates(guests, key):
+            try:
+                config = await helper.proxmox_api.get(f"nodes/{node}/qemu/{vmid}/config")
+
+                if not self.__is_ready(config, key):
+                    continue
+
+                await helper.proxmox_api.put(f"nodes/{node}/qemu/{vmid}/config", name=name, delete='description', digest=config['digest'])
+            except ResourceException:
+                self.__conflict()
+                continue
+
+            return self.__claimed(vmid, name, node)
+
+        self.__missed()
+
+
+    def refill(self, helper):
+        # clone one VM for every pool that is short; returns the number of VMs cloned. Like
+        # webhook clones, the clone is started on the template's node (helper.proxmox_plan_clone)
+        guests = helper.proxmox_get_vm_resources()
+
+        for vmid, node in self.__unknown(guests):
+            try:
+                self.__learn(vmid, helper.proxmox_api.nodes(node).qemu(vmid).config.get())
+            except ResourceException:
+                pass
+
+        cloned = 0
+
+        for key in self.__short(guests):
+            vmid = None
+
+            try:
+                clone_plan = helper.proxmox_plan_clone(self.__clone_request(key), STRATEGY_FULL)
+                vmid, clone_task = helper.proxmox_create_with_vmid(None, lambda vmid: helper.proxmox_api.nodes(clone_plan.source_node).qemu(key[0]).clone.post(**self.__clone_data(key, vmid, clone_plan)))
+
+                with time_task_wait('warm_pool') as task_wait:
+                    try:
+                        ok = task_watchers.wait(helper.proxmox_api, clone_plan.source_node, clone_task, self.clone_timeout).get('exitstatus') == 'OK'
+                    except FutureTimeoutError:
+                        task_wait['value'] = 'timeout'
+                        raise
+
+                    task_wait['value'] = 'ok' if ok else 'failed'
+            except Exception as e:
+                logging.warning(f"Unable to clone template {key[0]} into the warm pool on {key[1]}: {e}")
+                ok = False
+
+            if not ok and vmid:
+                vmid_allocator.release(vmid)
+
+            self.__cloned(key, vmid, ok)
+            cloned += ok
+
+        return cloned
+
+
+    async def refill_async(self, helper):
+        guests = await helper.proxmox_get_vm_resources()
+
+        for vmid, node in self.__unknown(guests):
+            try:
+                self.__learn(vmid, await helper.proxmox_api.get(f"nodes/{node}/qemu/{vmid}/config"))
+            except ResourceException:
+                pass
+
+        cloned = 0
+
+        for key in self.__short(guests):
+            vmid = None
+
+            try:
+                clone_plan = await helper.proxmox_plan_clone(self.__clone_request(key), STRATEGY_FULL)
+                vmid, clone_task = await helper.proxmox_create_with_vmid({'data': {'custom_fields': {}}}, await helper.proxmox_reserve_vmid(), lambda vmid: helper.proxmox_api.post(f"nodes/{clone_plan.source_node}/qemu/{key[0]}/clone", **self.__clone_data(key, vmid, clone_plan)))
+
+                ok = (await helper.proxmox_api.wait_for_task(clone_plan.source_node, clone_task, self.clone_timeout, kind='warm_pool')).get('exitstatus') == 'OK'
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"Unable to clone template {key[0]} into the warm pool on {key[1]}: {e}")
+                ok = False
+
+            if not ok and vmid:
+                await vmid_allocator.release_async(vmid)
+
+            self.__cloned(key, vmid, ok)
+            cloned += ok
+
+        return cloned
+
+
+    def start(self, helper):
+        # one refill thread per process; helper is a NetBoxProxmoxHelper for the clone source node.
+        # Only the process that holds an exclusive lock on lock_file refills; the others try
+        # again every refill_interval, and take over once that process has exited
+        with self._lock:
+            if self._thread and self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+            self._lock_fd = None
+            self._refilling = False
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self.__run, args=(helper,), name='warm-pool-refill', daemon=True)
+            self._thread.start()
+
+
+    def __hold_lock(self, lock_file):
+        # the lock is released by the operating system when this process exits
+        if self._lock_fd is not None:
+            return True
+
+        lock_fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(lock_fd)
+            return False
+
+        self._lock_fd = lock_fd
+        return True
+
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+
+    def __run(self, helper):
+        while not self._stop.is_set():
+            try:
+                self._refilling = not self.lock_file or self.__hold_lock(self.lock_file)
+                cloned = self.refill(helper) if self._refilling else 0
+            except Exception as e:
+                logging.warning(f"Unable to refill the warm pool: {e}")
+                cloned = 0
+
+            # keep cloning while pools are short, else wait for a claim or the next interval
+            if not cloned:
+                self._wake.wait(self.refill_interval)
+                self._wake.clear()
+
+
+    async def run_async(self, helper):
+        # for the asyncio listener (a single process): refill on the event loop instead of a thread
+        self._refilling = True
+
+        while True:
+            try:
+                cloned = await self.refill_async(helper)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"Unable to refill the warm pool: {e}")
+                cloned = 0
+
+            if not cloned:
+                waited = 0
+
+                while waited < self.refill_interval and not self._wake.is_set():
+                    await asyncio.sleep(1)
+                    waited += 1
+
+                self._wake.clear()
+
+
+    def get_stats(self):
+        with self._lock:
+            ready = {key: 0 for key in self.pools}
+
+            for key in self._members.values():
+                if key in ready:
+                    ready[key] += 1
+
+            return dict(
+                self.stats,
+                enabled=self.enabled,
+                refilling=self._refilling,
+                pools=[
+                    {'template': key[0], 'node': key[1], 'storage': key[2], 'size': size, 'members': ready[key]}
+                    for key, size in self.pools.items()
+                ]
+            )
+
+
+# process-wide pool shared by all helper instances
+warm_pool = WarmPool()
@@ -0,0 +1,176 @@
+from helpers.dedupe_store import dedupe_key
+from helpers.webhook_router import webhook_route_key
+from types import MappingProxyType
+
+
+def webhook_lane_key(webhook_event):
+    # NetBox VM ID when we have one, else the Proxmox vmid
+    if webhook_event.netbox_vm_id:
+        return f"netbox-vm-{webhook_event.netbox_vm_id}"
+
+    if webhook_event.vmid:
+        return f"proxmox-vmid-{webhook_event.vmid}"
+
+    return None
+
+
+def snapshot_changes(snapshots):
+    # field -> (prechange, postchange) for the fields that changed; custom fields as
+    # 'custom_fields.<name>'
+    prechange = snapshots.get('prechange') or {}
+    postchange = snapshots.get('postchange') or {}
+    changes = {}
+
+    for key in postchange.keys() & prechange.keys():
+        if key == 'custom_fields' and isinstance(postchange[key], dict) and isinstance(prechange[key], dict):
+            for field in postchange[key].keys() | prechange[key].keys():
+                if postchange[key].get(field) != prechange[key].get(field):
+                    changes[f"custom_fields.{field}"] = (prechange[key].get(field), postchange[key].get(field))
+        elif postchange[key] != prechange[key]:
+            changes[key] = (prechange[key], postchange[key])
+
+    return changes
+
+
+def snapshot_changed(snapshots, field):
+    # whether `field` is in snapshot_changes(snapshots), without diffing every field
+    prechange = snapshots.get('prechange') or {}
+    postchange = snapshots.get('postchange') or {}
+
+    if field.startswith('custom_fields.'):
+        if not isinstance(prechange.get('custom_fields'), dict) or not isinstance(postchange.get('custom_fields'), dict):
+            return False
+
+        name = field[len('custom_fields.'):]
+
+        return prechange['custom_fields'].get(name) != postchange['custom_fields'].get(name)
+
+    if field not in prechange or field not in postchange:
+        return False
+
+    if field == 'custom_fields' and isinstance(prechange[field], dict) and isinstance(postchange[field], dict):
+        return False
+
+    return prechange[field] != postchange[field]
+
+
+class Immutable:
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            object.__setattr__(self, name, fields.get(name))
+
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__ if name not in ('payload', 'snapshots') and not name.startswith('_'))})"
+
+
+class WebhookDisk(Immutable):
+    __slots__ = ('name', 'size', 'prechange_size', 'storage', 'netbox_vm_id')
+
+
+class WebhookEvent(Immutable):
+    # one NetBox webhook, parsed once when it arrives. `payload` is the JSON that NetBox sent,
+    # for the helpers that take it as it is. What only some webhooks need (changes, disk,
+    # dedupe_key) is worked out when it is first asked for
+    __slots__ = (
+        'model', 'event', 'request_id', 'object_id', 'netbox_vm_id', 'name', 'vmid', 'node', 'vm_type',
+        'has_node', 'status', 'prechange_node', 'prechange_status', 'disk_resized', 'snapshots', 'payload',
+        '_changes', '_disk'
+    )
+
+    @classmethod
+    def from_json(cls, webhook_json_data):
+        webhook_data = webhook_json_data['data']
+        custom_fields = webhook_data.get('custom_fields') if isinstance(webhook_data.get('custom_fields'), dict) else {}
+        snapshots = webhook_json_data.get('snapshots') if isinstance(webhook_json_data.get('snapshots'), dict) else {}
+        prechange = snapshots.get('prechange') or {}
+
+        fields = {
+            'model': webhook_json_data['model'],
+            'event': webhook_json_data['event'],
+            'request_id': webhook_json_data.get('request_id'),
+            'object_id': webhook_data.get('id'),
+            'name': webhook_data.get('name'),
+            'snapshots': snapshots,
+            'payload': webhook_json_data
+        }
+
+        if custom_fields.get('proxmox_vmid'):
+            fields['vmid'] = int(custom_fields['proxmox_vmid'])
+
+        if fields['model'] == 'virtualdisk':
+            virtual_machine = webhook_data.get('virtual_machine') if isinstance(webhook_data.get('virtual_machine'), dict) else {}
+
+            fields['netbox_vm_id'] = virtual_machine.get('id')
+            fields['vm_type'] = 'lxc' if webhook_data.get('name') == 'rootfs' else 'vm'
+            fields['disk_resized'] = webhook_data.get('size') != prechange.get('size')
+        else:
+            fields['netbox_vm_id'] = webhook_data.get('id')
+            fields['vm_type'] = custom_fields.get('proxmox_vm_type')
+            fields['node'] = custom_fields.get('proxmox_node')
+            fields['has_node'] = 'proxmox_node' in custom_fields
+            fields['status'] = (webhook_data.get('status') or {}).get('value')
+            fields['prechange_node'] = (prechange.get('custom_fields') or {}).get('proxmox_node')
+            fields['prechange_status'] = prechange.get('status')
+
+        return cls(**fields)
+
+
+    @property
+    def route_key(self):
+        return webhook_route_key(self)
+
+
+    @property
+    def lane_key(self):
+        return webhook_lane_key(self)
+
+
+    @property
+    def dedupe_key(self):
+        return dedupe_key(self.request_id, self.model, self.object_id, self.event)
+
+
+    @property
+    def changes(self):
+        # field -> (prechange, postchange), see snapshot_changes
+        if self._changes is None:
+            object.__setattr__(self, '_changes', MappingProxyType(snapshot_changes(self.snapshots)))
+
+        return self._changes
+
+
+    @property
+    def disk(self):
+        # virtual disk webhooks only
+        if self._disk is None and self.model == 'virtualdisk':
+            webhook_data = self.payload['data']
+            custom_fields = webhook_data.get('custom_fields') if isinstance(webhook_data.get('custom_fields'), dict) else {}
+            virtual_machine = webhook_data.get('virtual_machine') if isinstance(webhook_data.get('virtual_machine'), dict) else {}
+
+            object.__setattr__(self, '_disk', WebhookDisk(
+                name=webhook_data.get('name'),
+                size=webhook_data.get('size'),
+                prechange_size=(self.snapshots.get('prechange') or {}).get('size'),
+                storage=custom_fields.get('proxmox_disk_storage_volume'),
+                netbox_vm_id=virtual_machine.get('id')
+            ))
+
+        return self._disk
+
+
+    def changed(self, *fields):
+        if self._changes is not None:
+            return any(field in self._changes for field in fields)
+
+        return any(snapshot_changed(self.snapshots, field) for field in fields)
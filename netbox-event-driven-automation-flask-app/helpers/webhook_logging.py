@@ -0,0 +1,215 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+
+from datetime import datetime, timezone
+
+
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 5
+DEFAULT_PAYLOAD_MAX_BYTES = 4096
+DEFAULT_PAYLOAD_SAMPLE_RATE = 0.01
+
+# attributes every LogRecord has; anything else was passed with extra={...}
+LOG_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+
+class JsonLinesFormatter(logging.Formatter):
+    # runs on the background thread. Payloads arrive already serialized (payload_json): the
+    # handlers change the webhook dict while the record waits in the queue
+    def __init__(self, payload_max_bytes=DEFAULT_PAYLOAD_MAX_BYTES):
+        super().__init__()
+        self.payload_max_bytes = int(payload_max_bytes)
+
+
+    def format(self, record):
+        log_entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'message': record.getMessage()
+        }
+
+        for attribute, value in vars(record).items():
+            if attribute not in LOG_RECORD_ATTRIBUTES:
+                log_entry[attribute] = value
+
+        payload_json = log_entry.pop('payload_json', None)
+
+        if payload_json is not None:
+            log_entry['payload_bytes'] = len(payload_json)
+
+            if len(payload_json) > self.payload_max_bytes:
+                log_entry['payload'] = payload_json[:self.payload_max_bytes]
+                log_entry['payload_truncated'] = True
+            else:
+                return json.dumps(log_entry, default=str)[:-1] + f', "payload": {payload_json}}}'
+
+        return json.dumps(log_entry, default=str)
+
+
+class WebhookPayload:
+    # a webhook's JSON, serialized at most once and shared by the log and capture records. It
+    # is serialized on the request thread, because the handlers change the webhook dict while
+    # the records wait in the queue. size is the request's Content-Length, when known
+    __slots__ = ('data', 'size', '_json')
+
+    def __init__(self, data, size=None):
+        self.data = data
+        self.size = size
+        self._json = None
+
+
+    @property
+    def is_serialized(self):
+        return self._json is not None
+
+
+    @property
+    def json(self):
+        if self._json is None:
+            self._json = json.dumps(self.data, default=str)
+
+        return self._json
+
+
+class BackgroundLogHandler(logging.handlers.QueueHandler):
+    # hands records to a QueueListener thread that owns the (blocking) file handlers.
+    # The listener is started on first use in each process, because threads (and file
+    # handlers that rotate) must not be shared across a gunicorn fork.
+    def __init__(self, handler_factory):
+        super().__init__(queue.SimpleQueue())
+
+        self.handler_factory = handler_factory
+
+        self._start_lock = threading.Lock()
+        self._listener = None
+        self._pid = None
+
+        atexit.register(self.stop)
+
+
+    def __start_listener(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+
+            self.queue = queue.SimpleQueue()
+            self._listener = logging.handlers.QueueListener(self.queue, *self.handler_factory(), respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self.__start_listener()
+
+        super().emit(record)
+
+
+    def stop(self):
+        # flush whatever is still queued
+        with self._start_lock:
+            if self._listener and self._pid == os.getpid():
+                self._listener.stop()
+
+                for handler in self._listener.handlers:
+                    handler.close()
+
+                self._listener = None
+                self._pid = None
+
+
+def webhook_logger(app_name, log_config=None):
+    log_config = log_config or {}
+
+    log_file = log_config.get('file') or f"{app_name}.log"
+    max_bytes = int(log_config.get('max_bytes', DEFAULT_MAX_BYTES))
+    backup_count = int(log_config.get('backup_count', DEFAULT_BACKUP_COUNT))
+    payload_max_bytes = int(log_config.get('payload_max_bytes', DEFAULT_PAYLOAD_MAX_BYTES))
+
+    def handler_factory():
+        # '{pid}' in the file name gives every worker process its own log file
+        file_logging = logging.handlers.RotatingFileHandler(log_file.replace('{pid}', str(os.getpid())), maxBytes=max_bytes, backupCount=backup_count)
+        file_logging.setFormatter(JsonLinesFormatter(payload_max_bytes))
+
+        return [file_logging]
+
+    logger = logging.getLogger(app_name)
+    logger.setLevel(logging.getLevelName(str(log_config.get('level', 'INFO')).upper()))
+    logger.propagate = False
+
+    for handler in list(logger.handlers):
+        if isinstance(handler, BackgroundLogHandler):
+            handler.stop()
+
+        logger.removeHandler(handler)
+
+    logger.addHandler(BackgroundLogHandler(handler_factory))
+
+    return logger
+
+
+def log_webhook(logger, payload, sample_rate=DEFAULT_PAYLOAD_SAMPLE_RATE, payload_max_bytes=DEFAULT_PAYLOAD_MAX_BYTES, message="Webhook received", **fields):
+    # every webhook is logged with its identifying fields; the full payload only for a sample.
+    # A payload that is known to be too big is not serialized just to be cut off
+    webhook_json_data = payload.data
+
+    if isinstance(webhook_json_data, dict):
+        fields['model'] = webhook_json_data.get('model')
+        fields['event'] = webhook_json_data.get('event')
+        fields['request_id'] = webhook_json_data.get('request_id')
+
+        if isinstance(webhook_json_data.get('data'), dict):
+            fields['object_id'] = webhook_json_data['data'].get('id')
+            fields['object_name'] = webhook_json_data['data'].get('name')
+
+    if sample_rate >= 1 or (sample_rate > 0 and random.random() < sample_rate):
+        if payload.is_serialized or not payload.size or payload.size <= payload_max_bytes:
+            fields['payload_json'] = payload.json
+        else:
+            fields['payload_bytes'] = payload.size
+            fields['payload_truncated'] = True
+
+    logger.info(message, extra=fields)
+
+
+class WebhookCaptureFormatter(logging.Formatter):
+    # one replayable record per line: {"received": <epoch seconds>, "payload": {...}}
+    def format(self, record):
+        return f'{{"received": {json.dumps(record.created)}, "payload": {record.payload_json}}}'
+
+
+def webhook_capture_logger(capture_file):
+    def handler_factory():
+        file_capture = logging.FileHandler(capture_file.replace('{pid}', str(os.getpid())))
+        file_capture.setFormatter(WebhookCaptureFormatter())
+
+        return [file_capture]
+
+    capture_logger = logging.getLogger('netbox-proxmox-webhook-capture')
+    capture_logger.setLevel(logging.INFO)
+    capture_logger.propagate = False
+
+    for handler in list(capture_logger.handlers):
+        if isinstance(handler, BackgroundLogHandler):
+            handler.stop()
+
+        capture_logger.removeHandler(handler)
+
+    capture_logger.addHandler(BackgroundLogHandler(handler_factory))
+
+    return capture_logger
+
+
+def capture_webhook(capture_logger, payload):
+    # payloads are kept whole (no size cap), so that they can be replayed. Capture before
+    # log_webhook, which then reuses the serialized payload
+    if capture_logger and isinstance(payload.data, dict):
+        capture_logger.info("Webhook captured", extra={'payload_json': payload.json})
@@ -0,0 +1,220 @@
+import bisect
+import threading
+import time
+
+from helpers.metrics import record_webhook, webhooks_running
+
+
+# upper bounds (seconds) of the latency histogram buckets; the last bucket is +Inf
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+VM_STATUSES = ('offline', 'active')
+
+DEFAULT_RESULTS = {
+    'virtualmachine': (500, {'result': 'Default error message (obviously something has gone wrong)'}),
+    'virtualdisk': (500, {'result': 'Something has gone wrong with virtualdisk management'})
+}
+
+
+def webhook_route_key(webhook_event):
+    # normalize a WebhookEvent (helpers/webhook_event.py) to (model, vm_type, status, event,
+    # change); fields that do not matter for routing the event are None
+    model = webhook_event.model
+    event = webhook_event.event
+
+    if model == 'virtualmachine':
+        if not webhook_event.has_node:
+            return (model, None, None, None, 'missing-proxmox-node')
+
+        vm_type = webhook_event.vm_type
+        status = webhook_event.status
+        change = None
+
+        if status != 'staged':
+            if status not in VM_STATUSES:
+                status = 'other'
+
+            # running VMs are started/stopped or migrated depending on what changed
+            if vm_type == 'vm' and event == 'updated':
+                if webhook_event.node != webhook_event.prechange_node:
+                    change = 'node'
+                elif webhook_event.status != webhook_event.prechange_status:
+                    change = 'status'
+
+        return (model, vm_type, status, event, change)
+
+    if model == 'virtualdisk':
+        change = None
+
+        if event == 'updated' and webhook_event.disk_resized:
+            change = 'size'
+
+        return (model, webhook_event.vm_type, None, event, change)
+
+    return (model, None, None, event, None)
+
+
+def build_webhook_routes():
+    # declarative routing table: normalized event tuple -> operation name
+    routes = {}
+
+    routes[('virtualmachine', None, None, None, 'missing-proxmox-node')] = 'missing-proxmox-node'
+
+    routes[('virtualmachine', 'vm', 'staged', 'created', None)] = 'vm-clone'
+    routes[('virtualmachine', 'vm', 'staged', 'updated', None)] = 'vm-update-config'
+    routes[('virtualmachine', 'vm', 'staged', 'deleted', None)] = 'vm-delete'
+
+    for status in VM_STATUSES + ('other',):
+        routes[('virtualmachine', 'vm', status, 'deleted', None)] = 'vm-delete'
+        routes[('virtualmachine', 'lxc', status, 'deleted', None)] = 'lxc-delete'
+        routes[('virtualmachine', 'lxc', status, 'created', None)] = 'unknown-event'
+
+    for status in VM_STATUSES:
+        routes[('virtualmachine', 'vm', status, 'updated', 'node')] = 'vm-migrate'
+
+    routes[('virtualmachine', 'vm', 'offline', 'updated', 'status')] = 'vm-stop'
+    routes[('virtualmachine', 'vm', 'active', 'updated', 'status')] = 'vm-start'
+
+    for change in (None, 'node', 'status'):
+        routes[('virtualmachine', 'vm', 'other', 'updated', change)] = 'unknown-status'
+
+    routes[('virtualmachine', 'lxc', 'staged', 'created', None)] = 'lxc-create'
+    routes[('virtualmachine', 'lxc', 'staged', 'updated', None)] = 'lxc-update-config'
+    routes[('virtualmachine', 'lxc', 'staged', 'deleted', None)] = 'lxc-delete'
+    routes[('virtualmachine', 'lxc', 'offline', 'updated', None)] = 'lxc-stop'
+    routes[('virtualmachine', 'lxc', 'active', 'updated', None)] = 'lxc-start'
+    routes[('virtualmachine', 'lxc', 'other', 'updated', None)] = 'unknown-status'
+
+    routes[('virtualdisk', 'lxc', None, 'updated', 'size')] = 'lxc-resize-disk'
+    routes[('virtualdisk', 'lxc', None, 'deleted', None)] = 'lxc-delete-disk'
+    routes[('virtualdisk', 'vm', None, 'created', None)] = 'vm-add-disk'
+    routes[('virtualdisk', 'vm', None, 'updated', None)] = 'vm-resize-disk'
+    routes[('virtualdisk', 'vm', None, 'updated', 'size')] = 'vm-resize-disk'
+    routes[('virtualdisk', 'vm', None, 'deleted', None)] = 'vm-delete-disk'
+
+    # disk webhooks for one VM folded together (see helpers/disk_batch.py)
+    routes[('virtualdisk', 'vm', None, 'batch', None)] = 'vm-disk-batch'
+
+    return routes
+
+
+WEBHOOK_ROUTES = build_webhook_routes()
+
+
+class WebhookRoute:
+    __slots__ = ('name', 'handler', 'calls', 'errors', 'exceptions', 'total_seconds', 'max_seconds', 'buckets')
+
+    def __init__(self, name, handler):
+        self.name = name
+        self.handler = handler
+
+        self.calls = 0
+        self.errors = 0
+        self.exceptions = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'exceptions': self.exceptions,
+            'total_seconds': round(self.total_seconds, 6),
+            'avg_seconds': round(self.total_seconds / self.calls, 6) if self.calls else 0.0,
+            'max_seconds': round(self.max_seconds, 6),
+            'latency_buckets': {
+                str(bound): count for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), self.buckets)
+            }
+        }
+
+
+class WebhookRouter:
+    def __init__(self, handlers, routes=WEBHOOK_ROUTES, default_results=DEFAULT_RESULTS):
+        missing_handlers = set(routes.values()) - set(handlers)
+
+        if missing_handlers:
+            raise ValueError(f"No handler for webhook route(s): {', '.join(sorted(missing_handlers))}")
+
+        self._lock = threading.Lock()
+        self.default_results = default_results
+
+        # one WebhookRoute (and one set of counters) per operation, shared by all the keys
+        # that resolve to it
+        self.routes = {name: WebhookRoute(name, handlers[name]) for name in set(routes.values())}
+        self.unrouted = WebhookRoute('unrouted', None)
+
+        self._table = {key: self.routes[name] for key, name in routes.items()}
+
+
+    def resolve(self, webhook_event):
+        # webhook_event is a helpers.webhook_event.WebhookEvent, which carries its route key
+        return self._table.get(webhook_event.route_key, self.unrouted)
+
+
+    def default_result(self, webhook_event):
+        return self.default_results.get(webhook_event.model, DEFAULT_RESULTS['virtualmachine'])
+
+
+    def record(self, route, webhook_event, seconds, results=None, failed=False):
+        record_webhook(route.name, webhook_event.model, webhook_event.event, None if failed else results, seconds)
+
+        with self._lock:
+            route.calls += 1
+            route.total_seconds += seconds
+            route.max_seconds = max(route.max_seconds, seconds)
+            route.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+            if failed:
+                route.exceptions += 1
+            elif not results or results[0] >= 400:
+                route.errors += 1
+
+
+    def dispatch(self, webhook_event):
+        route = self.resolve(webhook_event)
+        start_time = time.monotonic()
+        results = None
+
+        try:
+            if route.handler:
+                with webhooks_running.labels(route.name).track_inprogress():
+                    results = route.handler(webhook_event)
+            else:
+                results = self.default_result(webhook_event)
+        except Exception:
+            self.record(route, webhook_event, time.monotonic() - start_time, failed=True)
+            raise
+
+        self.record(route, webhook_event, time.monotonic() - start_time, results)
+
+        return results
+
+
+    async def dispatch_async(self, webhook_event):
+        route = self.resolve(webhook_event)
+        start_time = time.monotonic()
+        results = None
+
+        try:
+            if route.handler:
+                with webhooks_running.labels(route.name).track_inprogress():
+                    results = await route.handler(webhook_event)
+            else:
+                results = self.default_result(webhook_event)
+        except Exception:
+            self.record(route, webhook_event, time.monotonic() - start_time, failed=True)
+            raise
+
+        self.record(route, webhook_event, time.monotonic() - start_time, results)
+
+        return results
+
+
+    def get_stats(self):
+        with self._lock:
+            route_stats = {name: route.to_dict() for name, route in sorted(self.routes.items()) if route.calls}
+            route_stats['unrouted'] = self.unrouted.to_dict()
+
+            return route_stats
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import aiohttp
+import copy
+import json
+import re
+import sys
+import time
+import uuid
+
+from urllib.parse import urlsplit
+
+from benchmark_listeners import load_records, percentile, is_error_response
+
+
+PROXMOX_CALLS_METRIC = 'netbox_proxmox_proxmox_api_requests_total'
+METRIC_LINE = re.compile(r'^(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*)(\{(?P<labels>.*)\})?\s+(?P<value>\S+)$')
+METRIC_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Replay captured NetBox webhooks against a running listener and report latency, errors and Proxmox API calls")
+    parser.add_argument("--payloads", required=True, help="JSONL file with captured webhooks (webhook_capture) or bare NetBox webhook payloads")
+    parser.add_argument("--url", required=True, help="Listener webhook URL, e.g. http://127.0.0.1:8000/netbox-proxmox-webhook/")
+
+    pacing = parser.add_mutually_exclusive_group()
+    pacing.add_argument("--concurrency", type=int, default=10, help="Number of webhooks in flight at once (default)")
+    pacing.add_argument("--rate", type=float, help="Send webhooks at this many per second, regardless of how fast the listener answers")
+    pacing.add_argument("--speed", type=float, help="Keep the captured arrival times, sped up by this factor (1 = real time)")
+
+    parser.add_argument("--repeat", type=int, default=1, help="Replay the payload file this many times")
+    parser.add_argument("--timeout", type=float, default=900, help="Per-webhook timeout in seconds")
+    parser.add_argument("--keep-request-ids", action='store_true', default=False, help="Do not give each replayed webhook a fresh request_id")
+    parser.add_argument("--wait-jobs", action='store_true', default=False, help="For asynchronous listeners (202 + job_id), measure until the job has finished")
+    parser.add_argument("--metrics-url", help="Listener /metrics URL (default: /metrics on the listener host)")
+    parser.add_argument("--no-metrics", action='store_true', default=False, help="Do not read Proxmox API call counts from /metrics")
+    parser.add_argument("--json", action='store_true', default=False, help="Print the report as JSON")
+
+    return parser.parse_args()
+
+
+def parse_metrics(metrics_text, metric_name):
+    # {labels tuple: value} for every sample of metric_name
+    samples = {}
+
+    for line in metrics_text.splitlines():
+        if not line.startswith(metric_name):
+            continue
+
+        match = METRIC_LINE.match(line)
+
+        if not match or match.group('name') != metric_name:
+            continue
+
+        labels = tuple(sorted(METRIC_LABEL.findall(match.group('labels') or '')))
+        samples[labels] = samples.get(labels, 0.0) + float(match.group('value'))
+
+    return samples
+
+
+async def read_proxmox_calls(http_session, metrics_url):
+    if not metrics_url:
+        return None
+
+    try:
+        async with http_session.get(metrics_url) as resp:
+            if resp.status != 200:
+                return None
+
+            return parse_metrics(await resp.text(), PROXMOX_CALLS_METRIC)
+    except aiohttp.ClientError:
+        return None
+
+
+def proxmox_calls_delta(before, after):
+    if before is None or after is None:
+        return None
+
+    calls_by_endpoint = {}
+
+    for labels, value in after.items():
+        delta = value - before.get(labels, 0.0)
+
+        if delta > 0:
+            label_values = dict(labels)
+            endpoint = f"{label_values.get('method', '')} {label_values.get('endpoint', '')}"
+            calls_by_endpoint[endpoint] = calls_by_endpoint.get(endpoint, 0) + int(delta)
+
+    return calls_by_endpoint
+
+
+class JobNotFoundError(Exception):
+    pass
+
+
+async def wait_for_job(http_session, url, job_id, deadline):
+    job_url = f"{url.rstrip('/')}/jobs/{job_id}/"
+
+    while time.perf_counter() < deadline:
+        async with http_session.get(job_url) as resp:
+            # jobs are only known to the process that accepted the webhook
+            if resp.status == 404:
+                raise JobNotFoundError(f"Job {job_id} is unknown to the listener at {job_url}; --wait-jobs needs a listener with a single worker process")
+
+            job_info = await resp.json(content_type=None)
+
+        if job_info.get('state') in ('finished', 'failed'):
+            return job_info['state'] == 'finished' and (job_info.get('status') or 500) < 400
+
+        await asyncio.sleep(0.25)
+
+    return False
+
+
+async def replay(args, records):
+    latencies = []
+    errors = 0
+
+    metrics_url = None
+
+    if not args.no_metrics:
+        listener_url = urlsplit(args.url)
+        metrics_url = args.metrics_url or f"{listener_url.scheme}://{listener_url.netloc}/metrics"
+
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=args.timeout)) as http_session:
+        async def send(payload):
+            nonlocal errors
+
+            if not args.keep_request_ids:
+                payload = copy.copy(payload)
+                payload['request_id'] = str(uuid.uuid4())
+
+            start_time = time.perf_counter()
+            failed = False
+
+            try:
+                async with http_session.post(args.url, json=payload) as resp:
+                    body = await resp.text()
+                    failed = is_error_response(resp.status, body)
+
+                    if args.wait_jobs and resp.status == 202:
+                        job_id = json.loads(body).get('job_id')
+
+                        if job_id:
+                            failed = not await wait_for_job(http_session, args.url, job_id, start_time + args.timeout)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                failed = True
+
+            if failed:
+                errors += 1
+
+            latencies.append(time.perf_counter() - start_time)
+
+        proxmox_calls_before = await read_proxmox_calls(http_session, metrics_url)
+
+        start_time = time.perf_counter()
+
+        if args.rate or args.speed:
+            # open loop: webhooks go out on schedule, however long earlier ones take
+            captured_times = [received for received, _ in records if received is not None]
+            sends = []
+
+            for index, (received, payload) in enumerate(records * args.repeat):
+                if args.speed and received is not None:
+                    # repeats of the capture follow each other back to back
+                    cycle = index // len(records)
+                    capture_span = max(captured_times) - min(captured_times)
+                    send_at = start_time + (received - min(captured_times) + cycle * capture_span) / args.speed
+                else:
+                    send_at = start_time + index / (args.rate or 1.0)
+
+                await asyncio.sleep(max(0.0, send_at - time.perf_counter()))
+                sends.append(asyncio.ensure_future(send(payload)))
+
+            await asyncio.gather(*sends)
+        else:
+            semaphore = asyncio.Semaphore(args.concurrency)
+
+            async def send_limited(payload):
+                async with semaphore:
+                    await send(payload)
+
+            await asyncio.gather(*(send_limited(payload) for _, payload in records * args.repeat))
+
+        elapsed = time.perf_counter() - start_time
+
+        proxmox_calls = proxmox_calls_delta(proxmox_calls_before, await read_proxmox_calls(http_session, metrics_url))
+
+    requests_sent = len(latencies)
+
+    report = {
+        'requests': requests_sent,
+        'errors': errors,
+        'error_rate': errors / requests_sent,
+        'elapsed': elapsed,
+        'throughput': requests_sent / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99)
+    }
+
+    if proxmox_calls is not None:
+        report['proxmox_calls'] = sum(proxmox_calls.values())
+        report['proxmox_calls_per_event'] = report['proxmox_calls'] / requests_sent
+        report['proxmox_calls_by_endpoint'] = dict(sorted(proxmox_calls.items(), key=lambda endpoint: endpoint[1], reverse=True))
+
+    return report
+
+
+def print_report(report):
+    print(f"requests:        {report['requests']}")
+    print(f"errors:          {report['errors']} ({report['error_rate'] * 100:.1f}%)")
+    print(f"elapsed:         {report['elapsed']:.2f} s")
+    print(f"throughput:      {report['throughput']:.1f} webhooks/s")
+    print(f"latency p50:     {report['p50'] * 1000:.1f} ms")
+    print(f"latency p95:     {report['p95'] * 1000:.1f} ms")
+    print(f"latency p99:     {report['p99'] * 1000:.1f} ms")
+
+    if 'proxmox_calls' in report:
+        print(f"proxmox calls:   {report['proxmox_calls']} ({report['proxmox_calls_per_event']:.2f} per webhook)")
+
+        for endpoint, calls in report['proxmox_calls_by_endpoint'].items():
+            print(f"  {calls:>8}  {endpoint}")
+    else:
+        print("proxmox calls:   unavailable (no /metrics)")
+
+
+def main():
+    args = get_arguments()
+
+    records = load_records(args.payloads)
+
+    if not records:
+        raise ValueError(f"No payloads found in {args.payloads}")
+
+    try:
+        report = asyncio.run(replay(args, records))
+    except JobNotFoundError as e:
+        sys.exit(str(e))
+
+    if args.json:
+        print(json.dumps(report, indent=4))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
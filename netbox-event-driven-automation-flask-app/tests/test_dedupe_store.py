@@ -0,0 +1,98 @@
+import time
+
+import pytest
+
+from helpers.dedupe_store import dedupe_key, webhook_dedupe_key, WebhookDedupeStore, DEDUPE_STATE_DONE, DEDUPE_STATE_IN_PROGRESS
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def make_store(request, tmp_path):
+    def make_store(**settings):
+        if request.param == 'sqlite':
+            settings['sqlite_path'] = str(tmp_path / 'dedupe.sqlite')
+
+        return WebhookDedupeStore(**settings)
+
+    return make_store
+
+
+def test_dedupe_key():
+    webhook_json_data = {'request_id': 'abc', 'model': 'virtualmachine', 'event': 'updated', 'data': {'id': 7}}
+
+    assert webhook_dedupe_key(webhook_json_data) == dedupe_key('abc', 'virtualmachine', 7, 'updated') == 'abc:virtualmachine:7:updated'
+    assert webhook_dedupe_key(dict(webhook_json_data, request_id=None)) is None
+
+
+def test_begin_then_duplicate_while_in_progress(make_store):
+    store = make_store()
+
+    assert store.begin('k') == (True, pytest.approx({'state': DEDUPE_STATE_IN_PROGRESS, 'job_id': None, 'results': None, 'created': time.time()}, abs=5))
+
+    is_new_delivery, entry = store.begin('k')
+
+    assert not is_new_delivery
+    assert entry['state'] == DEDUPE_STATE_IN_PROGRESS
+
+
+def test_completed_delivery_is_answered_from_the_store(make_store):
+    store = make_store()
+    store.begin('k')
+    store.complete('k', (200, {'result': 'ok'}))
+
+    is_new_delivery, entry = store.begin('k')
+
+    assert not is_new_delivery
+    assert entry['state'] == DEDUPE_STATE_DONE
+    assert tuple(entry['results']) == (200, {'result': 'ok'})
+
+
+def test_failed_delivery_is_released(make_store):
+    store = make_store()
+    store.begin('k')
+    store.complete('k', (500, {'result': 'failed'}))
+
+    assert store.begin('k')[0]
+
+
+def test_release(make_store):
+    store = make_store()
+    store.begin('k')
+    store.release('k')
+
+    assert store.begin('k')[0]
+    assert store.get_stats()['released'] == 1
+
+
+def test_entries_expire_after_ttl(make_store):
+    store = make_store(ttl=0.2)
+    store.begin('k')
+    store.complete('k', (200, {'result': 'ok'}))
+
+    assert not store.begin('k')[0]
+
+    time.sleep(0.3)
+
+    assert store.begin('k')[0]
+
+
+def test_lost_in_progress_entries_expire_after_in_progress_ttl(make_store):
+    store = make_store(ttl=60, in_progress_ttl=0.2)
+    store.begin('k')
+
+    assert not store.begin('k')[0]
+
+    time.sleep(0.3)
+
+    assert store.begin('k')[0]
+
+
+def test_sqlite_store_is_shared(tmp_path):
+    first = WebhookDedupeStore(sqlite_path=str(tmp_path / 'dedupe.sqlite'))
+    second = WebhookDedupeStore(sqlite_path=str(tmp_path / 'dedupe.sqlite'))
+
+    assert first.begin('k')[0]
+    assert not second.begin('k')[0]
+
+    first.complete('k', (200, {'result': 'ok'}))
+
+    assert second.begin('k')[1]['state'] == DEDUPE_STATE_DONE
@@ -0,0 +1,64 @@
+from helpers.disk_batch import fold_disk_events, merge_disk_webhooks, BATCH_EVENT, DISK_OP_ADD, DISK_OP_DELETE, DISK_OP_REPLACE, DISK_OP_RESIZE
+
+
+def disk_webhook(event, name, size):
+    return {
+        'model': 'virtualdisk',
+        'event': event,
+        'data': {'id': int(name[-1]), 'name': name, 'size': size, 'virtual_machine': {'id': 7}, 'custom_fields': {'proxmox_disk_storage_volume': 'local-lvm'}}
+    }
+
+
+def merged(*webhooks):
+    batch = webhooks[0]
+
+    for webhook in webhooks[1:]:
+        batch = merge_disk_webhooks(batch, webhook)
+
+    return batch
+
+
+def test_merge_keeps_every_webhook_in_order():
+    batch = merged(disk_webhook('created', 'scsi1', 10000), disk_webhook('updated', 'scsi1', 20000), disk_webhook('created', 'scsi2', 5000))
+
+    assert batch['event'] == BATCH_EVENT
+    assert [(disk['event'], disk['data']['name']) for disk in batch['disks']] == [('created', 'scsi1'), ('updated', 'scsi1'), ('created', 'scsi2')]
+    assert batch['data']['name'] == 'scsi2'
+
+
+def test_created_then_resized_disk_is_added_at_its_final_size():
+    batch = merged(disk_webhook('created', 'scsi1', 10000), disk_webhook('updated', 'scsi1', 20000))
+
+    operation, disk_data = fold_disk_events(batch['disks'])['scsi1']
+
+    assert operation == DISK_OP_ADD
+    assert disk_data['size'] == 20000
+
+
+def test_os_disk_created_then_resized_is_resized():
+    # scsi0 comes with the clone, so a 'created' webhook for it is a resize
+    batch = merged(disk_webhook('created', 'scsi0', 32000), disk_webhook('updated', 'scsi0', 40000))
+
+    assert fold_disk_events(batch['disks']) == {'scsi0': (DISK_OP_RESIZE, batch['disks'][-1]['data'])}
+
+
+def test_created_then_deleted_disk_is_not_touched():
+    batch = merged(disk_webhook('created', 'scsi1', 10000), disk_webhook('deleted', 'scsi1', 10000))
+
+    assert fold_disk_events(batch['disks'])['scsi1'][0] is None
+
+
+def test_deleted_and_recreated_disk_is_replaced():
+    batch = merged(disk_webhook('deleted', 'scsi1', 10000), disk_webhook('created', 'scsi1', 30000))
+
+    assert fold_disk_events(batch['disks'])['scsi1'] == (DISK_OP_REPLACE, batch['disks'][-1]['data'])
+
+
+def test_each_disk_is_folded_on_its_own():
+    batch = merged(disk_webhook('created', 'scsi1', 10000), disk_webhook('deleted', 'scsi2', 5000), disk_webhook('updated', 'scsi3', 8000))
+
+    assert {name: operation for name, (operation, _) in fold_disk_events(batch['disks']).items()} == {
+        'scsi1': DISK_OP_ADD,
+        'scsi2': DISK_OP_DELETE,
+        'scsi3': DISK_OP_RESIZE
+    }
@@ -0,0 +1,44 @@
+import pytest
+
+from helpers.client_registry import ClientRegistry
+from helpers.fake_proxmox import allocate_disk, FakeProxmoxCluster, FakeProxmoxServer
+from helpers.task_watcher import ProxmoxTaskWatchers
+
+
+@pytest.fixture
+def fake_proxmox():
+    cluster = FakeProxmoxCluster(nodes=['pve1'], task_duration=0.05, task_duration_jitter=0, seed=1)
+    cluster.add_guest(100, 'web1', 'pve1')
+    server = FakeProxmoxServer(cluster).start()
+
+    proxmox_api = ClientRegistry().get_proxmox_api({
+        'api_proto': 'http',
+        'api_host': '127.0.0.1',
+        'api_port': server.port,
+        'api_user': 'root@pam',
+        'api_token_id': 'test',
+        'api_token_secret': 'secret'
+    })
+
+    yield cluster, proxmox_api
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_allocate_disk():
+    assert allocate_disk(100, 'scsi1', 'local-lvm:10.0,backup=0,ssd=0') == 'local-lvm:vm-100-disk-1,backup=0,ssd=0,size=10G'
+    assert allocate_disk(100, 'scsi0', 'local-lvm:vm-100-disk-0,size=32G') == 'local-lvm:vm-100-disk-0,size=32G'
+    assert allocate_disk(100, 'ide2', 'none,media=cdrom') == 'none,media=cdrom'
+    assert allocate_disk(100, 'name', 'web1') == 'web1'
+
+
+def test_added_disk_can_be_resized(fake_proxmox):
+    cluster, proxmox_api = fake_proxmox
+    task_watchers = ProxmoxTaskWatchers()
+    proxmox_vm = proxmox_api.nodes('pve1').qemu(100)
+
+    assert task_watchers.wait(proxmox_api, 'pve1', proxmox_vm.config.post(scsi1='local-lvm:10.0,backup=0,ssd=0'), 5)['exitstatus'] == 'OK'
+    assert task_watchers.wait(proxmox_api, 'pve1', proxmox_vm.resize.put(disk='scsi1', size='20.0G'), 5)['exitstatus'] == 'OK'
+
+    assert proxmox_vm.config.get()['scsi1'] == 'local-lvm:vm-100-disk-1,backup=0,ssd=0,size=20G'
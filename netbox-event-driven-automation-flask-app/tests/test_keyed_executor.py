@@ -0,0 +1,102 @@
+import threading
+import time
+
+from helpers.keyed_executor import KeyedExecutor
+
+
+def test_work_for_one_key_runs_in_order():
+    executor = KeyedExecutor(workers=4)
+    executor.start()
+    done = []
+
+    def work(n):
+        time.sleep(0.01 * (5 - n))
+        done.append(n)
+
+    futures = [executor.submit('vm-7', work, n) for n in range(5)]
+
+    for future in futures:
+        future.result(5)
+
+    assert done == [0, 1, 2, 3, 4]
+
+
+def test_different_keys_run_in_parallel():
+    executor = KeyedExecutor(workers=2)
+    executor.start()
+    barrier = threading.Barrier(2, timeout=5)
+
+    # deadlocks (and times out) unless both keys run at the same time
+    futures = [executor.submit(key, barrier.wait) for key in ('vm-1', 'vm-2')]
+
+    for future in futures:
+        future.result(5)
+
+
+def test_pending_work_with_the_same_merge_key_is_coalesced():
+    executor = KeyedExecutor(workers=1)
+    executor.start()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def blocker():
+        started.set()
+        release.wait(5)
+
+    def apply(value):
+        calls.append(value)
+        return value
+
+    def merge(pending_args, incoming_args):
+        return (pending_args[0] + incoming_args[0],)
+
+    executor.submit('vm-7', blocker)
+    started.wait(5)
+
+    futures = [executor.submit('vm-7', apply, [n], merge_key='updates', merge=merge) for n in range(3)]
+    release.set()
+
+    assert [future.result(5) for future in futures] == [[0, 1, 2]] * 3
+    assert calls == [[0, 1, 2]]
+    assert executor.get_stats()['coalesced'] == 2
+
+
+def test_other_work_in_between_is_not_coalesced():
+    executor = KeyedExecutor(workers=1)
+    executor.start()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def blocker():
+        started.set()
+        release.wait(5)
+
+    def merge(pending_args, incoming_args):
+        return (pending_args[0] + incoming_args[0],)
+
+    executor.submit('vm-7', blocker)
+    started.wait(5)
+
+    futures = [
+        executor.submit('vm-7', calls.append, ['a'], merge_key='updates', merge=merge),
+        executor.submit('vm-7', calls.append, ['b']),
+        executor.submit('vm-7', calls.append, ['c'], merge_key='updates', merge=merge)
+    ]
+    release.set()
+
+    for future in futures:
+        future.result(5)
+
+    assert calls == [['a'], ['b'], ['c']]
+
+
+def test_coalescing_window_holds_work_back():
+    executor = KeyedExecutor(workers=1)
+    executor.start()
+    start_time = time.monotonic()
+
+    future = executor.submit('vm-7', time.monotonic, merge_key='updates', merge=lambda pending_args, incoming_args: incoming_args, delay=0.2, max_delay=1)
+
+    assert future.result(5) - start_time >= 0.2
@@ -0,0 +1,41 @@
+from helpers.vm_config import desired_vm_config, vm_config_changes, vm_config_failed, FIELD_FAILED, FIELD_UNCHANGED, FIELD_UPDATED
+
+
+def test_unchanged_fields_are_not_sent():
+    desired = {'cores': 2, 'memory': 2048}
+    current = {'cores': '2', 'memory': 4096}
+
+    assert vm_config_changes(desired, current) == ({'memory': 2048}, {'cores': FIELD_UNCHANGED, 'memory': FIELD_UPDATED})
+
+
+def test_ipconfig_is_compared_regardless_of_order():
+    desired = {'ipconfig0': 'ip=10.0.0.5/24,gw=10.0.0.1'}
+
+    assert vm_config_changes(desired, {'ipconfig0': 'gw=10.0.0.1,ip=10.0.0.5/24'}) == ({}, {'ipconfig0': FIELD_UNCHANGED})
+    assert vm_config_changes(desired, {'ipconfig0': 'ip=10.0.0.6/24,gw=10.0.0.1'})[0] == desired
+
+
+def test_sshkeys_are_compared_unescaped():
+    vm_config = desired_vm_config({
+        'data': {'primary_ip': None, 'custom_fields': {'proxmox_public_ssh_key': 'ssh-ed25519 AAAA user@host\n'}},
+        'snapshots': {'postchange': {'vcpus': None, 'memory': None}}
+    }, None)
+
+    assert vm_config_changes(vm_config, {'sshkeys': 'ssh-ed25519%20AAAA%20user%40host%0A'}) == ({}, {'sshkeys': FIELD_UNCHANGED})
+
+
+def test_missing_fields_are_sent():
+    assert vm_config_changes({'cores': 1}, {}) == ({'cores': 1}, {'cores': FIELD_UPDATED})
+
+
+def test_desired_config_from_webhook():
+    vm_config = desired_vm_config({
+        'data': {'primary_ip': {'address': '10.0.0.5/24'}, 'custom_fields': {}},
+        'snapshots': {'postchange': {'vcpus': 2.0, 'memory': 2048}}
+    }, lambda ip_address: '10.0.0.1')
+
+    assert vm_config == {'cores': 2, 'memory': 2048, 'ipconfig0': 'ip=10.0.0.5/24,gw=10.0.0.1'}
+
+
+def test_failed_update_marks_only_changed_fields():
+    assert vm_config_failed({'cores': FIELD_UPDATED, 'memory': FIELD_UNCHANGED}) == {'cores': FIELD_FAILED, 'memory': FIELD_UNCHANGED}
@@ -0,0 +1,93 @@
+import pytest
+
+from helpers.webhook_event import WebhookEvent
+from helpers.webhook_router import build_webhook_routes, webhook_route_key, WEBHOOK_ROUTES
+
+
+def vm_webhook(event, status, vm_type='vm', node='pve1', prechange_node='pve1', prechange_status=None, has_node=True):
+    custom_fields = {'proxmox_vm_type': vm_type, 'proxmox_vmid': 101}
+
+    if has_node:
+        custom_fields['proxmox_node'] = node
+
+    return {
+        'model': 'virtualmachine',
+        'event': event,
+        'request_id': 'r1',
+        'data': {'id': 7, 'name': 'web1', 'status': {'value': status}, 'custom_fields': custom_fields},
+        'snapshots': {
+            'prechange': {'status': prechange_status or status, 'custom_fields': {'proxmox_node': prechange_node}},
+            'postchange': {'status': status, 'custom_fields': custom_fields}
+        }
+    }
+
+
+def disk_webhook(event, name='scsi1', size=20000, prechange_size=10000):
+    return {
+        'model': 'virtualdisk',
+        'event': event,
+        'request_id': 'r2',
+        'data': {'id': 3, 'name': name, 'size': size, 'virtual_machine': {'id': 7}, 'custom_fields': {'proxmox_disk_storage_volume': 'local-lvm'}},
+        'snapshots': {'prechange': {'size': prechange_size}, 'postchange': {'size': size}}
+    }
+
+
+def route(webhook_json_data):
+    return WEBHOOK_ROUTES.get(webhook_route_key(WebhookEvent.from_json(webhook_json_data)))
+
+
+# the operations that the original if/elif dispatch in app.py chose for these webhooks
+@pytest.mark.parametrize('webhook_json_data, operation', [
+    (vm_webhook('created', 'staged', has_node=False), 'missing-proxmox-node'),
+    (vm_webhook('created', 'staged'), 'vm-clone'),
+    (vm_webhook('updated', 'staged'), 'vm-update-config'),
+    (vm_webhook('deleted', 'staged'), 'vm-delete'),
+    (vm_webhook('deleted', 'active'), 'vm-delete'),
+    (vm_webhook('deleted', 'failed'), 'vm-delete'),
+    (vm_webhook('updated', 'active', node='pve2'), 'vm-migrate'),
+    (vm_webhook('updated', 'offline', node='pve2', prechange_status='active'), 'vm-migrate'),
+    (vm_webhook('updated', 'active', prechange_status='offline'), 'vm-start'),
+    (vm_webhook('updated', 'offline', prechange_status='active'), 'vm-stop'),
+    (vm_webhook('updated', 'active'), None),
+    (vm_webhook('updated', 'failed', prechange_status='active'), 'unknown-status'),
+    (vm_webhook('created', 'staged', vm_type='lxc'), 'lxc-create'),
+    (vm_webhook('created', 'active', vm_type='lxc'), 'unknown-event'),
+    (vm_webhook('updated', 'staged', vm_type='lxc'), 'lxc-update-config'),
+    (vm_webhook('updated', 'active', vm_type='lxc'), 'lxc-start'),
+    (vm_webhook('updated', 'offline', vm_type='lxc'), 'lxc-stop'),
+    (vm_webhook('updated', 'failed', vm_type='lxc'), 'unknown-status'),
+    (vm_webhook('deleted', 'active', vm_type='lxc'), 'lxc-delete'),
+    (disk_webhook('created'), 'vm-add-disk'),
+    (disk_webhook('updated'), 'vm-resize-disk'),
+    (disk_webhook('updated', prechange_size=20000), 'vm-resize-disk'),
+    (disk_webhook('deleted'), 'vm-delete-disk'),
+    (disk_webhook('updated', name='rootfs'), 'lxc-resize-disk'),
+    (disk_webhook('updated', name='rootfs', prechange_size=20000), None),
+    (disk_webhook('deleted', name='rootfs'), 'lxc-delete-disk'),
+    (disk_webhook('created', name='rootfs'), None),
+])
+def test_webhook_routes(webhook_json_data, operation):
+    assert route(webhook_json_data) == operation
+
+
+def test_route_key_ignores_changes_for_staged_vms():
+    assert webhook_route_key(WebhookEvent.from_json(vm_webhook('updated', 'staged', node='pve2', prechange_status='active'))) == ('virtualmachine', 'vm', 'staged', 'updated', None)
+
+
+def test_route_key_prefers_migration_over_status_change():
+    assert webhook_route_key(WebhookEvent.from_json(vm_webhook('updated', 'active', node='pve2', prechange_status='offline')))[4] == 'node'
+
+
+def test_other_models_are_not_routed():
+    webhook_event = WebhookEvent.from_json({'model': 'device', 'event': 'created', 'data': {'id': 1}})
+
+    assert webhook_route_key(webhook_event) == ('device', None, None, 'created', None)
+    assert WEBHOOK_ROUTES.get(webhook_route_key(webhook_event)) is None
+
+
+def test_build_webhook_routes_returns_a_fresh_table():
+    routes = build_webhook_routes()
+    routes.clear()
+
+    assert build_webhook_routes() == WEBHOOK_ROUTES
+    assert WEBHOOK_ROUTES[('virtualdisk', 'vm', None, 'batch', None)] == 'vm-disk-batch'